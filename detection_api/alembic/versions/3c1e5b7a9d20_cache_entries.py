@@ -0,0 +1,38 @@
+"""cache entries
+
+Revision ID: 3c1e5b7a9d20
+Revises: 17a8f9d4c8a8
+Create Date: 2026-10-17 09:12:40.512384
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3c1e5b7a9d20'
+down_revision: Union[str, None] = '17a8f9d4c8a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'cache_entries',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('is_deleted', sa.Boolean(), nullable=False, server_default='false'),
+        sa.Column('namespace', sa.String(), nullable=False),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('value', sa.Text(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name='pk_cache_entries'),
+        sa.UniqueConstraint('namespace', 'key', name='uq_cache_entries_namespace_key'),
+    )
+    op.create_index('ix_cache_entries_expires_at', 'cache_entries', ['expires_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_cache_entries_expires_at', table_name='cache_entries')
+    op.drop_table('cache_entries')
@@ -0,0 +1,59 @@
+"""batch jobs
+
+Revision ID: 5b7d9e1f3a42
+Revises: 8e2d4f6a1b3c
+Create Date: 2026-10-17 16:02:27.730115
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '5b7d9e1f3a42'
+down_revision: Union[str, None] = '8e2d4f6a1b3c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'batch_jobs',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('is_deleted', sa.Boolean(), nullable=False, server_default='false'),
+        sa.Column('user_id', sa.String(), nullable=True),
+        sa.Column('model_name', sa.String(), nullable=False),
+        sa.Column('contextualize', sa.String(), nullable=False),
+        sa.Column('total_items', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False, server_default='queued'),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name='pk_batch_jobs'),
+    )
+    op.create_table(
+        'batch_items',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('is_deleted', sa.Boolean(), nullable=False, server_default='false'),
+        sa.Column('job_id', sa.String(), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('lease_expires_at', sa.DateTime(), nullable=True),
+        sa.Column('analysis_result_id', sa.String(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name='pk_batch_items'),
+        sa.ForeignKeyConstraint(['job_id'], ['batch_jobs.id'], name='fk_batch_items_job_id', ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['analysis_result_id'], ['analysis_results.id'],
+                                name='fk_batch_items_analysis_result_id'),
+        sa.UniqueConstraint('job_id', 'position', name='uq_batch_items_job_id_position'),
+    )
+    op.create_index('ix_batch_items_status_lease_expires_at', 'batch_items', ['status', 'lease_expires_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_batch_items_status_lease_expires_at', table_name='batch_items')
+    op.drop_table('batch_items')
+    op.drop_table('batch_jobs')
@@ -0,0 +1,45 @@
+"""result jsonb
+
+Revision ID: 8e2d4f6a1b3c
+Revises: 3c1e5b7a9d20
+Create Date: 2026-10-17 13:41:05.208731
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '8e2d4f6a1b3c'
+down_revision: Union[str, None] = '3c1e5b7a9d20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Results were stored as json.dumps output, so every existing value casts cleanly
+    op.alter_column('analysis_results', 'result',
+                    type_=postgresql.JSONB(),
+                    existing_type=sa.Text(),
+                    postgresql_using='result::jsonb')
+
+    # Build the indexes without locking the table against writes
+    with op.get_context().autocommit_block():
+        op.create_index('ix_analysis_results_user_id_created_at', 'analysis_results',
+                        ['user_id', 'created_at', 'id'], postgresql_concurrently=True)
+        op.create_index('ix_analysis_results_created_at', 'analysis_results',
+                        ['created_at'], postgresql_concurrently=True)
+        op.create_index('ix_analysis_results_result', 'analysis_results',
+                        ['result'], postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_analysis_results_result', table_name='analysis_results')
+    op.drop_index('ix_analysis_results_created_at', table_name='analysis_results')
+    op.drop_index('ix_analysis_results_user_id_created_at', table_name='analysis_results')
+    op.alter_column('analysis_results', 'result',
+                    type_=sa.Text(),
+                    existing_type=postgresql.JSONB(),
+                    postgresql_using='result::text')
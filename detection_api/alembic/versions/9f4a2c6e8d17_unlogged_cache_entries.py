@@ -0,0 +1,30 @@
+"""unlogged cache entries
+
+Revision ID: 9f4a2c6e8d17
+Revises: 5b7d9e1f3a42
+Create Date: 2026-10-17 21:40:11.204583
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '9f4a2c6e8d17'
+down_revision: Union[str, None] = '5b7d9e1f3a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Cache entries can be recomputed, so they are not worth the write-ahead log
+    op.execute("ALTER TABLE cache_entries SET UNLOGGED")
+    # Values are stored as bytes, so they can be compressed. Existing JSON entries stay readable.
+    op.execute("ALTER TABLE cache_entries ALTER COLUMN value TYPE bytea USING convert_to(value, 'UTF8')")
+
+
+def downgrade() -> None:
+    # Compressed entries cannot be converted back to text
+    op.execute("DELETE FROM cache_entries")
+    op.execute("ALTER TABLE cache_entries ALTER COLUMN value TYPE text USING convert_from(value, 'UTF8')")
+    op.execute("ALTER TABLE cache_entries SET LOGGED")
@@ -0,0 +1,28 @@
+"""contextualize values
+
+Revision ID: b4e8d2a6c1f9
+Revises: 9f4a2c6e8d17
+Create Date: 2026-10-17 23:05:42.318907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e8d2a6c1f9'
+down_revision: Union[str, None] = '9f4a2c6e8d17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Batch jobs stored "True" and "False", and copied them to their analysis results
+    for table in ("batch_jobs", "analysis_results"):
+        op.execute(f"UPDATE {table} SET contextualize = lower(contextualize) "
+                   f"WHERE contextualize IN ('True', 'False')")
+
+
+def downgrade() -> None:
+    # The values written by the websocket endpoints cannot be told apart from the batch ones anymore
+    pass
@@ -1,20 +1,37 @@
 import asyncio
+import base64
+import copy
 import json
 import logging
+import os
 import uuid
-from typing import Literal, Union, Optional
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Literal, Union, Optional
 
 import logfire
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from starlette.websockets import WebSocketState
 
 import dependencies
-from database import AnalysisResult
+from database import AnalysisResult, BatchJob, format_contextualize, parse_contextualize
+from database.batch import BatchWorker, iter_batch_results
+from database.export import export_analysis_results, ndjson_chunks
 from database.repo import Repo
-from llm.contextualizer import Contextualizer
+from database.writer import WriteBehindQueue
+from llm import http_pool
+from llm.budget import (RequestBudget, BudgetExceeded, SKIPPED_BUDGET, budget, budget_counters, current_budget,
+                        entry_slot, within_deadline)
+from llm.cache import cache_stats, content_key, normalize_text
+from llm.contextualizer import Contextualizer, context_flight, engine_stats, CONTEXT_ENGINE
+from llm.google_retriever import search_stats
+from llm.load_llm import warm_up, registry_stats
+from llm.page_fetcher import page_stats
+from llm.scheduler import scheduler, priority, PRIORITY_BACKGROUND
 from llm.propaganda_detection import OpenAITextClassificationPropagandaInference
 
 # Configure logging
@@ -23,8 +40,43 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     handlers=[logfire.LogfireLoggingHandler()])
 
+# Models whose clients are created and connected when a worker starts
+WARMUP_MODELS = [model for model in os.getenv("WARMUP_MODELS", "gpt-4o").split(",") if model]
+# Whether this process works on the queued batch jobs, and how many articles one job may hold
+BATCH_WORKER_ENABLED = os.getenv("BATCH_WORKER_ENABLED", "true").lower() in ("1", "true", "yes")
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+# Whether the detection results of an analysis whose client disconnected are still saved
+SAVE_PARTIAL_RESULTS = os.getenv("SAVE_PARTIAL_RESULTS", "true").lower() in ("1", "true", "yes")
+
+
+# Analysis results are saved in the background, so database stalls do not block the websockets
+analysis_writer = WriteBehindQueue(AnalysisResult)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the shared LLM clients up front and open their keep-alive connections
+    llms = []
+    for model_name in WARMUP_MODELS:
+        try:
+            llms.append(OpenAITextClassificationPropagandaInference(model_name=model_name).llm)
+            llms.append(Contextualizer(model_name=model_name).llm)
+        except Exception as e:
+            logging.warning(f"Failed to warm up model {model_name}: {e}")
+    await warm_up(llms)
+    logging.info(f"Warmed up models: {WARMUP_MODELS}")
+    analysis_writer.start()
+    if BATCH_WORKER_ENABLED:
+        batch_worker.start()
+    yield
+    # Hand the running batch items back and write the analysis results that are still queued before the worker exits
+    await batch_worker.stop()
+    await analysis_writer.stop()
+    await http_pool.aclose_all()
+
+
 # Initialize the FastAPI application
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 logfire.instrument_fastapi(app)
 app.add_middleware(
     CORSMiddleware,
@@ -41,15 +93,30 @@ class Request(BaseModel):
     model_name: str
     text: str
     contextualize: Union[Literal["Auto"], bool] = False
+    stream: bool = False  # Send each contextualized entry as soon as it is done
+    stream_detection: bool = False  # Send each detected entry as soon as the model has generated it
+    context_engine: Literal["agent", "retrieve"] = CONTEXT_ENGINE  # See CONTEXT_ENGINES in llm/contextualizer.py
+    # Limits for this request, capped by the server's maximums (see llm/budget.py)
+    budget_seconds: Optional[float] = None
+    budget_tokens: Optional[int] = None
+    budget_searches: Optional[int] = None
+
+
+class BatchRequest(BaseModel):
+    user_id: Optional[str] = None
+    model_name: str
+    texts: List[str]
+    contextualize: Union[Literal["Auto"], bool] = False
 
 
 # Define a function to process each entry in the analysis results
-async def process_entry(entry, contextualizer: Contextualizer, auto=False):
+async def process_entry(entry, contextualizer: Contextualizer, auto=False, seems_factual=None):
     entry["contextualize_status"] = "success"
 
     try:
         if auto:
-            seems_factual = await contextualizer.seems_factual(entry["location"])
+            if seems_factual is None:
+                seems_factual = await contextualizer.seems_factual(entry["location"])
             if seems_factual:
                 result = await contextualizer.process_statement(entry["location"])
             else:
@@ -65,6 +132,8 @@ async def process_entry(entry, contextualizer: Contextualizer, auto=False):
         else:
             entry["contextualize_status"] = "error"
             entry["contextualize_error"] = result["error"]
+    except BudgetExceeded:
+        raise
     except Exception as e:
         logging.error(f"An error occurred during contextualization: {e}", exc_info=True)
         entry["contextualize_status"] = "error"
@@ -73,20 +142,51 @@ async def process_entry(entry, contextualizer: Contextualizer, auto=False):
     return entry
 
 
+# Define a function to contextualize a single entry and report it once it is done
+async def contextualize_entry(request, contextualizer: Contextualizer, technique, entry_id, entry,
+                              on_entry=None, seems_factual=None):
+    try:
+        # Every LLM call and search of the entry is checked against the budget as well
+        async with entry_slot(current_budget()):
+            await within_deadline(process_entry(entry, contextualizer, auto=request.contextualize == "Auto",
+                                                seems_factual=seems_factual))
+    except BudgetExceeded as e:
+        # The entry is reported without a contextualization instead of running over the request's budget
+        entry["contextualize_status"] = SKIPPED_BUDGET
+        entry.pop("contextualize_error", None)
+        budget_counters["skipped_entries"] += 1
+        logging.info(f"Skipped contextualization of {entry_id}: {e}")
+    if on_entry is not None:
+        await on_entry(technique, entry_id, entry)
+
+
 # Define a function to contextualize the analysis results
-async def contextualize(request, analysis_results):
+async def contextualize(request, analysis_results, on_entry=None):
+    """
+    Contextualizes every detected entry in place. If on_entry is given, it is awaited with
+    (technique, entry_id, entry) as soon as each entry is done.
+    """
     if request.contextualize in [True, "Auto"]:
-        contextualizer = Contextualizer(model_name=request.model_name)
-        tasks = []
+        contextualizer = Contextualizer(model_name=request.model_name, engine=request.context_engine)
+        entries = [(technique, f"{technique}:{index}", entry)
+                   for technique, technique_entries in analysis_results.items()
+                   for index, entry in enumerate(technique_entries)]
 
-        for category, entries in analysis_results.items():
-            for entry in entries:
-                if request.contextualize == "Auto":
-                    tasks.append(process_entry(entry, contextualizer, auto=True))
-                else:
-                    tasks.append(process_entry(entry, contextualizer))
+        if request.contextualize == "Auto":
+            # Label all candidate locations up front instead of one classification call per entry
+            try:
+                labels = await within_deadline(
+                    contextualizer.classify_factual([entry["location"] for _, _, entry in entries]))
+            except BudgetExceeded:
+                # Every entry is skipped by contextualize_entry
+                labels = [None] * len(entries)
+        else:
+            labels = [None] * len(entries)
 
-        await asyncio.gather(*tasks)
+        await asyncio.gather(*[
+            contextualize_entry(request, contextualizer, technique, entry_id, entry, on_entry, seems_factual=label)
+            for (technique, entry_id, entry), label in zip(entries, labels)
+        ])
         return True
     return False
 
@@ -98,7 +198,283 @@ async def detect_propaganda_async(request):
     return analysis_results
 
 
-async def handle_request(data, websocket, repo):
+async def detect_propaganda_stream(request, on_entry):
+    inference_class = OpenAITextClassificationPropagandaInference(model_name=request.model_name)
+    analysis_results = await inference_class.analyze_article_stream(request.text, on_entry)
+    return analysis_results
+
+
+async def run_analysis(request, send, on_detected=None):
+    """
+    Runs detection and, if requested, contextualization for a request, passing every message for the client to
+    send(message). Returns the analysis results, or None if the detection failed.
+
+    If on_detected is given, it is called with the analysis results as soon as the detection succeeded. They are
+    contextualized in place afterwards.
+
+    All LLM and search calls of the request are charged to one budget. Once it runs out, the remaining entries are
+    marked as skipped instead of contextualized.
+    """
+    request_budget = RequestBudget.for_request(deadline_seconds=request.budget_seconds,
+                                               max_tokens=request.budget_tokens,
+                                               max_searches=request.budget_searches)
+    with budget(request_budget):
+        analysis_results = await run_analysis_steps(request, send, on_detected)
+    logging.info(f"Request budget used: {request_budget.stats()}")
+    return analysis_results
+
+
+async def run_analysis_steps(request, send, on_detected=None):
+    async def send_context_entry(technique, entry_id, entry):
+        await send({
+            "type": "contextualization_entry",
+            "status": "success",
+            "technique": technique,
+            "entry_id": entry_id,
+            "data": entry
+        })
+
+    on_context_entry = send_context_entry if request.stream else None
+
+    # Step 1: Perform propaganda analysis
+    context_tasks = []
+    if request.stream_detection:
+        contextualizer = None
+        if request.contextualize in [True, "Auto"]:
+            contextualizer = Contextualizer(model_name=request.model_name, engine=request.context_engine)
+
+        async def on_detection(technique, entry_id, entry):
+            await send({
+                "type": "propaganda_detection_entry",
+                "status": "success",
+                "technique": technique,
+                "entry_id": entry_id,
+                "data": entry
+            })
+            if contextualizer is not None:
+                # Start contextualizing the entry while the rest of the article is still being analyzed
+                context_tasks.append(asyncio.ensure_future(
+                    contextualize_entry(request, contextualizer, technique, entry_id, entry, on_context_entry)))
+
+        try:
+            analysis_results = await within_deadline(detect_propaganda_stream(request, on_detection))
+        except BudgetExceeded as e:
+            analysis_results = {"status": "error", "error": str(e)}
+        except asyncio.CancelledError:
+            for task in context_tasks:
+                task.cancel()
+            raise
+    else:
+        try:
+            analysis_results = await within_deadline(detect_propaganda_async(request))
+        except BudgetExceeded as e:
+            analysis_results = {"status": "error", "error": str(e)}
+    logging.info(f"Analysis results: {analysis_results}")
+
+    # Step 2: Send the raw propaganda analysis back to the client
+    status = analysis_results.pop("status", "error")
+    if status == "error":
+        for task in context_tasks:
+            task.cancel()
+        await send({
+            "type": "propaganda_detection",
+            "status": "error",
+            "message": analysis_results.get("error", "Unknown error")
+        })
+        return None
+    if on_detected is not None:
+        on_detected(analysis_results)
+    if request.stream_detection:
+        await send({
+            "type": "propaganda_detection_complete",
+            "status": "success"
+        })
+    else:
+        await send({
+            "type": "propaganda_detection",
+            "status": "success",
+            "data": analysis_results
+        })
+
+    # Step 3: If contextualization is enabled, process it and send the updated entries
+    try:
+        if request.stream_detection:
+            await asyncio.gather(*context_tasks)
+            was_contextualized = request.contextualize in [True, "Auto"]
+        else:
+            was_contextualized = await contextualize(request, analysis_results, on_entry=on_context_entry)
+        if was_contextualized and request.stream:
+            await send({
+                "type": "contextualization_complete",
+                "status": "success"
+            })
+        elif was_contextualized:
+            await send({
+                "type": "contextualization",
+                "status": "success",
+                "data": analysis_results
+            })
+    except Exception as e:
+        logging.error(f"An error occurred during contextualization: {e}", exc_info=True)
+        await send({
+            "type": "contextualization",
+            "status": "error",
+            "message": f"An error occurred during contextualization: {str(e)}"
+        })
+
+    return analysis_results
+
+
+class AnalysisBroadcast:
+    """
+    A running analysis whose messages are delivered to every client that subscribed to it,
+    including the ones that were published before the client subscribed.
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.messages = []
+        self.queues = []
+        self.task = None
+        self.detection_results = None  # Set once the detection succeeded
+
+    async def publish(self, message):
+        # Snapshot the message, as the entries it contains are still being contextualized
+        message = copy.deepcopy(message)
+        self.messages.append(message)
+        for queue in self.queues:
+            queue.put_nowait(message)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        for message in self.messages:
+            queue.put_nowait(message)
+        self.queues.append(queue)
+        if self.task.done():
+            queue.put_nowait(None)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self.queues:
+            self.queues.remove(queue)
+
+    def finish(self):
+        for queue in self.queues:
+            queue.put_nowait(None)
+
+
+# Identical requests that are currently being analyzed, see analysis_key
+in_flight_analyses = {}
+analysis_counters = {"started": 0, "joined": 0, "cancelled": 0, "disconnected": 0, "partial_saved": 0}
+
+
+def analysis_key(request):
+    return content_key(normalize_text(request.text), request.model_name, request.contextualize,
+                       request.context_engine, request.stream, request.stream_detection,
+                       request.budget_seconds, request.budget_tokens, request.budget_searches)
+
+
+def join_analysis(request) -> AnalysisBroadcast:
+    """
+    Returns the running analysis for an identical request, or starts a new one.
+    """
+    key = analysis_key(request)
+    analysis = in_flight_analyses.get(key)
+    if analysis is not None:
+        analysis_counters["joined"] += 1
+        logging.info("Joining an identical analysis that is already running")
+        return analysis
+
+    analysis = AnalysisBroadcast(key)
+
+    def on_detected(analysis_results):
+        analysis.detection_results = analysis_results
+
+    analysis.task = asyncio.ensure_future(run_analysis(request, analysis.publish, on_detected))
+
+    def on_done(task):
+        if in_flight_analyses.get(key) is analysis:
+            del in_flight_analyses[key]
+        analysis.finish()
+
+    analysis.task.add_done_callback(on_done)
+    in_flight_analyses[key] = analysis
+    analysis_counters["started"] += 1
+    return analysis
+
+
+def leave_analysis(analysis: AnalysisBroadcast, queue: asyncio.Queue):
+    """
+    Unsubscribes a client from an analysis. The analysis, with its detection and contextualization calls,
+    is cancelled when no client is left to receive it.
+    """
+    analysis.unsubscribe(queue)
+    if analysis.queues or analysis.task.done():
+        return
+    if in_flight_analyses.get(analysis.key) is analysis:
+        del in_flight_analyses[analysis.key]
+    analysis.task.cancel()
+    analysis_counters["cancelled"] += 1
+    logging.info("Cancelled an analysis that no client is waiting for anymore")
+
+
+def partial_results(analysis_results):
+    """
+    Returns a copy of analysis results whose contextualization was interrupted, marking the unfinished entries.
+    """
+    analysis_results = copy.deepcopy(analysis_results)
+    for entries in analysis_results.values():
+        for entry in entries:
+            if "contextualize_status" in entry and "contextualize" not in entry and "contextualize_error" not in entry:
+                entry["contextualize_status"] = "cancelled"
+    return analysis_results
+
+
+async def stream_analysis(request, user_id, send):
+    """
+    Runs the analysis of a request, or subscribes to an identical one that is already running, and passes each of
+    its messages, tagged with the user_id, to send(message). Returns the analysis results, or None on error.
+
+    If the caller is cancelled or send fails, e.g. because the client disconnected, the caller is unsubscribed
+    and the finished detection results are still saved (see SAVE_PARTIAL_RESULTS).
+    """
+    analysis = join_analysis(request)
+    queue = analysis.subscribe()
+    finished = False
+    try:
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            await send({"user_id": user_id, **message})
+        finished = True
+        return analysis.task.result()
+    finally:
+        leave_analysis(analysis, queue)
+        if not finished and SAVE_PARTIAL_RESULTS and analysis.detection_results is not None:
+            analysis_counters["partial_saved"] += 1
+            asyncio.ensure_future(save_analysis(request, user_id, partial_results(analysis.detection_results)))
+
+
+async def wait_for_disconnect(websocket: WebSocket):
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+async def save_analysis(request, user_id, analysis_results):
+    # Queue the full response to be saved to the database
+    await analysis_writer.submit(dict(
+        user_id=user_id,
+        model_name=request.model_name,
+        text=request.text,
+        contextualize=format_contextualize(request.contextualize),
+        result=analysis_results
+    ))
+
+
+async def handle_request(data, websocket):
     request = Request.parse_raw(data)
     with logfire.span("handle_request user_id={user_id} model_name={model_name} contextualize={contextualize}",
                       user_id=request.user_id,
@@ -114,70 +490,340 @@ async def handle_request(data, websocket, repo):
             user_id = request.user_id
             logging.info(f"Using existing user_id: {user_id}")
 
-        # Step 1: Perform propaganda analysis
-        analysis_results = await detect_propaganda_async(request)
-        logging.info(f"Analysis results: {analysis_results}")
-
-        # Step 2: Send the raw propaganda analysis back to the client
-        status = analysis_results.pop("status", "error")
-        if status == "error":
-            await websocket.send_text(json.dumps({
-                "user_id": user_id,
-                "type": "propaganda_detection",
-                "status": "error",
-                "message": analysis_results.get("error", "Unknown error")
-            }))
-            await websocket.close()
+        # Steps 1-3: Run the analysis and forward its messages to the client
+        async def send(message):
+            await websocket.send_text(json.dumps(message))
+
+        # Watch for a disconnect while the analysis runs, so work nobody receives anymore is cancelled
+        forward = asyncio.ensure_future(stream_analysis(request, user_id, send))
+        disconnect = asyncio.ensure_future(wait_for_disconnect(websocket))
+        try:
+            await asyncio.wait({forward, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+            disconnected = not forward.done() or isinstance(forward.exception(), WebSocketDisconnect)
+            if disconnected:
+                analysis_counters["disconnected"] += 1
+                logging.info("Client disconnected during the analysis")
+                forward.cancel()
+                await asyncio.gather(forward, return_exceptions=True)
+        if disconnected:
+            return
+        analysis_results = forward.result()
+
+        # Step 4: Close the WebSocket connection after all responses are sent
+        await websocket.close()
+        if analysis_results is None:
+            return
+
+        # Step 5: Save the full response
+        await save_analysis(request, user_id, analysis_results)
+
+
+# Limits of one session connection, see AnalysisSession
+SESSION_MAX_CONCURRENCY = int(os.getenv("SESSION_MAX_CONCURRENCY", "4"))
+SESSION_MAX_PENDING = int(os.getenv("SESSION_MAX_PENDING", "50"))
+SESSION_PING_INTERVAL = float(os.getenv("SESSION_PING_INTERVAL", "20"))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "60"))
+
+session_counters = {"opened": 0, "closed": 0, "requests": 0, "rejected": 0, "cancelled": 0}
+
+
+class AnalysisSession:
+    """
+    A websocket connection that carries many analysis requests.
+
+    Every request is tagged with a client-supplied request_id, which is added to all of its messages. Requests run
+    concurrently, at most SESSION_MAX_CONCURRENCY at a time, and their messages are interleaved. The server sends
+    a ping every SESSION_PING_INTERVAL seconds and answers the client's pings. A session without running requests
+    that receives nothing from the client for SESSION_IDLE_TIMEOUT seconds is closed.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.semaphore = asyncio.Semaphore(SESSION_MAX_CONCURRENCY)
+        self.send_lock = asyncio.Lock()
+        self.tasks = {}
+        self.user_id = None
+        self.closed = False
+
+    async def send(self, message):
+        if self.closed:
             return
+        try:
+            # Messages of concurrent requests must not interleave within a frame
+            async with self.send_lock:
+                await self.websocket.send_text(json.dumps(message))
+        except Exception as e:
+            logging.info(f"Session closed while sending: {e}")
+            self.closed = True
+
+    async def send_error(self, message, request_id=None):
+        await self.send({"type": "error", "status": "error", "request_id": request_id, "message": message})
+
+    async def run(self):
+        heartbeat = asyncio.ensure_future(self.heartbeat())
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(self.websocket.receive_text(), SESSION_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if self.tasks:
+                        continue
+                    logging.info("Closing idle session")
+                    await self.websocket.close()
+                    break
+                await self.handle_message(data)
+        finally:
+            self.closed = True
+            heartbeat.cancel()
+            # Nobody receives the results of the running requests anymore
+            for task in list(self.tasks.values()):
+                task.cancel()
+                session_counters["cancelled"] += 1
+
+    async def heartbeat(self):
+        while not self.closed:
+            await asyncio.sleep(SESSION_PING_INTERVAL)
+            await self.send({"type": "ping"})
+
+    async def handle_message(self, data):
+        try:
+            message = json.loads(data)
+            message_type = message.get("type", "analyze")
+        except Exception:
+            await self.send_error("Invalid message")
+            return
+
+        if message_type == "ping":
+            await self.send({"type": "pong"})
+        elif message_type == "pong":
+            pass
+        elif message_type == "analyze":
+            await self.start_request(message)
         else:
-            await websocket.send_text(json.dumps({
-                "user_id": user_id,
-                "type": "propaganda_detection",
-                "status": "success",
-                "data": analysis_results
-            }))
+            await self.send_error(f"Unknown message type: {message_type}")
 
-        # Step 3: If contextualization is enabled, process it and send the updated entries
+    async def start_request(self, message):
+        request_id = message.get("request_id")
+        if request_id is None or request_id in self.tasks:
+            await self.send_error("Every request needs a request_id that is not in use", request_id)
+            return
+        if len(self.tasks) >= SESSION_MAX_PENDING:
+            session_counters["rejected"] += 1
+            await self.send_error(f"Too many requests, at most {SESSION_MAX_PENDING} may be pending", request_id)
+            return
         try:
-            was_contextualized = await contextualize(request, analysis_results)
-            if was_contextualized:
-                await websocket.send_text(json.dumps({
-                    "user_id": user_id,
-                    "type": "contextualization",
-                    "status": "success",
-                    "data": analysis_results
-                }))
+            request = Request.parse_obj(message)
         except Exception as e:
-            logging.error(f"An error occurred during contextualization: {e}", exc_info=True)
-            await websocket.send_text(json.dumps({
-                "user_id": user_id,
-                "type": "contextualization",
-                "status": "error",
-                "message": f"An error occurred during contextualization: {str(e)}"
-            }))
+            await self.send_error(f"Invalid request: {e}", request_id)
+            return
 
-        # Step 4: Close the WebSocket connection after all responses are sent
-        await websocket.close()
+        session_counters["requests"] += 1
+        task = asyncio.ensure_future(self.analyze(request_id, request))
+        self.tasks[request_id] = task
+        task.add_done_callback(lambda done: self.tasks.pop(request_id, None))
+
+    async def analyze(self, request_id, request):
+        # A session without a user_id gets one that is kept for all of its requests
+        if request.user_id is not None:
+            user_id = request.user_id
+        else:
+            if self.user_id is None:
+                self.user_id = str(uuid.uuid4())
+            user_id = self.user_id
+
+        async def send(message):
+            await self.send({"request_id": request_id, **message})
 
-        # Step 5: Save the full response to the database
-        analysis_result = AnalysisResult(
-            user_id=user_id,
-            model_name=request.model_name,
-            text=request.text,
-            contextualize=request.contextualize,
-            result=json.dumps(analysis_results)
-        )
-        repo.create(analysis_result)
+        async with self.semaphore:
+            with logfire.span("session request_id={request_id} model_name={model_name} contextualize={contextualize}",
+                              request_id=request_id,
+                              model_name=request.model_name,
+                              contextualize=request.contextualize):
+                try:
+                    analysis_results = await stream_analysis(request, user_id, send)
+                except Exception as e:
+                    logging.error(f"An unexpected error occurred in session request {request_id}: {e}", exc_info=True)
+                    await self.send_error(f"An unexpected error occurred: {e}", request_id)
+                    return
+
+                await send({
+                    "type": "analysis_complete",
+                    "user_id": user_id,
+                    "status": "success" if analysis_results is not None else "error"
+                })
+                if analysis_results is not None:
+                    await save_analysis(request, user_id, analysis_results)
+
+
+async def analyze_batch_item(job: BatchJob, text: str):
+    """
+    Runs the analysis of one article of a batch job. Returns the analysis results, or raises if the detection failed.
+    """
+    request = Request(user_id=job.user_id, model_name=job.model_name, text=text,
+                      contextualize=parse_contextualize(job.contextualize))
+    errors = []
+
+    async def collect_errors(message):
+        if message["status"] == "error":
+            errors.append(message["message"])
+
+    # Batch articles wait behind the articles of interactive clients
+    with priority(PRIORITY_BACKGROUND):
+        analysis_results = await run_analysis(request, collect_errors)
+    if analysis_results is None:
+        raise RuntimeError(errors[0] if errors else "Propaganda detection failed")
+    return analysis_results
+
+
+batch_worker = BatchWorker(analyze_batch_item)
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "llm_registry": registry_stats(),
+        "http_pools": http_pool.pool_stats(),
+        "caches": cache_stats(),
+        "analysis_in_flight": {**analysis_counters, "in_flight": len(in_flight_analyses)},
+        "sessions": {**session_counters, "open": session_counters["opened"] - session_counters["closed"]},
+        "contextualization_in_flight": context_flight.stats(),
+        "context_engines": engine_stats(),
+        "google_search": search_stats(),
+        "page_fetcher": page_stats(),
+        "budgets": budget_counters,
+        "llm_scheduler": scheduler.stats(),
+        "analysis_writer": analysis_writer.stats(),
+        "batch_worker": batch_worker.stats(),
+    }
+
+
+def encode_cursor(analysis_result) -> str:
+    position = [analysis_result.created_at.isoformat(), analysis_result.id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/users/{user_id}/analyses")
+def user_analyses(user_id: str,
+                  limit: int = Query(20, ge=1, le=100),
+                  cursor: Optional[str] = None,
+                  technique: Optional[str] = None,
+                  repo: Repo = Depends(dependencies.repo)):
+    """
+    Returns a user's analysis history, newest first. Pass next_cursor as cursor to get the next page.
+    """
+    before = decode_cursor(cursor) if cursor else None
+    results = repo.find_user_analysis_results(user_id, limit, before=before, technique=technique)
+    return {
+        "items": [result.to_dict() for result in results],
+        "next_cursor": encode_cursor(results[-1]) if len(results) == limit else None,
+    }
+
+
+@app.get("/export/analyses", dependencies=[Depends(dependencies.export_access)])
+def export_analyses(start: Optional[datetime] = None,
+                    end: Optional[datetime] = None,
+                    model_name: Optional[str] = None,
+                    user_id: Optional[str] = None,
+                    format: Literal["ndjson", "gzip"] = "ndjson"):
+    """
+    Streams the stored analyses matching the filters as NDJSON, optionally gzipped, in constant memory.
+    Only available with EXPORT_API_ENABLED and the admin token, see dependencies.export_access.
+    """
+    compress = format == "gzip"
+    chunks = export_analysis_results(compress=compress, start=start, end=end,
+                                     model_name=model_name, user_id=user_id)
+    filename = "analyses.ndjson.gz" if compress else "analyses.ndjson"
+    return StreamingResponse(chunks,
+                             media_type="application/gzip" if compress else "application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.post("/batch/jobs")
+async def create_batch_job(batch_request: BatchRequest, repo: Repo = Depends(dependencies.repo)):
+    """
+    Queues the articles of a batch for analysis and returns the id of the job.
+    """
+    if not batch_request.texts:
+        raise HTTPException(status_code=400, detail="No texts given")
+    if len(batch_request.texts) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch may hold at most {BATCH_MAX_ITEMS} texts")
+
+    job = BatchJob(user_id=batch_request.user_id,
+                   model_name=batch_request.model_name,
+                   contextualize=format_contextualize(batch_request.contextualize),
+                   total_items=len(batch_request.texts))
+    await asyncio.to_thread(repo.create_batch_job, job, batch_request.texts)
+    batch_worker.notify()
+    logging.info(f"Created batch job {job.id} with {job.total_items} texts")
+    return {"job_id": job.id, "total_items": job.total_items}
+
+
+def find_batch_job_or_404(repo: Repo, job_id: str) -> BatchJob:
+    job = repo.find_batch_job(job_id)
+    if job is None or job.is_deleted:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job
+
+
+@app.get("/batch/jobs/{job_id}")
+def batch_job(job_id: str, repo: Repo = Depends(dependencies.repo)):
+    """
+    Returns a batch job with the number of its items per status.
+    """
+    job = find_batch_job_or_404(repo, job_id)
+    counts = repo.count_batch_items(job_id)
+    progress = {status: counts.get(status, 0) for status in ("pending", "running", "done", "error")}
+    finished = progress["done"] + progress["error"]
+    return {
+        **job.to_dict(),
+        "progress": progress,
+        "finished_items": finished,
+        "progress_ratio": finished / job.total_items if job.total_items else 1.0,
+    }
+
+
+@app.get("/batch/jobs/{job_id}/results")
+def batch_job_results(job_id: str,
+                      after: int = Query(-1, ge=-1),
+                      limit: int = Query(100, ge=1, le=1000),
+                      repo: Repo = Depends(dependencies.repo)):
+    """
+    Returns the finished items of a batch job in submission order. Pass next_after as after to get the next page.
+    """
+    find_batch_job_or_404(repo, job_id)
+    items = repo.find_batch_results(job_id, limit, after=after)
+    return {
+        "items": items,
+        "next_after": items[-1]["position"] if len(items) == limit else None,
+    }
+
+
+@app.get("/batch/jobs/{job_id}/results/stream")
+def stream_batch_job_results(job_id: str, repo: Repo = Depends(dependencies.repo)):
+    """
+    Streams all finished items of a batch job as NDJSON, in submission order.
+    """
+    find_batch_job_or_404(repo, job_id)
+    return StreamingResponse(ndjson_chunks(iter_batch_results(job_id)), media_type="application/x-ndjson")
 
 
 @app.websocket("/ws/analyze_propaganda")
-async def websocket_endpoint(websocket: WebSocket,
-                             repo: Repo = Depends(dependencies.repo)):
+async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     logging.info("WebSocket connection accepted")
     try:
         data = await websocket.receive_text()
-        await handle_request(data, websocket, repo)
+        await handle_request(data, websocket)
     except WebSocketDisconnect:
         logging.info("Client disconnected")
     except Exception as e:
@@ -186,6 +832,23 @@ async def websocket_endpoint(websocket: WebSocket,
             await websocket.close()
 
 
+@app.websocket("/ws/session")
+async def session_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    logging.info("WebSocket session accepted")
+    session_counters["opened"] += 1
+    try:
+        await AnalysisSession(websocket).run()
+    except WebSocketDisconnect:
+        logging.info("Session client disconnected")
+    except Exception as e:
+        logging.error(f"An unexpected error occurred in a session: {e}", exc_info=True)
+        if websocket.client_state != WebSocketState.DISCONNECTED:
+            await websocket.close()
+    finally:
+        session_counters["closed"] += 1
+
+
 # Entry point for running the application
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
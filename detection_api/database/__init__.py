@@ -1,4 +1,8 @@
 # Import all the models, so that Base has them before being imported by Alembic
 
 from database.base import Base
-from database.models import AnalysisResult
\ No newline at end of file
+from database.models import AnalysisResult
+from database.models import CacheEntry
+from database.models import BatchJob
+from database.models import BatchItem
+from database.models import format_contextualize, parse_contextualize
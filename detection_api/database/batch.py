@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, Iterator, List
+
+from sqlalchemy import select, update, insert, func, or_, and_
+
+from database import AnalysisResult, BatchJob, BatchItem
+from database.base import create_uuid, now_utc
+from database.postgres import SessionLocal
+
+# Articles analyzed at the same time by the batch worker of one process
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# A claimed item is handed to another worker if its lease is not renewed in time, e.g. after a restart
+BATCH_LEASE_SECONDS = float(os.getenv("BATCH_LEASE_SECONDS", "300"))
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "2"))
+BATCH_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "3"))
+
+
+class BatchWorker:
+    """
+    Works through the items of the batch jobs with at most concurrency analyses at a time.
+
+    Items are claimed with SELECT ... FOR UPDATE SKIP LOCKED and a lease, so several processes can share the
+    queue without claiming the same item twice. The leases of running items are renewed while they are analyzed.
+    If a process dies, its items are claimed again once their leases expire, so interrupted jobs resume on
+    their own. An item's analysis result is stored in the same transaction that marks it done.
+
+    Every claim increments the item's attempts, which serves as a fencing token: a worker only writes an item
+    while it is still running with the attempt the worker claimed it with. A worker whose lease expired and whose
+    item was claimed again by another worker drops its result instead of storing a second one.
+
+    analyze(job, text) runs the analysis of one article and returns its results, or raises if it failed.
+    """
+
+    def __init__(self, analyze: Callable[[BatchJob, str], Awaitable[dict]], session_factory=SessionLocal,
+                 concurrency=BATCH_CONCURRENCY, lease_seconds=BATCH_LEASE_SECONDS,
+                 poll_interval=BATCH_POLL_INTERVAL, max_attempts=BATCH_MAX_ATTEMPTS):
+        self.analyze = analyze
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.task = None
+        self.wakeup = None
+        self.active: Dict[str, asyncio.Task] = {}
+        self.attempts: Dict[str, int] = {}  # The attempt each active item was claimed with
+        self.storing = set()  # Items whose analysis is done and whose result is being written
+        self.leases_renewed_at = 0.0
+        self.counters = {"claimed": 0, "done": 0, "retried": 0, "failed": 0, "jobs_completed": 0, "lease_lost": 0}
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self._run())
+
+    def notify(self):
+        """Look for new items right away instead of at the next poll, e.g. after a job was created."""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                if loop.time() - self.leases_renewed_at > self.lease_seconds / 3:
+                    await asyncio.to_thread(self._renew_leases, dict(self.attempts))
+                    self.leases_renewed_at = loop.time()
+                free = self.concurrency - len(self.active)
+                if free > 0:
+                    for job, item_id, attempt, text in await asyncio.to_thread(self._claim, free):
+                        task = asyncio.ensure_future(self._process(job, item_id, attempt, text))
+                        self.active[item_id] = task
+                        self.attempts[item_id] = attempt
+                        task.add_done_callback(lambda done, item_id=item_id: self._forget(item_id))
+            except Exception as e:
+                logging.error(f"Batch worker failed to poll the queue: {e}", exc_info=True)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _forget(self, item_id):
+        self.active.pop(item_id, None)
+        self.attempts.pop(item_id, None)
+        self.storing.discard(item_id)
+        self.wakeup.set()
+
+    def _claim(self, limit) -> List[tuple]:
+        now = now_utc()
+        with self.session_factory() as db:
+            claimable = (
+                select(BatchItem.id)
+                .where(or_(BatchItem.status == "pending",
+                           and_(BatchItem.status == "running", BatchItem.lease_expires_at < now)))
+                .order_by(BatchItem.created_at, BatchItem.job_id, BatchItem.position)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+            item_ids = db.execute(
+                update(BatchItem)
+                .where(BatchItem.id.in_(claimable.scalar_subquery()))
+                .values(status="running",
+                        attempts=BatchItem.attempts + 1,
+                        lease_expires_at=now + timedelta(seconds=self.lease_seconds))
+                .returning(BatchItem.id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            db.commit()
+            if not item_ids:
+                return []
+
+            rows = db.execute(
+                select(BatchJob, BatchItem.id, BatchItem.attempts, BatchItem.text)
+                .join(BatchItem, BatchItem.job_id == BatchJob.id)
+                .where(BatchItem.id.in_(item_ids))
+            ).all()
+            db.expunge_all()
+        self.counters["claimed"] += len(rows)
+        return [tuple(row) for row in rows]
+
+    @staticmethod
+    def _owned(item_attempts: Dict[str, int]):
+        """Condition matching the given items only while they run with the attempts they were claimed with."""
+        return and_(BatchItem.status == "running",
+                    or_(*[and_(BatchItem.id == item_id, BatchItem.attempts == attempt)
+                          for item_id, attempt in item_attempts.items()]))
+
+    def _renew_leases(self, item_attempts: Dict[str, int]):
+        if not item_attempts:
+            return
+        with self.session_factory() as db:
+            db.execute(
+                update(BatchItem)
+                .where(self._owned(item_attempts))
+                .values(lease_expires_at=now_utc() + timedelta(seconds=self.lease_seconds))
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+
+    async def _process(self, job: BatchJob, item_id: str, attempt: int, text: str):
+        try:
+            results = await self.analyze(job, text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Batch item {item_id} of job {job.id} failed: {e}")
+            await self._finish(self._fail, job, item_id, attempt, str(e))
+            return
+        await self._finish(self._complete, job, item_id, attempt, text, results)
+
+    async def _finish(self, write, job, item_id, *args):
+        self.storing.add(item_id)
+        try:
+            await asyncio.to_thread(write, job, item_id, *args)
+        except Exception as e:
+            # The item keeps its lease and is claimed again once it expires
+            logging.error(f"Failed to store batch item of job {job.id}: {e}", exc_info=True)
+
+    def _take_over(self, db, job: BatchJob, item_id: str, attempt: int, **values) -> bool:
+        """
+        Update an item this worker still owns. Returns False, rolling back, if its lease was lost to another worker.
+        """
+        owned = db.execute(
+            update(BatchItem)
+            .where(BatchItem.id == item_id, self._owned({item_id: attempt}))
+            .values(lease_expires_at=None, **values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if owned == 1:
+            return True
+        db.rollback()
+        self.counters["lease_lost"] += 1
+        logging.warning(f"Dropped the result of batch item {item_id} of job {job.id}, its lease was lost")
+        return False
+
+    def _complete(self, job: BatchJob, item_id: str, attempt: int, text: str, results: dict):
+        with self.session_factory() as db:
+            if not self._take_over(db, job, item_id, attempt, status="done", error=None):
+                return
+            analysis_result_id = create_uuid()
+            db.execute(insert(AnalysisResult).values(
+                id=analysis_result_id,
+                user_id=job.user_id or job.id,
+                model_name=job.model_name,
+                text=text,
+                contextualize=job.contextualize,
+                result=results,
+            ))
+            db.execute(
+                update(BatchItem)
+                .where(BatchItem.id == item_id)
+                .values(analysis_result_id=analysis_result_id)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            self.counters["done"] += 1
+            self._complete_job(db, job)
+
+    def _fail(self, job: BatchJob, item_id: str, attempt: int, error: str):
+        status = "pending" if attempt < self.max_attempts else "error"
+        with self.session_factory() as db:
+            if not self._take_over(db, job, item_id, attempt, status=status, error=error):
+                return
+            db.commit()
+            if status == "pending":
+                self.counters["retried"] += 1
+            else:
+                self.counters["failed"] += 1
+                self._complete_job(db, job)
+
+    def _complete_job(self, db, job: BatchJob):
+        unfinished = db.execute(
+            select(func.count())
+            .where(BatchItem.job_id == job.id, BatchItem.status.in_(["pending", "running"]))
+        ).scalar()
+        if unfinished:
+            return
+        db.execute(
+            update(BatchJob)
+            .where(BatchJob.id == job.id, BatchJob.status != "completed")
+            .values(status="completed", finished_at=now_utc())
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        self.counters["jobs_completed"] += 1
+        logging.info(f"Batch job {job.id} completed")
+
+    def _release(self, item_attempts: Dict[str, int]):
+        with self.session_factory() as db:
+            db.execute(
+                update(BatchItem)
+                .where(self._owned(item_attempts))
+                .values(status="pending",
+                        attempts=BatchItem.attempts - 1,
+                        lease_expires_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+
+    async def stop(self):
+        """
+        Stop claiming items and hand the running ones back to the queue, so they are picked up right away
+        by the next worker. Called on application shutdown.
+        """
+        if self.task is None:
+            return
+        self.task.cancel()
+        # Items that are being stored are left to finish, the others are interrupted
+        tasks = list(self.active.values())
+        released = {item_id: attempt for item_id, attempt in self.attempts.items() if item_id not in self.storing}
+        for item_id in released:
+            self.active[item_id].cancel()
+        await asyncio.gather(self.task, *tasks, return_exceptions=True)
+        self.task = None
+        if released:
+            try:
+                await asyncio.to_thread(self._release, released)
+            except Exception as e:
+                logging.warning(f"Failed to release batch items, they are claimed again once their leases expire: {e}")
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "running": len(self.active),
+            "concurrency": self.concurrency,
+        }
+
+
+def iter_batch_results(job_id: str, session_factory=SessionLocal, batch_size: int = 100) -> Iterator[dict]:
+    """
+    Yield the finished items of a batch job with their analysis results, in submission order,
+    streamed through a server-side cursor.
+    """
+    stmt = (
+        select(BatchItem.position, BatchItem.status, BatchItem.error,
+               BatchItem.analysis_result_id, AnalysisResult.result)
+        .outerjoin(AnalysisResult, AnalysisResult.id == BatchItem.analysis_result_id)
+        .where(BatchItem.job_id == job_id, BatchItem.status.in_(["done", "error"]))
+        .order_by(BatchItem.position)
+        .execution_options(yield_per=batch_size)
+    )
+    with session_factory() as db:
+        for row in db.execute(stmt):
+            yield dict(row._mapping)
@@ -0,0 +1,63 @@
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import select, delete, or_
+from sqlalchemy.dialects.postgresql import insert
+
+from database import CacheEntry
+from database.base import now_utc
+from database.postgres import SessionLocal
+from llm.cache_stores import CacheStore
+
+
+class PostgresCacheStore(CacheStore):
+    """
+    Persistent cache tier stored in the cache_entries table, an UNLOGGED table shared by all workers.
+    Its writes skip the write-ahead log, so its entries are lost when Postgres crashes, which a cache can afford.
+    """
+    name = "postgres"
+
+    def __init__(self, session_factory=SessionLocal, serializer=None):
+        super().__init__(serializer)
+        self.session_factory = session_factory
+
+    def get(self, namespace: str, key: str):
+        with self.session_factory() as db:
+            stmt = (
+                select(CacheEntry.value)
+                .where(CacheEntry.namespace == namespace,
+                       CacheEntry.key == key,
+                       or_(CacheEntry.expires_at.is_(None), CacheEntry.expires_at > now_utc()))
+            )
+            value = db.execute(stmt).scalar_one_or_none()
+        return self._loads(value)
+
+    def _write(self, namespace: str, key: str, data: bytes, ttl: Optional[float], max_entries: Optional[int]):
+        expires_at = now_utc() + timedelta(seconds=ttl) if ttl else None
+        stmt = insert(CacheEntry).values(namespace=namespace, key=key, value=data, expires_at=expires_at)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CacheEntry.namespace, CacheEntry.key],
+            set_={"value": stmt.excluded.value, "expires_at": stmt.excluded.expires_at, "created_at": now_utc()},
+        )
+        with self.session_factory() as db:
+            db.execute(stmt)
+            db.commit()
+
+    def prune(self, namespace: str, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Delete expired entries and, if max_entries is given, the oldest entries beyond it.
+        """
+        with self.session_factory() as db:
+            db.execute(
+                delete(CacheEntry)
+                .where(CacheEntry.namespace == namespace, CacheEntry.expires_at <= now_utc())
+            )
+            if max_entries:
+                oldest = (
+                    select(CacheEntry.id)
+                    .where(CacheEntry.namespace == namespace)
+                    .order_by(CacheEntry.created_at.desc())
+                    .offset(max_entries)
+                )
+                db.execute(delete(CacheEntry).where(CacheEntry.id.in_(oldest)))
+            db.commit()
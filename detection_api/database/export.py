@@ -0,0 +1,103 @@
+import argparse
+import json
+import sys
+import zlib
+from datetime import datetime
+from typing import Iterator, Optional
+
+from sqlalchemy import select
+
+from database import AnalysisResult
+from database.postgres import SessionLocal
+
+# Rows fetched per round trip from the server-side cursor
+EXPORT_BATCH_SIZE = 1000
+# Size of the chunks handed to the response or file
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def iter_analysis_results(db, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                          model_name: Optional[str] = None, user_id: Optional[str] = None,
+                          batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[dict]:
+    """
+    Yield analysis results as plain dicts, oldest first, streamed through a server-side cursor.
+
+    Only batch_size rows are held in memory at a time, independent of the size of the table.
+    """
+    stmt = select(*AnalysisResult.__table__.columns).where(AnalysisResult.is_deleted.is_(False))
+    if start is not None:
+        stmt = stmt.where(AnalysisResult.created_at >= start)
+    if end is not None:
+        stmt = stmt.where(AnalysisResult.created_at < end)
+    if model_name is not None:
+        stmt = stmt.where(AnalysisResult.model_name == model_name)
+    if user_id is not None:
+        stmt = stmt.where(AnalysisResult.user_id == user_id)
+    stmt = stmt.order_by(AnalysisResult.created_at).execution_options(yield_per=batch_size)
+
+    for row in db.execute(stmt):
+        yield dict(row._mapping)
+
+
+def ndjson_chunks(rows: Iterator[dict], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    """Serialize rows as newline-delimited JSON, grouped into chunks of about chunk_size bytes."""
+    buffer = []
+    buffered = 0
+    for row in rows:
+        line = (json.dumps(row, default=str) + "\n").encode("utf-8")
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= chunk_size:
+            yield b"".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Compress a stream of chunks into a single gzip stream."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_analysis_results(compress: bool = False, session_factory=SessionLocal, **filters) -> Iterator[bytes]:
+    """
+    Export the analysis results matching filters (see iter_analysis_results) as NDJSON, optionally gzipped.
+
+    The database session lives as long as the returned iterator, so the export can be streamed as a response.
+    """
+    with session_factory() as db:
+        chunks = ndjson_chunks(iter_analysis_results(db, **filters))
+        if compress:
+            chunks = gzip_chunks(chunks)
+        yield from chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export stored analysis results as NDJSON.")
+    parser.add_argument("--out", help="Output file, gzipped if it ends with .gz (default: stdout)")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the output")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="Only results created at or after this time")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="Only results created before this time")
+    parser.add_argument("--model-name", help="Only results of this model")
+    parser.add_argument("--user-id", help="Only results of this user")
+    args = parser.parse_args()
+
+    compress = args.gzip or (args.out or "").endswith(".gz")
+    chunks = export_analysis_results(compress=compress, start=args.start, end=args.end,
+                                     model_name=args.model_name, user_id=args.user_id)
+    out = open(args.out, "wb") if args.out else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
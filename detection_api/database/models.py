@@ -1,19 +1,41 @@
+from typing import Literal, Union
+
 from database.base import Base
-from sqlalchemy import Column, String, DateTime, Text, func
+from sqlalchemy import Column, String, DateTime, Text, Integer, ForeignKey, LargeBinary, func, UniqueConstraint, Index
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+def format_contextualize(value: Union[Literal["Auto"], bool]) -> str:
+    """
+    The contextualize option of a request as stored in the contextualize columns: "true", "false" or "Auto".
+    """
+    return str(value).lower() if isinstance(value, bool) else value
+
+
+def parse_contextualize(value: str) -> Union[Literal["Auto"], bool]:
+    # Batch jobs used to store "True" and "False"
+    return {"true": True, "false": False}.get(value.lower(), value)
 
 
 class AnalysisResult(Base):
     __tablename__ = 'analysis_results'
+    __table_args__ = (
+        Index('ix_analysis_results_user_id_created_at', 'user_id', 'created_at', 'id'),
+        Index('ix_analysis_results_created_at', 'created_at'),
+        Index('ix_analysis_results_result', 'result', postgresql_using='gin'),
+    )
 
     user_id = Column(String, primary_key=True)
     request_time = Column(DateTime(timezone=True), server_default=func.now())  # Current time
     model_name = Column(String)
     text = Column(Text)
     contextualize = Column(String)
-    result = Column(Text)  # Store the result as a JSON string
+    result = Column(JSONB)  # Techniques as keys, so they can be filtered through the GIN index
 
     def to_dict(self):
         return {
+            'id': self.id,
+            'created_at': self.created_at,
             'user_id': self.user_id,
             'request_time': self.request_time,
             'model_name': self.model_name,
@@ -21,3 +43,56 @@ class AnalysisResult(Base):
             'contextualize': self.contextualize,
             'result': self.result
         }
+
+
+class CacheEntry(Base):
+    __tablename__ = 'cache_entries'
+    __table_args__ = (
+        UniqueConstraint('namespace', 'key', name='uq_cache_entries_namespace_key'),
+        Index('ix_cache_entries_expires_at', 'expires_at'),
+    )
+
+    namespace = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    value = Column(LargeBinary, nullable=False)  # Serialized by the store's serializer, see llm/cache_stores.py
+    expires_at = Column(DateTime, nullable=True)
+
+
+class BatchJob(Base):
+    __tablename__ = 'batch_jobs'
+
+    user_id = Column(String)
+    model_name = Column(String, nullable=False)
+    contextualize = Column(String, nullable=False)
+    total_items = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default='queued')  # queued, completed
+    finished_at = Column(DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'created_at': self.created_at,
+            'user_id': self.user_id,
+            'model_name': self.model_name,
+            'contextualize': self.contextualize,
+            'total_items': self.total_items,
+            'status': self.status,
+            'finished_at': self.finished_at
+        }
+
+
+class BatchItem(Base):
+    __tablename__ = 'batch_items'
+    __table_args__ = (
+        UniqueConstraint('job_id', 'position', name='uq_batch_items_job_id_position'),
+        Index('ix_batch_items_status_lease_expires_at', 'status', 'lease_expires_at'),
+    )
+
+    job_id = Column(String, ForeignKey('batch_jobs.id', ondelete='CASCADE'), nullable=False)
+    position = Column(Integer, nullable=False)  # Index of the article in the submitted batch
+    text = Column(Text, nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending, running, done, error
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_expires_at = Column(DateTime, nullable=True)  # A running item whose lease expired is claimed again
+    analysis_result_id = Column(String, ForeignKey('analysis_results.id'), nullable=True)
+    error = Column(Text, nullable=True)
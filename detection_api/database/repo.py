@@ -1,7 +1,10 @@
-from sqlalchemy import select
+from sqlalchemy import select, insert, tuple_, func
 from sqlalchemy.orm import Session
 
-from database import AnalysisResult
+from database import AnalysisResult, BatchJob, BatchItem
+
+# Rows per INSERT when the items of a batch job are created
+BATCH_INSERT_SIZE = 1000
 
 
 class Repo:
@@ -35,3 +38,70 @@ class Repo:
         results = self.db.execute(stmt).all()
 
         return [result[0] for result in results]
+
+    def create_many(self, model, rows):
+        """Insert many rows of the given model with a single multi-row INSERT."""
+        if not rows:
+            return
+        self.db.execute(insert(model).values(rows))
+        self.db.commit()
+
+    def find_user_analysis_results(self, user_id, limit, before=None, technique=None):
+        """
+        Return one page of a user's analysis results, newest first.
+
+        Pages are addressed by keyset: before is the (created_at, id) of the last result of the previous page.
+        If technique is given, only results in which that technique was detected are returned.
+        """
+        stmt = (
+            select(AnalysisResult)
+            .where(AnalysisResult.user_id == user_id, AnalysisResult.is_deleted.is_(False))
+        )
+        if technique is not None:
+            stmt = stmt.where(AnalysisResult.result.has_key(technique))
+        if before is not None:
+            stmt = stmt.where(tuple_(AnalysisResult.created_at, AnalysisResult.id) < tuple_(*before))
+        stmt = stmt.order_by(AnalysisResult.created_at.desc(), AnalysisResult.id.desc()).limit(limit)
+
+        return list(self.db.execute(stmt).scalars())
+
+    def create_batch_job(self, job, texts):
+        """Create a batch job together with one pending item per text, in a single transaction."""
+        self.db.add(job)
+        self.db.flush()
+        for offset in range(0, len(texts), BATCH_INSERT_SIZE):
+            rows = [dict(job_id=job.id, position=position, text=text)
+                    for position, text in enumerate(texts[offset:offset + BATCH_INSERT_SIZE], start=offset)]
+            self.db.execute(insert(BatchItem), rows)
+        self.db.commit()
+        self.db.refresh(job)
+
+    def find_batch_job(self, job_id):
+        return self.db.get(BatchJob, job_id)
+
+    def count_batch_items(self, job_id):
+        """Return the number of items of a batch job per status."""
+        stmt = (
+            select(BatchItem.status, func.count())
+            .where(BatchItem.job_id == job_id)
+            .group_by(BatchItem.status)
+        )
+        return {status: count for status, count in self.db.execute(stmt).all()}
+
+    def find_batch_results(self, job_id, limit, after=-1):
+        """
+        Return one page of the finished items of a batch job with their analysis results, in submission order.
+
+        Pages are addressed by keyset: after is the position of the last item of the previous page.
+        """
+        stmt = (
+            select(BatchItem.position, BatchItem.status, BatchItem.error,
+                   BatchItem.analysis_result_id, AnalysisResult.result)
+            .outerjoin(AnalysisResult, AnalysisResult.id == BatchItem.analysis_result_id)
+            .where(BatchItem.job_id == job_id,
+                   BatchItem.status.in_(["done", "error"]),
+                   BatchItem.position > after)
+            .order_by(BatchItem.position)
+            .limit(limit)
+        )
+        return [dict(row._mapping) for row in self.db.execute(stmt)]
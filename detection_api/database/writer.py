@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import time
+
+from database.postgres import SessionLocal
+from database.repo import Repo
+
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "1000"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.5"))
+
+
+class WriteBehindQueue:
+    """
+    Bounded write-behind queue for inserts of one model.
+
+    Rows are queued without touching the database and written by a background task in multi-row
+    INSERTs of up to batch_size rows, off the event loop. When the queue is full, submit waits until
+    there is room again, which pushes back on the producers instead of buffering without limit.
+    """
+
+    def __init__(self, model, session_factory=SessionLocal, max_size=WRITE_QUEUE_SIZE,
+                 batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.model = model
+        self.session_factory = session_factory
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.task = None
+        self.counters = {"rows_written": 0, "rows_failed": 0, "batches": 0}
+        self.flush_latency_total = 0.0
+        self.flush_latency_max = 0.0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            if self.queue is None:
+                self.queue = asyncio.Queue(maxsize=self.max_size)
+            self.task = asyncio.ensure_future(self._run())
+
+    async def submit(self, row: dict):
+        """
+        Queue a row (a dict of column values) for insertion.
+        """
+        self.start()
+        await self.queue.put(row)
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    def _write(self, rows):
+        with self.session_factory() as db:
+            Repo(db).create_many(self.model, rows)
+
+    async def _flush(self, rows):
+        start = time.monotonic()
+        try:
+            await asyncio.to_thread(self._write, rows)
+            self.counters["rows_written"] += len(rows)
+        except Exception as e:
+            self.counters["rows_failed"] += len(rows)
+            logging.error(f"Failed to write {len(rows)} {self.model.__tablename__} rows: {e}", exc_info=True)
+        finally:
+            latency = time.monotonic() - start
+            self.counters["batches"] += 1
+            self.flush_latency_total += latency
+            self.flush_latency_max = max(self.flush_latency_max, latency)
+            for _ in rows:
+                self.queue.task_done()
+
+    async def stop(self):
+        """
+        Write everything that is still queued and stop the background task. Called on application shutdown.
+        """
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "queue_length": self.queue.qsize() if self.queue is not None else 0,
+            "queue_size": self.max_size,
+            "avg_flush_latency": self.flush_latency_total / self.counters["batches"] if self.counters["batches"] else 0.0,
+            "max_flush_latency": self.flush_latency_max,
+        }
@@ -1,11 +1,18 @@
-from typing import Generator
+import logging
+import os
+import secrets
+from typing import Generator, Optional
 
-from fastapi import Depends
+from fastapi import Depends, Header, HTTPException
 from sqlalchemy.orm import Session
 
 from database.postgres import SessionLocal
 from database.repo import Repo
 
+# The export API streams every user's analyses, so it is off unless enabled and protected by a token
+EXPORT_API_ENABLED = os.getenv("EXPORT_API_ENABLED", "false").lower() in ("1", "true", "yes")
+EXPORT_API_TOKEN = os.getenv("EXPORT_API_TOKEN", "")
+
 
 def get_db() -> Generator:
     db = SessionLocal()
@@ -17,3 +24,17 @@ def get_db() -> Generator:
 
 def repo(db: Session = Depends(get_db)) -> Repo:
     return Repo(db)
+
+
+def export_access(authorization: Optional[str] = Header(None)):
+    """
+    Admits requests to the export API that carry "Authorization: Bearer <EXPORT_API_TOKEN>".
+    The API does not exist unless EXPORT_API_ENABLED is set and a token is configured.
+    """
+    if not EXPORT_API_ENABLED or not EXPORT_API_TOKEN:
+        if EXPORT_API_ENABLED:
+            logging.warning("The export API is enabled but EXPORT_API_TOKEN is not set, so it stays disabled")
+        raise HTTPException(status_code=404, detail="Not Found")
+    expected = f"Bearer {EXPORT_API_TOKEN}".encode("utf-8")
+    if not secrets.compare_digest((authorization or "").encode("utf-8"), expected):
+        raise HTTPException(status_code=401, detail="Invalid export token", headers={"WWW-Authenticate": "Bearer"})
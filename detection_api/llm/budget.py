@@ -0,0 +1,290 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+# Upper bounds for a single request. 0 disables a bound. Clients may ask for lower ones.
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "300"))
+REQUEST_MAX_TOKENS = int(os.getenv("REQUEST_MAX_TOKENS", "400000"))
+REQUEST_MAX_SEARCHES = int(os.getenv("REQUEST_MAX_SEARCHES", "60"))
+# Entries of a request contextualized at the same time, so a budget that runs out skips the entries that did not
+# start yet instead of stopping all of them half done. 0 disables the limit.
+REQUEST_ENTRY_CONCURRENCY = int(os.getenv("REQUEST_ENTRY_CONCURRENCY", "8"))
+
+# Status of an entry that was not contextualized because the budget of its request ran out
+SKIPPED_BUDGET = "skipped (budget)"
+
+budget_counters = {"requests": 0, "deadline": 0, "tokens": 0, "searches": 0, "skipped_entries": 0}
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised by a pipeline stage that would go over the budget of its request.
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request budget exceeded: {reason}")
+        self.reason = reason
+
+
+def _limit(requested, maximum):
+    """The lower of a client's requested limit and the server's maximum, where 0 or None mean no limit."""
+    limits = [value for value in (requested, maximum) if value]
+    return min(limits) if limits else None
+
+
+class RequestBudget:
+    """
+    Wall time, LLM tokens and search calls that one request may use across all of its pipeline stages.
+    """
+
+    def __init__(self, deadline_seconds: Optional[float] = None, max_tokens: Optional[int] = None,
+                 max_searches: Optional[int] = None, entry_concurrency: Optional[int] = None):
+        self.deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+        self.max_tokens = max_tokens
+        self.max_searches = max_searches
+        self.entry_concurrency = entry_concurrency
+        self.tokens = 0
+        self.searches = 0
+        self.exceeded = None
+        self._entry_slots = None
+
+    @classmethod
+    def for_request(cls, deadline_seconds=None, max_tokens=None, max_searches=None) -> "RequestBudget":
+        """Budget for a request that asked for the given limits, capped by the server's maximums."""
+        budget_counters["requests"] += 1
+        return cls(deadline_seconds=_limit(deadline_seconds, REQUEST_DEADLINE_SECONDS),
+                   max_tokens=_limit(max_tokens, REQUEST_MAX_TOKENS),
+                   max_searches=_limit(max_searches, REQUEST_MAX_SEARCHES),
+                   entry_concurrency=REQUEST_ENTRY_CONCURRENCY or None)
+
+    def entry_slots(self) -> asyncio.Semaphore:
+        # Created on first use, so it belongs to the running event loop
+        if self._entry_slots is None:
+            self._entry_slots = asyncio.Semaphore(self.entry_concurrency)
+        return self._entry_slots
+
+    def remaining_time(self) -> Optional[float]:
+        """Seconds until the deadline, or None without a deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def _record(self, reason: str):
+        if self.exceeded is None:
+            self.exceeded = reason
+            budget_counters[reason] += 1
+
+    def exceed(self, reason: str):
+        """Record that the budget ran out for the given reason and raise BudgetExceeded."""
+        self._record(reason)
+        raise BudgetExceeded(reason)
+
+    def check(self):
+        """Raise BudgetExceeded if any part of the budget is used up."""
+        if self.exceeded is not None:
+            raise BudgetExceeded(self.exceeded)
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.exceed("deadline")
+        if self.max_tokens is not None and self.tokens >= self.max_tokens:
+            self.exceed("tokens")
+        if self.max_searches is not None and self.searches >= self.max_searches:
+            self.exceed("searches")
+
+    def charge_tokens(self, tokens: int):
+        """Charge an LLM call of an estimated size, or raise BudgetExceeded if it does not fit anymore."""
+        self.check()
+        if self.max_tokens is not None and self.tokens + tokens > self.max_tokens:
+            self.exceed("tokens")
+        self.tokens += tokens
+
+    def correct_tokens(self, estimated: int, actual: int):
+        """Replace the estimate of a finished call by its actual usage."""
+        self.tokens += actual - estimated
+
+    def charge_search(self):
+        """Charge one search API call, or raise BudgetExceeded if none is left."""
+        self.check()
+        self.searches += 1
+
+    def absorb(self, tokens: int, searches: int):
+        """
+        Charge calls that were made before this request joined a shared computation, as far as they fit.
+        The budget is used up if they do not, but nothing is raised, as the calls were made anyway.
+        """
+        if self.max_tokens is not None and self.tokens + tokens >= self.max_tokens:
+            tokens = max(0, self.max_tokens - self.tokens)
+            self._record("tokens")
+        if self.max_searches is not None and self.searches + searches >= self.max_searches:
+            searches = max(0, self.max_searches - self.searches)
+            self._record("searches")
+        self.tokens += tokens
+        self.searches += searches
+
+    def stats(self) -> dict:
+        return {
+            "remaining_time": self.remaining_time(),
+            "tokens": self.tokens,
+            "max_tokens": self.max_tokens,
+            "searches": self.searches,
+            "max_searches": self.max_searches,
+            "exceeded": self.exceeded,
+        }
+
+
+# Budget of the request the current task works for
+request_budget: ContextVar[Optional[RequestBudget]] = ContextVar("request_budget", default=None)
+
+
+@contextmanager
+def budget(value: Optional[RequestBudget]):
+    """
+    Charge the LLM and search calls made inside the block (and in tasks started from it) to the given budget.
+    """
+    token = request_budget.set(value)
+    try:
+        yield value
+    finally:
+        request_budget.reset(token)
+
+
+def current_budget() -> Optional[RequestBudget]:
+    return request_budget.get()
+
+
+@asynccontextmanager
+async def entry_slot(value: Optional[RequestBudget]):
+    """
+    Wait until the request may contextualize another entry, see REQUEST_ENTRY_CONCURRENCY.
+    Raises BudgetExceeded if its budget ran out in the meantime.
+    """
+    if value is None:
+        yield
+    elif value.entry_concurrency is None:
+        value.check()
+        yield
+    else:
+        async with value.entry_slots():
+            value.check()
+            yield
+
+
+class SharedBudget:
+    """
+    Budget of a computation that several requests wait for, see shared_run.
+
+    Each call it makes is charged, as it is made, to every waiting request that can still afford it, and refused
+    once none of them can. So the computation costs each request at most its own limits. A request that ran out
+    keeps waiting, and gets the result if the others pay for the rest of it.
+    """
+    # Every request waits for the computation within its own deadline
+    deadline = None
+
+    def __init__(self):
+        self.budgets: List[RequestBudget] = []
+        self.unlimited = 0  # Waiting requests without a budget
+        self.tokens = 0
+        self.searches = 0
+        self.finished = False
+
+    def join(self, request_budget: Optional[RequestBudget]):
+        if request_budget is None:
+            self.unlimited += 1
+            return
+        if request_budget not in self.budgets:
+            request_budget.absorb(self.tokens, self.searches)
+        # Once per waiting entry, but each request pays once
+        self.budgets.append(request_budget)
+
+    def leave(self, request_budget: Optional[RequestBudget]):
+        if request_budget is None:
+            self.unlimited -= 1
+        elif request_budget in self.budgets:
+            self.budgets.remove(request_budget)
+
+    def waiting(self) -> bool:
+        return bool(self.unlimited or self.budgets)
+
+    def remaining_time(self) -> Optional[float]:
+        return None
+
+    def _paying(self) -> List[RequestBudget]:
+        return list(dict.fromkeys(self.budgets))
+
+    def _charge(self, charge):
+        paying = self._paying()
+        reasons = []
+        for request_budget in paying:
+            try:
+                charge(request_budget)
+            except BudgetExceeded as e:
+                reasons.append(e.reason)
+        if not self.unlimited and len(reasons) == len(paying):
+            raise BudgetExceeded(reasons[0] if reasons else "deadline")
+
+    def check(self):
+        self._charge(RequestBudget.check)
+
+    def charge_tokens(self, tokens: int):
+        self._charge(lambda request_budget: request_budget.charge_tokens(tokens))
+        self.tokens += tokens
+
+    def correct_tokens(self, estimated: int, actual: int):
+        # Goes to the requests that are still paying, which the estimate was charged to
+        for request_budget in self._paying():
+            if request_budget.exceeded is None:
+                request_budget.correct_tokens(estimated, actual)
+        self.tokens += actual - estimated
+
+    def charge_search(self):
+        self._charge(RequestBudget.charge_search)
+        self.searches += 1
+
+
+# Shared computations that are running, by key, see shared_run
+_shared_budgets: Dict[Any, SharedBudget] = {}
+
+
+async def shared_run(flight, key, func):
+    """
+    Await func() through the SingleFlight flight, sharing it with the other requests for key. Its calls are charged
+    to the budgets of the waiting requests while it runs, see SharedBudget.
+    """
+    shared = _shared_budgets.get(key)
+    if shared is None or shared.finished:
+        shared = _shared_budgets[key] = SharedBudget()
+    request_budget = current_budget()
+    shared.join(request_budget)
+
+    async def run():
+        try:
+            with budget(shared):
+                return await func()
+        finally:
+            shared.finished = True
+
+    try:
+        return await flight.do(key, run)
+    finally:
+        shared.leave(request_budget)
+        if not shared.waiting() and _shared_budgets.get(key) is shared:
+            del _shared_budgets[key]
+
+
+async def within_deadline(awaitable, request_budget: Optional[RequestBudget] = None):
+    """
+    Await awaitable, cancelling it and raising BudgetExceeded if the deadline of the request passes first.
+    """
+    request_budget = request_budget or current_budget()
+    if request_budget is None or request_budget.deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, request_budget.remaining_time())
+    except asyncio.TimeoutError:
+        request_budget.exceed("deadline")
@@ -0,0 +1,298 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import argparse
+import copy
+import io
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import llm.ressources.prompts as prompts
+from llm import http_pool
+from llm.cache import content_key, normalize_text
+from llm.chunking import split_text, merge_detections
+from llm.propaganda_detection import (OpenAITextClassificationPropagandaInference, detection_cache, PROMPT_VERSION,
+                                      RANDOM_SEED, ARTICLE_CHUNK_SIZE, ARTICLE_CHUNK_OVERLAP)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Requests per submitted batch file, below the provider's limit of 50,000
+BULK_MAX_REQUESTS = int(os.getenv("BULK_MAX_REQUESTS", "20000"))
+BULK_POLL_INTERVAL = float(os.getenv("BULK_POLL_INTERVAL", "60"))
+
+# Batch states after which the provider does not change a batch anymore
+FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def build_batch_request(custom_id: str, model_name: str, text: str) -> dict:
+    """
+    Build one line of a batch file: the same SYSTEM_PROMPT + article call that detect_explain makes.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model_name,
+            "temperature": 0,
+            "seed": RANDOM_SEED,
+            "response_format": {"type": "json_object"},
+            "messages": [
+                {"role": "system", "content": prompts.SYSTEM_PROMPT},
+                {"role": "user", "content": text},
+            ],
+        },
+    }
+
+
+def parse_batch_output(line: dict) -> dict:
+    """
+    Return the detections of one line of a batch output file, or raise if the request failed.
+    """
+    if line.get("error"):
+        raise ValueError(line["error"].get("message", str(line["error"])))
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        raise ValueError(f"Request failed with status {response.get('status_code')}: {response.get('body')}")
+    return json.loads(response["body"]["choices"][0]["message"]["content"])
+
+
+class OpenAIBatchProvider:
+    """
+    Runs batch files through the OpenAI Batch API, which is billed at a discount and has its own rate limits.
+    """
+
+    def __init__(self, client=None):
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(http_client=http_pool.get_sync_client("openai"))
+        self.client = client
+
+    def submit(self, lines: List[dict]) -> str:
+        content = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+        input_file = self.client.files.create(file=("detection_batch.jsonl", io.BytesIO(content)), purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id,
+                                           endpoint=BATCH_ENDPOINT,
+                                           completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id: str) -> Iterable[dict]:
+        batch = self.client.batches.retrieve(batch_id)
+        # Successful requests are in the output file, failed ones in the error file
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+class LocalBatchProvider:
+    """
+    Stand-in for OpenAIBatchProvider that runs batch files in this process, for tests and local runs.
+
+    complete(body) returns the message content for the body of one request. The default finds no propaganda.
+    A batch is reported as in progress on the first status check and completed from the second on.
+    """
+
+    def __init__(self, complete: Optional[Callable[[dict], str]] = None):
+        self.complete = complete or (lambda body: "{}")
+        self.batches: Dict[str, dict] = {}
+
+    def submit(self, lines: List[dict]) -> str:
+        batch_id = f"local_batch_{len(self.batches)}"
+        self.batches[batch_id] = {"lines": list(lines), "checks": 0}
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        batch = self.batches[batch_id]
+        batch["checks"] += 1
+        return "in_progress" if batch["checks"] == 1 else "completed"
+
+    def download(self, batch_id: str) -> Iterable[dict]:
+        for line in self.batches[batch_id]["lines"]:
+            try:
+                content = self.complete(line["body"])
+                response = {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}}
+                yield {"custom_id": line["custom_id"], "response": response, "error": None}
+            except Exception as e:
+                yield {"custom_id": line["custom_id"], "response": None, "error": {"message": str(e)}}
+
+
+class BulkDetection:
+    """
+    Detects propaganda in many articles through a provider batch endpoint instead of one call per article.
+
+    Articles are split into chunks like in analyze_article, and every chunk becomes one request of a batch file.
+    Articles whose detection is already cached are not submitted, and new detections are added to the cache.
+    """
+
+    def __init__(self, model_name: str, provider, poll_interval: float = BULK_POLL_INTERVAL,
+                 max_requests: int = BULK_MAX_REQUESTS):
+        self.model_name = model_name
+        self.provider = provider
+        self.poll_interval = poll_interval
+        self.max_requests = max_requests
+        self.inference = OpenAITextClassificationPropagandaInference(model_name=model_name)
+
+    def _cache_key(self, text: str) -> str:
+        return content_key(normalize_text(text), self.model_name, PROMPT_VERSION)
+
+    @staticmethod
+    def split(text: str) -> List[Tuple[str, int]]:
+        """The chunks an article is analyzed in, like in analyze_article, as returned by split_text."""
+        return split_text(text, ARTICLE_CHUNK_SIZE, ARTICLE_CHUNK_OVERLAP) if len(text) > ARTICLE_CHUNK_SIZE \
+            else [(text, 0)]
+
+    def find_duplicates(self, texts: List[str]) -> Dict[int, int]:
+        """Map the index of every repeated text to the index of its first copy, which is the only one submitted."""
+        first_copies = {}
+        duplicates = {}
+        for index, text in enumerate(texts):
+            first = first_copies.setdefault(self._cache_key(text), index)
+            if first != index:
+                duplicates[index] = first
+        return duplicates
+
+    def build_requests(self, texts: List[str], skipped: Set[int]) -> List[dict]:
+        requests = []
+        for index, text in enumerate(texts):
+            if index in skipped:
+                continue
+            chunks = self.split(text)
+            for chunk_index, (chunk, _) in enumerate(chunks):
+                requests.append(build_batch_request(f"{index}:{chunk_index}:{len(chunks)}", self.model_name, chunk))
+        return requests
+
+    def wait(self, batch_ids: List[str]):
+        pending = list(batch_ids)
+        while pending:
+            for batch_id in list(pending):
+                status = self.provider.status(batch_id)
+                if status in FINAL_STATES:
+                    logging.info(f"Batch {batch_id} finished with status {status}")
+                    pending.remove(batch_id)
+            if pending:
+                logging.info(f"Waiting for {len(pending)} batches")
+                time.sleep(self.poll_interval)
+
+    def collect(self, texts: List[str], batch_ids: List[str], results: Dict[int, dict],
+                skipped: Set[int]) -> Dict[int, dict]:
+        """
+        Map the outputs of the given batches back to their articles through format_output.
+        """
+        chunk_outputs: Dict[int, Dict[int, dict]] = {}
+        chunk_counts: Dict[int, int] = {}
+        errors: Dict[int, str] = {}
+        for batch_id in batch_ids:
+            for line in self.provider.download(batch_id):
+                index, chunk_index, chunk_count = (int(part) for part in line["custom_id"].split(":"))
+                chunk_counts[index] = chunk_count
+                try:
+                    chunk_outputs.setdefault(index, {})[chunk_index] = \
+                        self.inference.format_output(parse_batch_output(line))
+                except Exception as e:
+                    errors[index] = str(e)
+
+        for index, text in enumerate(texts):
+            if index in skipped:
+                continue
+            outputs = chunk_outputs.get(index, {})
+            if index in errors or len(outputs) < chunk_counts.get(index, 1):
+                results[index] = {"status": "error", "error": errors.get(index, "No output for this article")}
+                continue
+            detections = merge_detections([outputs[chunk] for chunk in sorted(outputs)], self.split(text)) \
+                if len(outputs) > 1 else outputs[0]
+            detection_cache.set(self._cache_key(text), detections)
+            results[index] = {**detections, "status": "success"}
+        return results
+
+    def run(self, texts: List[str], batch_ids: Optional[List[str]] = None) -> List[dict]:
+        """
+        Detect propaganda in every article and return one result per article, in order. Results have the shape
+        of analyze_article's: the detections with status "success", or status "error" and the error.
+
+        Pass the batch_ids of an earlier run with the same texts to collect its results instead of submitting again.
+        """
+        results: Dict[int, dict] = {}
+        for index, text in enumerate(texts):
+            cached = detection_cache.get(self._cache_key(text))
+            if cached is not None:
+                results[index] = {**cached, "status": "success"}
+        logging.info(f"{len(results)} of {len(texts)} articles served from cache")
+        duplicates = self.find_duplicates(texts)
+        skipped = set(results) | set(duplicates)
+
+        if batch_ids is None:
+            requests = self.build_requests(texts, skipped)
+            batch_ids = [self.provider.submit(requests[start:start + self.max_requests])
+                         for start in range(0, len(requests), self.max_requests)]
+            logging.info(f"Submitted {len(requests)} requests in batches {batch_ids}")
+        self.wait(batch_ids)
+        self.collect(texts, batch_ids, results, skipped)
+        for index, first in duplicates.items():
+            results.setdefault(index, copy.deepcopy(results[first]))
+        return [results[index] for index in range(len(texts))]
+
+
+def store_results(articles: List[dict], results: List[dict], model_name: str, session_factory=None):
+    """
+    Save the successful results to analysis_results, the same way the websocket endpoint does.
+    """
+    from database import AnalysisResult, format_contextualize
+    from database.base import create_uuid
+    from database.postgres import SessionLocal
+    from database.repo import Repo
+
+    rows = []
+    for article, result in zip(articles, results):
+        if result["status"] != "success":
+            continue
+        result = {technique: entries for technique, entries in result.items() if technique != "status"}
+        rows.append(dict(user_id=article.get("user_id") or create_uuid(),
+                         model_name=model_name,
+                         text=article["text"],
+                         contextualize=format_contextualize(False),
+                         result=result))
+    with (session_factory or SessionLocal)() as db:
+        repo = Repo(db)
+        for start in range(0, len(rows), 1000):
+            repo.create_many(AnalysisResult, rows[start:start + 1000])
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect propaganda in many articles through a provider batch endpoint.")
+    parser.add_argument("input", help="NDJSON file with one {\"text\": ..., \"user_id\": ...} object per line")
+    parser.add_argument("--model-name", default="gpt-4o")
+    parser.add_argument("--batch-id", action="append", help="Collect an earlier run's batch instead of submitting")
+    parser.add_argument("--local", action="store_true", help="Use the local stand-in provider")
+    parser.add_argument("--poll-interval", type=float, default=BULK_POLL_INTERVAL)
+    parser.add_argument("--out", help="Also write the results as NDJSON to this file")
+    parser.add_argument("--no-store", action="store_true", help="Do not save the results to the database")
+    args = parser.parse_args()
+
+    with open(args.input, encoding="utf-8") as f:
+        articles = [json.loads(line) for line in f if line.strip()]
+    provider = LocalBatchProvider() if args.local else OpenAIBatchProvider()
+    bulk = BulkDetection(args.model_name, provider, poll_interval=args.poll_interval)
+    results = bulk.run([article["text"] for article in articles], batch_ids=args.batch_id)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    stored = 0 if args.no_store else store_results(articles, results, args.model_name)
+    failed = sum(1 for result in results if result["status"] != "success")
+    print(f"{len(results)} articles analyzed, {failed} failed, {stored} results stored")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
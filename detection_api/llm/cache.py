@@ -0,0 +1,255 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import asyncio
+import copy
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+CACHE_PERSISTENT = os.getenv("CACHE_PERSISTENT", "true").lower() in ("1", "true", "yes")
+
+# The persistent store shared by every cache of this process, see get_default_store
+_default_store = None
+_default_store_lock = threading.Lock()
+
+# Every cache created in this process, so their counters can be reported together
+_caches: Dict[str, "TieredCache"] = {}
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text before hashing, so that trivially different copies of the same article share a key.
+    """
+    text = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def content_key(*parts) -> str:
+    """
+    Build a stable cache key from the given parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache with an optional time-to-live per entry.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_default_store():
+    """
+    Return the persistent cache store of CACHE_BACKEND (see llm/cache_stores.py), which the worker processes share,
+    or None when persistence is disabled or no backend is configured.
+    """
+    global _default_store
+    if not CACHE_PERSISTENT:
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            from llm.cache_stores import CACHE_BACKEND, create_store
+            _default_store = create_store(CACHE_BACKEND) or False
+    return _default_store or None
+
+
+class TieredCache:
+    """
+    Two-tier cache: an in-memory LRU in front of an optional persistent store.
+
+    Values must be JSON serializable. They are copied on the way in and out, so callers
+    may mutate what they get back without corrupting the cache.
+    """
+
+    def __init__(self, namespace: str, max_size: int = 1024, ttl: Optional[float] = None,
+                 store=None, store_max_entries: Optional[int] = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.store = store
+        self.store_max_entries = store_max_entries
+        self.counters = {"memory_hits": 0, "store_hits": 0, "misses": 0, "sets": 0, "store_errors": 0}
+        _caches[namespace] = self
+
+    def _store_get(self, key):
+        if self.store is None:
+            return None
+        try:
+            return self.store.get(self.namespace, key)
+        except Exception as e:
+            self.counters["store_errors"] += 1
+            logging.warning(f"Cache store lookup failed for {self.namespace}: {e}")
+            return None
+
+    def _store_set(self, key, value):
+        if self.store is None:
+            return
+        try:
+            self.store.set(self.namespace, key, value, ttl=self.ttl, max_entries=self.store_max_entries)
+        except Exception as e:
+            self.counters["store_errors"] += 1
+            logging.warning(f"Cache store write failed for {self.namespace}: {e}")
+
+    def _memory_get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.counters["memory_hits"] += 1
+            return copy.deepcopy(value)
+        return None
+
+    def _record_store_result(self, key, value):
+        if value is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["store_hits"] += 1
+        self.memory.set(key, value)
+        return copy.deepcopy(value)
+
+    def get(self, key) -> Optional[Any]:
+        value = self._memory_get(key)
+        if value is not None:
+            return value
+        return self._record_store_result(key, self._store_get(key))
+
+    def set(self, key, value):
+        value = copy.deepcopy(value)
+        self.counters["sets"] += 1
+        self.memory.set(key, value)
+        self._store_set(key, value)
+
+    async def aget(self, key) -> Optional[Any]:
+        """
+        Like get, but queries the persistent store off the event loop.
+        """
+        value = self._memory_get(key)
+        if value is not None:
+            return value
+        if self.store is None:
+            return self._record_store_result(key, None)
+        return self._record_store_result(key, await asyncio.to_thread(self._store_get, key))
+
+    async def aset(self, key, value):
+        """
+        Like set, but writes to the persistent store off the event loop.
+        """
+        value = copy.deepcopy(value)
+        self.counters["sets"] += 1
+        self.memory.set(key, value)
+        if self.store is not None:
+            await asyncio.to_thread(self._store_set, key, value)
+
+    def stats(self) -> dict:
+        lookups = self.counters["memory_hits"] + self.counters["store_hits"] + self.counters["misses"]
+        hits = lookups - self.counters["misses"]
+        return {
+            **self.counters,
+            "hits": hits,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "memory_size": len(self.memory),
+            "persistent": self.store is not None,
+            "store": self.store.name if self.store is not None else None,
+        }
+
+
+def cache_stats() -> dict:
+    """
+    Return the counters of every cache in this process.
+    """
+    return {namespace: cache.stats() for namespace, cache in _caches.items()}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single running computation.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Any, asyncio.Future] = {}
+        self._waiters: Dict[asyncio.Future, int] = {}
+        self.counters = {"started": 0, "joined": 0, "cancelled": 0}
+
+    async def do(self, key, func):
+        """
+        Await ``func()`` unless a call for ``key`` is already running, in which case await that one instead.
+
+        The shared computation is shielded, so a cancelled caller does not cancel it for the others.
+        It is cancelled once all of its callers are.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.counters["started"] += 1
+        else:
+            self.counters["joined"] += 1
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1 and not task.done():
+                task.cancel()
+                self.counters["cancelled"] += 1
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+        return copy.deepcopy(result)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {**self.counters, "in_flight": len(self._inflight)}
@@ -0,0 +1,288 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+# How many writes to a namespace happen between two eviction passes
+PRUNE_EVERY = 100
+
+# Persistent tier shared by the workers: "postgres", "sqlite", "redis" or "none".
+# Defaults to "postgres" when POSTGRES_URL is set.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "postgres" if os.getenv("POSTGRES_URL") else "none").lower()
+CACHE_SERIALIZER = os.getenv("CACHE_SERIALIZER", "json").lower()
+# A file on a volume all workers of the host can write to
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "/tmp/apollolytics_cache.sqlite3")
+# Any server speaking the Redis protocol (Redis, Valkey, KeyDB...). "local" uses LocalRedis, for tests and local runs.
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_REDIS_PREFIX = os.getenv("CACHE_REDIS_PREFIX", "apollolytics:cache:")
+
+
+class JSONSerializer:
+    name = "json"
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class CompressedJSONSerializer(JSONSerializer):
+    """
+    zlib-compressed JSON, for contextualizations and pages that carry retrieved texts. Reads plain JSON as well,
+    so the serializer can be switched without clearing the store.
+    """
+    name = "json+zlib"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def dumps(self, value) -> bytes:
+        return zlib.compress(super().dumps(value), self.level)
+
+    def loads(self, data: bytes):
+        data = bytes(data)
+        if data[:1] == b"\x78":  # zlib header; JSON never starts with "x"
+            data = zlib.decompress(data)
+        return super().loads(data)
+
+
+SERIALIZERS = {
+    "json": JSONSerializer,
+    "json+zlib": CompressedJSONSerializer,
+}
+
+
+def get_serializer(name: str = CACHE_SERIALIZER):
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown cache serializer: {name}, expected one of {sorted(SERIALIZERS)}")
+    return SERIALIZERS[name]()
+
+
+class CacheStore(abc.ABC):
+    """
+    Base of the persistent cache tiers. A store keeps serialized values per namespace and key with an optional
+    time-to-live, and evicts expired entries and the oldest entries beyond a namespace's max_entries every
+    PRUNE_EVERY writes to that namespace.
+
+    Subclasses implement get, _write and prune, a store missing one of them cannot be instantiated.
+    """
+    name = "store"
+
+    def __init__(self, serializer=None):
+        self.serializer = serializer or get_serializer()
+        self._writes: Dict[str, int] = {}
+
+    @abc.abstractmethod
+    def get(self, namespace: str, key: str):
+        ...
+
+    @abc.abstractmethod
+    def _write(self, namespace: str, key: str, data: bytes, ttl: Optional[float], max_entries: Optional[int]):
+        ...
+
+    @abc.abstractmethod
+    def prune(self, namespace: str, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        ...
+
+    def set(self, namespace: str, key: str, value, ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        self._write(namespace, key, self.serializer.dumps(value), ttl, max_entries)
+        self._writes[namespace] = self._writes.get(namespace, 0) + 1
+        if self._writes[namespace] % PRUNE_EVERY == 0:
+            self.prune(namespace, max_entries, ttl)
+
+    def _loads(self, data):
+        return self.serializer.loads(data) if data is not None else None
+
+
+class SQLiteCacheStore(CacheStore):
+    """
+    Persistent cache tier in a SQLite file shared by the worker processes of a host.
+
+    The file is opened in WAL mode, so readers do not block the writer. Each thread of each process has its own
+    connection, as connections must not be shared across the fork of a preloaded app.
+    """
+    name = "sqlite"
+
+    def __init__(self, path: str = CACHE_SQLITE_PATH, serializer=None):
+        super().__init__(serializer)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS cache_entries ("
+                       "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+                       "expires_at REAL, created_at REAL NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+            db.execute("CREATE INDEX IF NOT EXISTS ix_cache_entries_namespace_created_at "
+                       "ON cache_entries (namespace, created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def get(self, namespace: str, key: str):
+        row = self._connect().execute(
+            "SELECT value FROM cache_entries WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time())
+        ).fetchone()
+        return self._loads(row[0] if row else None)
+
+    def _write(self, namespace: str, key: str, data: bytes, ttl: Optional[float], max_entries: Optional[int]):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO cache_entries (namespace, key, value, expires_at, created_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET "
+                "value = excluded.value, expires_at = excluded.expires_at, created_at = excluded.created_at",
+                (namespace, key, sqlite3.Binary(data), now + ttl if ttl else None, now)
+            )
+
+    def prune(self, namespace: str, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        with self._connect() as db:
+            db.execute("DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?", (namespace, time.time()))
+            if max_entries:
+                db.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+                    "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (namespace, namespace, max_entries)
+                )
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the few Redis commands RedisCacheStore uses, for tests and local runs.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, tuple] = {}
+        self._sorted_sets: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._values.get(name)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._values[name]
+                return None
+            return value
+
+    def set(self, name, value, px=None):
+        with self._lock:
+            self._values[name] = (bytes(value), time.time() + px / 1000 if px else None)
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum((self._values.pop(name, None) or self._sorted_sets.pop(name, None)) is not None
+                       for name in names)
+
+    def zadd(self, name, mapping):
+        with self._lock:
+            self._sorted_sets.setdefault(name, {}).update(mapping)
+
+    def zcard(self, name):
+        with self._lock:
+            return len(self._sorted_sets.get(name, {}))
+
+    def zrange(self, name, start, end):
+        with self._lock:
+            members = sorted(self._sorted_sets.get(name, {}).items(), key=lambda item: item[1])
+            end = len(members) if end == -1 else end + 1
+            return [member.encode("utf-8") for member, _ in members[start:end]]
+
+    def zrem(self, name, *members):
+        with self._lock:
+            sorted_set = self._sorted_sets.get(name, {})
+            for member in members:
+                sorted_set.pop(member.decode("utf-8") if isinstance(member, bytes) else member, None)
+
+    def zremrangebyscore(self, name, min, max):
+        with self._lock:
+            sorted_set = self._sorted_sets.get(name, {})
+            for member, score in list(sorted_set.items()):
+                if float(min) <= score <= float(max):
+                    del sorted_set[member]
+
+
+class RedisCacheStore(CacheStore):
+    """
+    Persistent cache tier in a Redis-protocol server shared by the workers.
+
+    Entries expire through Redis' own TTLs. A namespace with max_entries keeps a sorted set of its keys by write
+    time, which prune uses to evict the oldest entries beyond it once the keys that have expired are dropped.
+    """
+    name = "redis"
+
+    def __init__(self, client=None, url: str = CACHE_REDIS_URL, prefix: str = CACHE_REDIS_PREFIX, serializer=None):
+        super().__init__(serializer)
+        if client is None:
+            if url == "local":
+                client = LocalRedis()
+            else:
+                # Imported here, as the redis client is only needed with this backend
+                import redis
+                client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    def _index(self, namespace: str) -> str:
+        return f"{self.prefix}{namespace}:__keys__"
+
+    def get(self, namespace: str, key: str):
+        return self._loads(self.client.get(self._key(namespace, key)))
+
+    def _write(self, namespace: str, key: str, data: bytes, ttl: Optional[float], max_entries: Optional[int]):
+        self.client.set(self._key(namespace, key), data, px=int(ttl * 1000) if ttl else None)
+        if max_entries:
+            self.client.zadd(self._index(namespace), {key: time.time()})
+
+    def prune(self, namespace: str, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        index = self._index(namespace)
+        if not max_entries:
+            # Without a limit there is nothing to evict, and no index to keep
+            self.client.delete(index)
+            return
+        if ttl:
+            # Keys written before then have expired in Redis already
+            self.client.zremrangebyscore(index, "-inf", time.time() - ttl)
+        excess = self.client.zcard(index) - max_entries
+        if excess > 0:
+            oldest = self.client.zrange(index, 0, excess - 1)
+            self.client.delete(*[self._key(namespace, key.decode("utf-8")) for key in oldest])
+            self.client.zrem(index, *oldest)
+
+
+def create_store(backend: str = CACHE_BACKEND, serializer=None):
+    """
+    Create the persistent cache store of a backend, or return None for "none".
+    """
+    serializer = serializer or get_serializer()
+    if backend == "none":
+        return None
+    if backend == "postgres":
+        from database.cache_store import PostgresCacheStore
+        return PostgresCacheStore(serializer=serializer)
+    if backend == "sqlite":
+        return SQLiteCacheStore(serializer=serializer)
+    if backend == "redis":
+        return RedisCacheStore(serializer=serializer)
+    raise ValueError(f"Unknown cache backend: {backend}, expected postgres, sqlite, redis or none")
@@ -0,0 +1,129 @@
+import re
+from typing import List, Tuple
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def _split_units(text: str, max_chars: int) -> List[Tuple[str, bool]]:
+    """Split text into sentences, each flagged with whether it starts a new paragraph."""
+    units = []
+    for paragraph in _PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        first = True
+        for sentence in _SENTENCE_END.split(paragraph):
+            # A single sentence longer than a chunk has to be cut hard
+            for start in range(0, len(sentence), max_chars):
+                units.append((sentence[start:start + max_chars], first))
+                first = False
+    return units
+
+
+def _join_units(units: List[Tuple[str, bool]]) -> str:
+    text = ""
+    for index, (sentence, starts_paragraph) in enumerate(units):
+        if index:
+            text += "\n\n" if starts_paragraph else " "
+        text += sentence
+    return text
+
+
+def split_text(text: str, max_chars: int, overlap: int = 0) -> List[Tuple[str, int]]:
+    """
+    Split text into chunks of at most max_chars characters on paragraph and sentence boundaries.
+
+    Consecutive chunks share up to overlap characters of whole sentences, so that passages on a
+    chunk border are seen in full by at least one chunk. Each chunk is returned with the length of
+    its start that it shares with the previous chunk.
+    """
+    chunks = []
+    current = []
+    current_length = 0
+    shared = 0
+
+    for unit in _split_units(text, max_chars):
+        sentence = unit[0]
+        if current and current_length + len(sentence) + 2 > max_chars:
+            chunks.append((_join_units(current), shared))
+            # Carry the trailing sentences of the previous chunk over as overlap
+            carried = []
+            carried_length = 0
+            for previous in reversed(current):
+                if carried_length + len(previous[0]) > overlap \
+                        or carried_length + len(previous[0]) + len(sentence) + 4 > max_chars:
+                    break
+                carried.insert(0, previous)
+                carried_length += len(previous[0]) + 2
+            current, current_length = carried, carried_length
+            shared = len(_join_units(carried))
+        current.append(unit)
+        current_length += len(sentence) + 2
+
+    if current:
+        chunks.append((_join_units(current), shared))
+    return chunks
+
+
+def _normalize_location(location: str) -> str:
+    return re.sub(r"\s+", " ", location).strip().lower()
+
+
+def _overlap_passage(location: str, other: str, overlap: str) -> str:
+    """
+    The passage two locations share if they are the same passage seen by both chunks of an overlap: the shorter
+    location, if the longer one contains it and it lies in the overlap. Empty otherwise.
+    """
+    if not location or not other:
+        return ""
+    shorter, longer = sorted((location, other), key=len)
+    return shorter if shorter in longer and shorter in overlap else ""
+
+
+def merge_detections(chunk_detections: List[dict], chunks: List[Tuple[str, int]]) -> dict:
+    """
+    Merge formatted per-chunk detections into one dictionary, chunk by chunk.
+
+    An occurrence is dropped as a duplicate only if the previous chunk reported the same passage within the text
+    the two chunks share: the locations are equal or one contains the other, and the shorter one lies in the
+    overlap. The longer location is kept. A passage is merged at most as often as it occurs in the overlap, and
+    each occurrence of the previous chunk absorbs at most one duplicate, so a passage the article repeats is kept
+    once per repetition. Occurrences within one chunk are never merged.
+
+    :param chunk_detections: The formatted detections of every chunk, in order.
+    :param chunks: The chunks with the length of the text each shares with the previous one, as returned by
+        split_text.
+    """
+    merged = {}
+    previous_entries = {}  # Index in merged of the previous chunk's occurrences, per technique
+    for chunk_index, detections in enumerate(chunk_detections):
+        chunk, shared = chunks[chunk_index]
+        overlap = _normalize_location(chunk[:shared])
+        current_entries = {}
+        for technique, entries in detections.items():
+            technique_entries = merged.setdefault(technique, [])
+            candidates = list(previous_entries.get(technique, [])) if overlap else []
+            merges = {}  # How often each passage of the overlap was merged
+            indexes = current_entries.setdefault(technique, [])
+            for entry in entries:
+                location = _normalize_location(entry.get("location", ""))
+                match = None
+                for index in candidates:
+                    existing_location = _normalize_location(technique_entries[index].get("location", ""))
+                    passage = _overlap_passage(location, existing_location, overlap)
+                    if passage and merges.get(passage, 0) < overlap.count(passage):
+                        match = index
+                        merges[passage] = merges.get(passage, 0) + 1
+                        break
+                if match is None:
+                    technique_entries.append(entry)
+                    indexes.append(len(technique_entries) - 1)
+                    continue
+                candidates.remove(match)
+                if len(location) > len(_normalize_location(technique_entries[match].get("location", ""))):
+                    technique_entries[match] = entry
+                # The occurrence now stands for this chunk too, so the next chunk can match it in its overlap
+                indexes.append(match)
+        previous_entries = current_entries
+    return merged
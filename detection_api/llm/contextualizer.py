@@ -2,16 +2,25 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import asyncio
+import json
 import logging
 import os
+import re
 import time
-import pandas as pd
-from langchain import hub
-from langchain.agents import Tool
-from langchain.agents import create_react_agent, AgentExecutor
+from functools import lru_cache
+from typing import List, Literal
+
+from langchain_core.prompts import PromptTemplate
 from langchain_core.tools import BaseTool
+from pydantic import BaseModel, Field
+from llm.cache import TieredCache, SingleFlight, content_key, normalize_text, get_default_store
+import llm.ressources.prompts as prompts
+from llm.budget import BudgetExceeded, shared_run, within_deadline
 from llm.load_llm import load_llm
+from llm.scheduler import priority, PRIORITY_BACKGROUND
 
+from llm.domain_filter import DomainSet
 from llm.google_retriever import InformationRetrieval
 
 # Load environment variables, including API keys for Google and OpenAI.
@@ -19,10 +28,36 @@ from llm.google_retriever import InformationRetrieval
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID", "default_cse_id")
 GOOGLE_APIKEY = os.getenv("GOOGLE_API_KEY", "default_api_key")
 
-# Load excluded URLs from a CSV file
-fake = pd.read_csv("llm/ressources/mediabiasfactcheck_fakenews.csv")
-fake = fake[fake["Traffic/Popularity"] != "Minimal Traffic"]
-excluded_sites = fake["source_link"].apply(lambda x: x.split("//")[-1].split("www.")[-1].split("/")[0])
+# Load excluded URLs, precomputed from mediabiasfactcheck_fakenews.csv by llm/ressources/build_excluded_domains.py
+EXCLUDED_DOMAINS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ressources", "excluded_domains.json")
+with open(EXCLUDED_DOMAINS_PATH) as f:
+    _excluded = json.load(f)
+excluded_sites = _excluded["excluded_sites"]
+
+# Search results from excluded sites are dropped locally; only the top-ranked ones stay in the query itself.
+# query_excluded_sites ranks the high-traffic sites, least factual first, see rank_query_exclusions.
+excluded_domains = DomainSet(excluded_sites)
+SEARCH_QUERY_EXCLUSIONS = int(os.getenv("SEARCH_QUERY_EXCLUSIONS", "10"))
+query_excluded_sites = _excluded["query_excluded_sites"][:SEARCH_QUERY_EXCLUSIONS]
+
+# Finished contextualizations are reused until they are older than CONTEXT_CACHE_TTL seconds
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", str(24 * 3600)))
+context_cache = TieredCache("contextualization",
+                            max_size=int(os.getenv("CONTEXT_CACHE_SIZE", "4096")),
+                            ttl=CONTEXT_CACHE_TTL,
+                            store=get_default_store(),
+                            store_max_entries=int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "100000")))
+# Concurrent requests for the same statement share one agent run
+context_flight = SingleFlight()
+
+# "agent" runs the ReAct agent, which searches and reasons in turns. "retrieve" makes one call to write the search
+# queries, runs them concurrently and makes one call to write the answer. Requests may choose either.
+CONTEXT_ENGINES = ("agent", "retrieve")
+CONTEXT_ENGINE = os.getenv("CONTEXT_ENGINE", "agent")
+# Search queries written by the retrieve engine per statement
+RETRIEVE_QUERIES = int(os.getenv("RETRIEVE_QUERIES", "3"))
+engine_counters = {engine: {"runs": 0, "errors": 0, "seconds": 0.0, "llm_calls": 0, "searches": 0}
+                   for engine in CONTEXT_ENGINES}
 
 
 def render_text_description(tools: list[BaseTool]) -> str:
@@ -51,68 +86,140 @@ def render_text_description(tools: list[BaseTool]) -> str:
 google_description = """Get previews of the top google search results to get more information about the statement. The function always returns the next 10 results and can be called multiple times. If initial results seem unrelated you may use quotation marks to search for an exact phrase. Use a minus sign to exclude a word from the search.  Use before:date and after:date to search for results within a specific time period. Do not google the entire statement verbatim."""
 
 
-def get_prompt(date, originator):
-    prompt = hub.pull("hwchase17/react")
-
-    prompt_template = """You are an expert contextualizer tasked to expanding and enriching understanding around potentially misleading statements to make sure users are safe and well informed.
-Your role is to provide balanced, accurate, concise, and helpful context about a given statement.
-
-You have access to the following tools for your research:
-<tools>
-{tools}
-</tools>
-
-You may use each tool up to three times.
-
-Use the following format:
-
-Question: the input question you must answer
-Thought: you should always think about what to do
-Action: the action to take, should be one of [{tool_names}]
-Action Input: the input to the action
-Observation: the result of the action
-... (this Thought/Action/Action Input/Observation can repeat 3 times)
-Thought: I now have sufficient information to provide context for the user.
-Final Answer: The context demanded by the user.
-
-**Final Response Format:**
-- **Context:** (Provide a precise, concise, and factual summary of the topic, incorporating context from the sources)
-- **Warning:** (Explain potential risks of misinformation precisely, including how the statement might be misleading and what important context it might be missing)
-- **Sources:** (List all important sources by their reference numbers, e.g., [1], [2], [3])
-
-**Example Final Answer in case no results are found:**
-Context: No relevant information found.
-Warning: The statement may not be widely discussed or may not have been indexed by search engines.
-Sources: None
-
-**Example Final Answer:**  
-Context: Electric vehicles (EVs) produce fewer greenhouse gas emissions over their lifetime compared to gasoline-powered cars, according to studies [1], [2]. EVs emit no tailpipe emissions and are more efficient in energy use. However, their production, particularly the manufacturing of batteries, involves significant environmental impact due to energy-intensive processes and raw material extraction [3].
-Warning: Statements claiming that EVs are "worse for the environment" may focus exclusively on production emissions, ignoring the substantial operational emissions savings during usage. Conversely, claims that EVs are "entirely green" may overlook the environmental impacts of mining lithium, cobalt, and other materials used in battery production.
-Sources: 
-- [1] EPA Report on Electric Vehicle Myths (2023-Aug)
-- [2] MIT Climate Portal Analysis (2024-Jan)
-- [3] Environmental Impact Study (2023-Dec)
-    
-Begin your analysis now!
-
-Question:
-Contextualise the statement: '{statement}'{originator_section}{date_section}
-Thought:{agent_scratchpad}"""
+@lru_cache(maxsize=None)
+def compile_prompt(has_date, has_originator, template=prompts.CONTEXTUALIZER_REACT_PROMPT):
+    """
+    Compiles a contextualizer prompt (the vendored ReAct prompt by default) for statements with or without
+    a date and an originator.
+    """
     date_section = ""
     originator_section = ""
-    if date:
+    if has_date:
         date_section = " on {date}"
-    if originator:
+    if has_originator:
         originator_section = " made by {originator}"
-    prompt_template = prompt_template.replace("{date_section}", date_section)
+    prompt_template = template.replace("{date_section}", date_section)
     prompt_template = prompt_template.replace("{originator_section}", originator_section)
+    return PromptTemplate.from_template(prompt_template)
 
-    prompt.template = prompt_template
-    return prompt
+
+def get_prompt(date, originator, template=prompts.CONTEXTUALIZER_REACT_PROMPT):
+    return compile_prompt(bool(date), bool(originator), template)
+
+
+def prompt_inputs(statement, date=None, originator=None, **inputs):
+    inputs["statement"] = statement
+    if date:
+        inputs["date"] = date
+    if originator:
+        inputs["originator"] = originator
+    return inputs
+
+
+def renumber_sources(final_answer, link_mapping):
+    """
+    Renumbers the references of an answer to 1, 2, 3... in the order of their search result numbers, keeping only
+    those that are cited, and links each one in the Sources section to its URL.
+
+    :param final_answer: The answer in the Context/Warning/Sources format.
+    :param link_mapping: The search result numbers and their URLs, see InformationRetrieval.get_link_mapping.
+    :return: The renumbered answer, or "No relevant information found." if it lists no sources.
+    """
+    sections = final_answer.split("Sources:")
+    if len(sections) != 2:
+        return final_answer
+    main_content, sources_section = sections
+    if len(sources_section) <= 10:
+        return "No relevant information found."
+
+    # Find all referenced numbers in the entire text
+    all_refs = set(int(num) for num in re.findall(r'\[(\d+)\]', final_answer))
+
+    # Create new mapping with sequential numbers, for used references only
+    new_mapping = {}
+    old_to_new = {}
+    new_index = 1
+    for old_num in sorted(all_refs):
+        if old_num in link_mapping:
+            old_to_new[old_num] = new_index
+            new_mapping[new_index] = link_mapping[old_num]
+            new_index += 1
+
+    # Replace numbers in main content
+    for old_num, new_num in old_to_new.items():
+        main_content = main_content.replace(f'[{old_num}]', f'[{new_num}]')
+        sources_section = sources_section.replace(f'[{old_num}]', f'[{new_num}]({new_mapping[new_num]})')
+
+    return main_content + "Sources:" + sources_section
+
+
+def new_search_tool():
+    return InformationRetrieval(cse_id=GOOGLE_CSE_ID,
+                                api_key=GOOGLE_APIKEY,
+                                excluded_sites=query_excluded_sites,
+                                excluded_domains=excluded_domains,
+                                num_results=10)
+
+
+def contextualization_output(final_answer, google_search_tool, engine):
+    return {
+        "output": final_answer,
+        "all_google_results": google_search_tool.all_results,
+        "all_queries": google_search_tool.all_queries,
+        "retrieved_links": google_search_tool.retrieved_links,
+        "retrieved_texts": google_search_tool.retrieved_texts,
+        "engine": engine,
+        "status": "success"
+    }
+
+
+def engine_stats() -> dict:
+    """
+    Return runs, errors, total seconds, LLM calls and search queries per contextualization engine,
+    to compare their latency and cost.
+    """
+    return {"default": CONTEXT_ENGINE, **engine_counters}
+
+
+FACT_LABEL_DESCRIPTION = ("Classify the given statement with an emphasis on identifying potential propaganda or disinformation. \n"
+                          "0: Opinions (e.g., 'Country X's leaders are the best in the world.', 'Only fools believe in climate change.')\n"
+                          "1: Statement Appears Factual or Misleadingly Factual (e.g., 'Country Y has the highest crime rate due to its immigration policies.', 'Recent studies show that vaccines are more harmful than previously thought.', '9/11 was an inside job.')\n"
+                          "Choose '0' or '1' based on whether the statement seems to be presenting a fact or an opinion, with an eye for potentially misleading information.")
+
+# Adjust the grading schema to include examples related to propaganda and disinformation.
+grading_schema = {
+    "properties": {
+        "fact_label": {
+            "type": "string",
+            "enum": ['0', '1'],
+            # '0' for opinions or statements not attempting to appear factual, '1' for statements that appear factual.
+            "description": FACT_LABEL_DESCRIPTION
+        },
+    },
+    "required": ["fact_label"],
+}
+
+# Maximum number of statements labeled by a single classify_factual call
+FACT_BATCH_SIZE = int(os.getenv("FACT_BATCH_SIZE", "20"))
+
+
+class FactLabel(BaseModel):
+    index: int = Field(description="The index of the statement in the numbered list")
+    fact_label: Literal['0', '1'] = Field(description=FACT_LABEL_DESCRIPTION)
+
+
+class FactLabels(BaseModel):
+    labels: List[FactLabel]
+
+
+class SearchQueries(BaseModel):
+    queries: List[str] = Field(description="The Google search queries, one per aspect of the statement")
 
 
 class Contextualizer:
-    def __init__(self, model_name, cse_id=GOOGLE_CSE_ID, api_key=GOOGLE_APIKEY):
+    def __init__(self, model_name, cse_id=GOOGLE_CSE_ID, api_key=GOOGLE_APIKEY, engine=CONTEXT_ENGINE):
+        self.model_name = model_name
+        self.engine = engine
         self.llm = load_llm(model_name,
                             max_tokens=4096,
                             temperature=0,
@@ -130,31 +237,58 @@ class Contextualizer:
         """
         try:
             from langchain.chains import create_tagging_chain
-            # Adjust the grading schema to include examples related to propaganda and disinformation.
-            grading_schema = {
-                "properties": {
-                    "fact_label": {
-                        "type": "string",
-                        "enum": ['0', '1'],
-                        # '0' for opinions or statements not attempting to appear factual, '1' for statements that appear factual.
-                        "description": "Classify the given statement with an emphasis on identifying potential propaganda or disinformation. \n"
-                                       "0: Opinions (e.g., 'Country X's leaders are the best in the world.', 'Only fools believe in climate change.')\n"
-                                       "1: Statement Appears Factual or Misleadingly Factual (e.g., 'Country Y has the highest crime rate due to its immigration policies.', 'Recent studies show that vaccines are more harmful than previously thought.', '9/11 was an inside job.')\n"
-                                       "Choose '0' or '1' based on whether the statement seems to be presenting a fact or an opinion, with an eye for potentially misleading information."
-                    },
-                },
-                "required": ["fact_label"],
-            }
 
             # Classify the statement with a focus on its appearance as factual or opinionated, considering propaganda and disinformation.
-            output_grading = create_tagging_chain(grading_schema, self.llm).run(statement)
+            with priority(PRIORITY_BACKGROUND):
+                output = await create_tagging_chain(grading_schema, self.llm).ainvoke({"input": statement})
+            output_grading = output["text"]
 
             # Interpret the classification result as a boolean value: True for '1' (Seems Factual or Misleadingly Factual) and False for '0' (Opinion or Clearly Biased).
             return output_grading["fact_label"] == '1'
+        except BudgetExceeded:
+            raise
         except Exception as e:
             logging.error(f"Failed to classify statement: {statement} - {str(e)}")
             return False
 
+    async def classify_factual(self, statements, batch_size=FACT_BATCH_SIZE):
+        """
+        Batched version of seems_factual: labels many statements with one LLM call per batch of batch_size statements.
+        Batches run concurrently. Statements the model leaves unlabeled fall back to seems_factual.
+
+        :param statements: The statements to classify.
+        :param batch_size: The maximum number of statements per LLM call.
+        :return: A list of booleans, True where the statement seems factual, in the order of statements.
+        """
+        batches = [statements[i:i + batch_size] for i in range(0, len(statements), batch_size)]
+        with priority(PRIORITY_BACKGROUND):
+            results = await asyncio.gather(*[self._classify_batch(batch) for batch in batches])
+        return [label for batch_labels in results for label in batch_labels]
+
+    async def _classify_batch(self, statements):
+        labels = {}
+        try:
+            from langchain.schema import HumanMessage, SystemMessage
+            prompt = [
+                SystemMessage(content="Classify each of the following numbered statements. For every statement return "
+                                      "its index and a fact_label.\n" + FACT_LABEL_DESCRIPTION),
+                HumanMessage(content="\n".join(f"{index}: {statement}" for index, statement in enumerate(statements))),
+            ]
+            output = await self.llm.with_structured_output(FactLabels).ainvoke(prompt)
+            labels = {item.index: item.fact_label == '1' for item in output.labels
+                      if 0 <= item.index < len(statements)}
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            logging.error(f"Failed to classify batch of {len(statements)} statements - {str(e)}")
+
+        missing = [index for index in range(len(statements)) if index not in labels]
+        if missing:
+            logging.info(f"Falling back to single classification for {len(missing)} statements")
+            fallback = await asyncio.gather(*[self.seems_factual(statements[index]) for index in missing])
+            labels.update(zip(missing, fallback))
+        return [labels[index] for index in range(len(statements))]
+
     def identify_seemingly_factual(self, text):
         """
         Identifies factual information in a given text, with a focus on identifying statements that could be related to propaganda or disinformation.
@@ -176,7 +310,48 @@ class Contextualizer:
         results_lst = output.content.split("\n")
         return results_lst
 
-    async def process_statement(self, statement, date=None, originator=None):
+    async def process_statement(self, statement, date=None, originator=None, engine=None):
+        """
+        Returns the contextualization of a statement, reusing a cached or already running one if available.
+
+        Results are cached by normalized statement, date, originator, model and engine for CONTEXT_CACHE_TTL seconds.
+        Only successful contextualizations are cached.
+
+        :param statement: The statement to be processed and contextualized.
+        :param date: The date associated with the statement, if available.
+        :param originator: The originator of the statement, if available.
+        :param engine: The engine to contextualize with, one of CONTEXT_ENGINES. Defaults to the contextualizer's.
+        :return: A dictionary containing processed information, see run_agent.
+        """
+        engine = engine or self.engine
+        if engine not in CONTEXT_ENGINES:
+            raise ValueError(f"Unknown contextualization engine: {engine}")
+        cache_key = content_key(normalize_text(statement), date, originator, self.model_name, engine)
+        cached = await context_cache.aget(cache_key)
+        if cached is not None:
+            logging.info("Contextualization served from cache")
+            return cached
+
+        async def compute():
+            run = self.run_agent if engine == "agent" else self.run_retrieve
+            start_time = time.time()
+            try:
+                result = await run(statement, date=date, originator=originator)
+            finally:
+                engine_counters[engine]["runs"] += 1
+                engine_counters[engine]["seconds"] += time.time() - start_time
+            if result["status"] == "success":
+                await context_cache.aset(cache_key, result)
+            else:
+                engine_counters[engine]["errors"] += 1
+            return result
+
+        # Contextualization yields to interactive detection calls in the LLM scheduler. The run is shared by every
+        # request for the statement, so each of them waits for it within its own deadline and pays for its calls.
+        with priority(PRIORITY_BACKGROUND):
+            return await within_deadline(shared_run(context_flight, cache_key, compute))
+
+    async def run_agent(self, statement, date=None, originator=None):
         """
         Processes a given statement to perform contextualization, utilizing both Google Custom Search and a language model.
 
@@ -193,14 +368,16 @@ class Contextualizer:
         :return: A dictionary containing processed information, including search results and analysis from the language model.
         """
 
-        google_search_tool = InformationRetrieval(cse_id=GOOGLE_CSE_ID,
-                                                  api_key=GOOGLE_APIKEY,
-                                                  excluded_sites=excluded_sites,
-                                                  num_results=10)
+        # Imported here, as langchain.agents is slow to import and only needed once a statement is contextualized
+        from langchain.agents import Tool
+        from langchain.agents import create_react_agent, AgentExecutor
+
+        google_search_tool = new_search_tool()
 
         google_private = Tool(
             name='Google',
             func=google_search_tool.search,
+            coroutine=google_search_tool.asearch,
             description=google_description,
         )
 
@@ -217,63 +394,76 @@ class Contextualizer:
                                            verbose=False,
                                            return_intermediate_steps=True,
                                            max_iterations=5)
-            agent_executor_input = {"statement": statement}
-            if date:
-                agent_executor_input["date"] = date
             start_time = time.time()
-            result = await agent_executor.ainvoke(agent_executor_input)
-            final_answer = result["output"]
-
-            # Get the link mapping from the search tool
-            link_mapping = google_search_tool.get_link_mapping()
-
-            # Split the answer into sections
-            sections = final_answer.split("Sources:")
-            if len(sections) == 2:
-                main_content, sources_section = sections
-                if len(sources_section) > 10:
-                    # Find all referenced numbers in the entire text
-                    import re
-                    all_refs = set(int(num) for num in re.findall(r'\[(\d+)\]', final_answer))
-
-                    # Create new mapping with sequential numbers
-                    new_mapping = {}
-                    old_to_new = {}
-                    new_index = 1
-
-                    # First pass: create mapping for used references only
-                    for old_num in sorted(all_refs):
-                        if old_num in link_mapping:
-                            old_to_new[old_num] = new_index
-                            new_mapping[new_index] = link_mapping[old_num]
-                            new_index += 1
-
-                    # Replace numbers in main content
-                    for old_num, new_num in old_to_new.items():
-                        main_content = main_content.replace(f'[{old_num}]', f'[{new_num}]')
-                        sources_section = sources_section.replace(f'[{old_num}]',
-                                                                  f'[{new_num}]({new_mapping[new_num]})')
-
-                    # Reconstruct the final answer
-                    final_answer = main_content + "Sources:" + sources_section
-
-                    # Update link_mapping to only include used references with new numbers
-                    link_mapping = new_mapping
-                else:
-                    final_answer = "No relevant information found."
+            result = await agent_executor.ainvoke(prompt_inputs(statement, date, originator))
+            engine_counters["agent"]["llm_calls"] += len(result["intermediate_steps"]) + 1
+            engine_counters["agent"]["searches"] += len(google_search_tool.all_queries)
+            final_answer = renumber_sources(result["output"], google_search_tool.get_link_mapping())
 
             logging.info(f"contextualizer took {time.time() - start_time} seconds")
 
+            return contextualization_output(final_answer, google_search_tool, "agent")
+
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            logging.error(f"Failed Parsing: {statement} - {str(e)}", exc_info=True)
             return {
-                "output": final_answer,
-                "all_google_results": google_search_tool.all_results,
-                "all_queries": google_search_tool.all_queries,
-                "retrieved_links": google_search_tool.retrieved_links,
-                "retrieved_texts": google_search_tool.retrieved_texts,
-                # "link_mapping": link_mapping,  # Add the link mapping to the output
-                "status": "success"
+                "status": "error",
+                "error": str(e)
             }
 
+    async def generate_queries(self, statement, date=None, originator=None, num_queries=RETRIEVE_QUERIES):
+        """
+        Writes the search queries for a statement with a single LLM call.
+
+        :return: Up to num_queries queries, or the statement itself if none could be written.
+        """
+        prompt = get_prompt(date, originator, prompts.CONTEXTUALIZER_QUERY_PROMPT)
+        try:
+            output = await (prompt | self.llm.with_structured_output(SearchQueries)).ainvoke(
+                prompt_inputs(statement, date, originator, num_queries=num_queries))
+            queries = list(dict.fromkeys(query.strip() for query in output.queries if query.strip()))[:num_queries]
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            logging.error(f"Failed to write search queries: {statement} - {str(e)}")
+            queries = []
+        finally:
+            engine_counters["retrieve"]["llm_calls"] += 1
+        return queries or [statement]
+
+    async def run_retrieve(self, statement, date=None, originator=None):
+        """
+        Contextualizes a statement in a fixed number of steps instead of the agent's search loop: one LLM call writes
+        the search queries, the searches run concurrently, and one LLM call writes the answer from all of their
+        results. Returns the same output as run_agent.
+
+        :param statement: The statement to be processed and contextualized.
+        :param date: The date associated with the statement, if available.
+        :param originator: The originator of the statement, if available.
+        :return: A dictionary containing processed information, see run_agent.
+        """
+        google_search_tool = new_search_tool()
+        try:
+            start_time = time.time()
+            queries = await self.generate_queries(statement, date=date, originator=originator)
+            searches = await google_search_tool.asearch_many(queries)
+            engine_counters["retrieve"]["searches"] += len(searches)
+            search_results = "\n".join(f"Search: {query}\n{results}" for query, results in searches)
+
+            prompt = get_prompt(date, originator, prompts.CONTEXTUALIZER_SYNTHESIS_PROMPT)
+            engine_counters["retrieve"]["llm_calls"] += 1
+            output = await (prompt | self.llm).ainvoke(
+                prompt_inputs(statement, date, originator, search_results=search_results))
+            final_answer = renumber_sources(output.content, google_search_tool.get_link_mapping())
+
+            logging.info(f"contextualizer (retrieve) took {time.time() - start_time} seconds")
+
+            return contextualization_output(final_answer, google_search_tool, "retrieve")
+
+        except BudgetExceeded:
+            raise
         except Exception as e:
             logging.error(f"Failed Parsing: {statement} - {str(e)}", exc_info=True)
             return {
@@ -0,0 +1,29 @@
+from typing import Iterable
+
+
+def domain_of(url: str) -> str:
+    """
+    Return the host of a URL or bare domain, lowercased and without a leading "www.".
+    """
+    host = url.strip().lower().split("//")[-1].split("/")[0].split("?")[0].split("#")[0]
+    host = host.split("@")[-1].split(":")[0].rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    return host
+
+
+class DomainSet:
+    """
+    A set of domains that matches URLs on the domain itself and on any of its subdomains,
+    e.g. "example.com" matches "https://news.example.com/article".
+    """
+
+    def __init__(self, domains: Iterable[str]):
+        self.domains = frozenset(filter(None, (domain_of(domain) for domain in domains)))
+
+    def __contains__(self, url: str) -> bool:
+        labels = domain_of(url).split(".")
+        return any(".".join(labels[i:]) in self.domains for i in range(len(labels)))
+
+    def __len__(self):
+        return len(self.domains)
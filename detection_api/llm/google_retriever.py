@@ -1,9 +1,53 @@
+import asyncio
 import logging
+import os
+import math
 import re
-from typing import List, Dict, Tuple
+import threading
+from datetime import datetime
+from typing import List, Dict, Tuple, Optional
 
-import pandas as pd
-from googleapiclient.discovery import build
+from llm import http_pool
+from llm.budget import BudgetExceeded, current_budget
+from llm.cache import TieredCache, content_key, get_default_store
+from llm.domain_filter import DomainSet
+from llm.page_fetcher import PAGE_FETCH_ENABLED, PAGE_FETCH_TOP_K, page_fetcher
+
+CUSTOM_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+
+# Search result pages are cached per query, exclusion set and offset to save CSE quota
+search_cache = TieredCache("google_search",
+                           max_size=int(os.getenv("SEARCH_CACHE_SIZE", "4096")),
+                           ttl=float(os.getenv("SEARCH_CACHE_TTL", str(24 * 3600))),
+                           store=get_default_store(),
+                           store_max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "200000")))
+search_counters = {"api_calls": 0, "saved_calls": 0, "filtered_results": 0}
+
+# Result pages fetched per search, and extra pages fetched at most to replace filtered-out results
+SEARCH_PAGES = 3
+SEARCH_BACKFILL_PAGES = int(os.getenv("SEARCH_BACKFILL_PAGES", "2"))
+
+
+# googleapiclient services are not thread-safe, so the sync path keeps one per thread
+_services = threading.local()
+
+
+def get_service(api_key):
+    services = getattr(_services, "by_key", None)
+    if services is None:
+        services = _services.by_key = {}
+    if api_key not in services:
+        # Imported here, as the discovery client is slow to import and only used by the sync search path
+        from googleapiclient.discovery import build
+        services[api_key] = build("customsearch", "v1", developerKey=api_key)
+    return services[api_key]
+
+
+def charge_search():
+    """Charge a Custom Search API call to the budget of the current request, if it has one."""
+    request_budget = current_budget()
+    if request_budget is not None:
+        request_budget.charge_search()
 
 
 def build_query(query, excluded_sites):
@@ -12,7 +56,15 @@ def build_query(query, excluded_sites):
 
 
 class InformationRetrieval:
-    def __init__(self, cse_id: str, api_key: str, excluded_sites: List[str], num_results: int = 10):
+    def __init__(self, cse_id: str, api_key: str, excluded_sites: List[str], num_results: int = 10,
+                 excluded_domains: Optional[DomainSet] = None, fetch_pages: bool = PAGE_FETCH_ENABLED,
+                 pages_per_search: int = PAGE_FETCH_TOP_K):
+        """
+        :param excluded_sites: Sites excluded in the query itself with -site: terms. Keep this list short.
+        :param excluded_domains: Domains whose results are dropped locally from the returned results.
+        :param fetch_pages: Whether asearch also fetches the top result pages and returns their main text.
+        :param pages_per_search: Number of result pages fetched per search.
+        """
         self.cse_id = cse_id
         self.api_key = api_key
         self.num_results = num_results
@@ -23,6 +75,11 @@ class InformationRetrieval:
         self.retrieved_links = []
         self.retrieved_texts = []
         self.excluded_sites = excluded_sites
+        self.excluded_domains = excluded_domains
+        self.fetch_pages = fetch_pages
+        self.pages_per_search = pages_per_search
+        # Cached pages hold the unfiltered results, so only the query exclusions are part of the cache key
+        self.exclusion_version = content_key(*sorted(excluded_sites))[:16]
         self.link_number_mapping = {}  # Maps link numbers to actual URLs
         self.current_link_number = 1  # Counter for assigning link numbers
 
@@ -52,7 +109,7 @@ class InformationRetrieval:
             if published_time:
                 published_time = published_time.split("T")[0]
                 try:
-                    published_time = pd.to_datetime(published_time).strftime('%Y-%b')
+                    published_time = datetime.fromisoformat(published_time).strftime('%Y-%b')
                 except:
                     published_time = "NO DATE"
 
@@ -75,38 +132,207 @@ class InformationRetrieval:
 
         return "".join(formatted_res), query_link_mapping
 
+    async def retrieve_pages(self, results: List[Dict]) -> str:
+        """
+        Fetch the main text of the top results that were not retrieved yet and format it with their link numbers.
+        """
+        links = []
+        for result in results:
+            link = result.get("link", "")
+            if link and link not in self.retrieved_links and link not in links:
+                links.append(link)
+            if len(links) >= self.pages_per_search:
+                break
+        if not links:
+            return ""
+
+        documents = await page_fetcher.fetch_many(links)
+        link_numbers = {link: number for number, link in self.link_number_mapping.items()}
+        formatted_pages = []
+        for document in documents:
+            if document["url"] in self.retrieved_links:
+                # Fetched for another search that ran at the same time
+                continue
+            self.retrieved_links.append(document["url"])
+            self.retrieved_texts.append(document["text"])
+            if document["text"]:
+                formatted_pages.append(f"[{link_numbers.get(document['url'], '?')}] {document['title']}:\n{document['text']}\n")
+
+        if not formatted_pages:
+            return ""
+        return "\nFull text of the top results:\n" + "\n".join(formatted_pages)
+
+    def _start_query(self, query: str):
+        if self.last_request != query:
+            self.start = 0
+            self.all_queries.append(query)
+            self.last_request = query
+
+    def _page_cache_key(self, query: str, start: int) -> str:
+        return content_key(query, self.exclusion_version, start, self.num_results)
+
+    def _filter_results(self, results: List[Dict]) -> List[Dict]:
+        if not self.excluded_domains:
+            return results
+        kept = [result for result in results if result.get("link", "") not in self.excluded_domains]
+        search_counters["filtered_results"] += len(results) - len(kept)
+        return kept
+
+    def _add_results(self, query: str, results: List[Dict]):
+        self.start += len(results)
+        kept = self._filter_results(results)
+        if query in self.all_results:
+            self.all_results[query].extend(kept)
+        else:
+            self.all_results[query] = kept
+        return len(kept)
+
     def search(self, query: str) -> str:
         """Perform Google search and return formatted results with numbered references."""
         try:
-            if self.last_request != query:
-                self.start = 0
-                self.all_queries.append(query)
-                self.last_request = query
-
-            service = build("customsearch", "v1", developerKey=self.api_key)
-
-            for _ in range(3):  # Make up to 3 requests
-                response = service.cse().list(
-                    q=build_query(query, self.excluded_sites),
-                    cx=self.cse_id,
-                    num=self.num_results,
-                    start=self.start
-                ).execute()
-
-                results = response['items']
-                self.start += len(results)
-
-                if query in self.all_results:
-                    self.all_results[query].extend(results)
+            self._start_query(query)
+            wanted = SEARCH_PAGES * self.num_results
+            collected = 0
+
+            # Make up to 3 requests, plus backfill requests for results that were filtered out
+            for _ in range(SEARCH_PAGES + SEARCH_BACKFILL_PAGES):
+                cache_key = self._page_cache_key(query, self.start)
+                results = search_cache.get(cache_key)
+                if results is not None:
+                    search_counters["saved_calls"] += 1
                 else:
-                    self.all_results[query] = results
+                    charge_search()
+                    search_counters["api_calls"] += 1
+                    response = get_service(self.api_key).cse().list(
+                        q=build_query(query, self.excluded_sites),
+                        cx=self.cse_id,
+                        num=self.num_results,
+                        start=self.start
+                    ).execute()
+
+                    results = response.get('items', [])
+                    search_cache.set(cache_key, results)
+                collected += self._add_results(query, results)
+                if collected >= wanted or len(results) < self.num_results:
+                    break
+
+            formatted_results, query_mapping = self.format_google(self.all_results.get(query, []))
+            return formatted_results
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            logging.warning(f"Search error occurred: {e}", exc_info=True)
+            return "No relevant information found."
+
+    async def fetch_page(self, query: str, start: int) -> List[Dict]:
+        """Fetch one page of Custom Search results through the shared async connection pool."""
+        cache_key = self._page_cache_key(query, start)
+        results = await search_cache.aget(cache_key)
+        if results is not None:
+            search_counters["saved_calls"] += 1
+            return results
+
+        charge_search()
+        search_counters["api_calls"] += 1
+        response = await http_pool.get_async_client("google").get(CUSTOM_SEARCH_URL, params={
+            "key": self.api_key,
+            "cx": self.cse_id,
+            "q": build_query(query, self.excluded_sites),
+            "num": self.num_results,
+            "start": start,
+        })
+        response.raise_for_status()
+        results = response.json().get("items", [])
+        await search_cache.aset(cache_key, results)
+        return results
+
+    async def _fetch_results(self, query: str, start: int) -> Tuple[List[Dict], int]:
+        """
+        Fetch the result pages of one search round concurrently, backfilling results that were filtered out.
+        Returns the kept results and the offset of the next round.
+        """
+        wanted = SEARCH_PAGES * self.num_results
+        kept = []
+        pages_left = SEARCH_PAGES + SEARCH_BACKFILL_PAGES
+        pages = SEARCH_PAGES
+
+        while pages > 0:
+            offsets = [start + page * self.num_results for page in range(pages)]
+            fetched = await asyncio.gather(*[self.fetch_page(query, offset) for offset in offsets])
+            pages_left -= pages
+
+            exhausted = False
+            for results in fetched:
+                start += len(results)
+                kept.extend(self._filter_results(results))
+                if len(results) < self.num_results:
+                    exhausted = True
+                    break
+            if exhausted or len(kept) >= wanted:
+                break
+            # Backfill the results that were filtered out
+            pages = min(pages_left, math.ceil((wanted - len(kept)) / self.num_results))
+        return kept, start
+
+    async def asearch(self, query: str) -> str:
+        """Async version of search that fetches the result pages of each round concurrently."""
+        try:
+            self._start_query(query)
+            kept, self.start = await self._fetch_results(query, self.start)
+            self.all_results.setdefault(query, []).extend(kept)
 
             formatted_results, query_mapping = self.format_google(self.all_results[query])
+            if self.fetch_pages and query_mapping:
+                formatted_results += await self.retrieve_pages(self.all_results[query])
             return formatted_results
+        except BudgetExceeded:
+            raise
         except Exception as e:
             logging.warning(f"Search error occurred: {e}", exc_info=True)
             return "No relevant information found."
 
+    async def _fetch_first_round(self, query: str) -> List[Dict]:
+        try:
+            kept, _ = await self._fetch_results(query, 0)
+            return kept
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            logging.warning(f"Search error occurred: {e}", exc_info=True)
+            return []
+
+    async def asearch_many(self, queries: List[str]) -> List[Tuple[str, str]]:
+        """
+        Run several searches concurrently and return (query, formatted results) for each distinct query, in order.
+        Link numbers are assigned in that order, so a link found by several searches keeps one number.
+        """
+        queries = list(dict.fromkeys(query for query in queries if query.strip()))
+        fetched = await asyncio.gather(*[self._fetch_first_round(query) for query in queries])
+
+        formatted = []
+        for query, kept in zip(queries, fetched):
+            self.all_queries.append(query)
+            self.all_results.setdefault(query, []).extend(kept)
+            formatted.append(self.format_google(self.all_results[query]))
+        results = [text for text, _ in formatted]
+        if self.fetch_pages:
+            found = [index for index, (_, query_mapping) in enumerate(formatted) if query_mapping]
+            pages = await asyncio.gather(*[self.retrieve_pages(self.all_results[queries[index]]) for index in found])
+            for index, page_text in zip(found, pages):
+                results[index] += page_text
+        return list(zip(queries, results))
+
     def get_link_mapping(self) -> Dict[int, str]:
         """Return the current link number to URL mapping."""
         return self.link_number_mapping
+
+
+def search_stats() -> dict:
+    """
+    Return how many CSE calls were made and how many were served from the search cache.
+    """
+    total = search_counters["api_calls"] + search_counters["saved_calls"]
+    return {
+        **search_counters,
+        "hit_ratio": search_counters["saved_calls"] / total if total else 0.0,
+    }
@@ -0,0 +1,116 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import logging
+import os
+import threading
+from typing import Dict
+
+import httpx
+
+# Limits shared by every pooled client. Keep-alive connections are what saves us
+# the TLS handshake to the providers on every request.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "300"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+
+_lock = threading.Lock()
+_async_clients: Dict[str, httpx.AsyncClient] = {}
+_sync_clients: Dict[str, httpx.Client] = {}
+_request_counts: Dict[str, int] = {}
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+
+def _count_request(name: str):
+    _request_counts[name] = _request_counts.get(name, 0) + 1
+
+
+def get_async_client(name: str = "default") -> httpx.AsyncClient:
+    """
+    Return the process-wide async HTTP client for the pool ``name``, creating it on first use.
+    """
+    with _lock:
+        client = _async_clients.get(name)
+        if client is None or client.is_closed:
+            async def on_request(request):
+                _count_request(f"{name}:async")
+
+            client = httpx.AsyncClient(limits=_limits(),
+                                       timeout=HTTP_TIMEOUT,
+                                       event_hooks={"request": [on_request]})
+            _async_clients[name] = client
+        return client
+
+
+def get_sync_client(name: str = "default") -> httpx.Client:
+    """
+    Return the process-wide sync HTTP client for the pool ``name``, creating it on first use.
+    """
+    with _lock:
+        client = _sync_clients.get(name)
+        if client is None or client.is_closed:
+            def on_request(request):
+                _count_request(f"{name}:sync")
+
+            client = httpx.Client(limits=_limits(),
+                                  timeout=HTTP_TIMEOUT,
+                                  event_hooks={"request": [on_request]})
+            _sync_clients[name] = client
+        return client
+
+
+def _connection_stats(client) -> dict:
+    # httpx does not expose its connection pool publicly, so read it defensively.
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []) or [])
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {
+        "connections": len(connections),
+        "idle": idle,
+        "active": len(connections) - idle,
+    }
+
+
+def pool_stats() -> dict:
+    """
+    Return connection and request counters for every pooled client.
+    """
+    stats = {
+        "limits": {
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+        },
+        "pools": {},
+    }
+    for kind, clients in (("async", _async_clients), ("sync", _sync_clients)):
+        for name, client in list(clients.items()):
+            pool = _connection_stats(client)
+            pool["requests"] = _request_counts.get(f"{name}:{kind}", 0)
+            stats["pools"][f"{name}:{kind}"] = pool
+    return stats
+
+
+async def aclose_all():
+    """
+    Close every pooled client. Called on application shutdown.
+    """
+    with _lock:
+        async_clients = list(_async_clients.values())
+        sync_clients = list(_sync_clients.values())
+        _async_clients.clear()
+        _sync_clients.clear()
+    for client in async_clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logging.warning(f"Failed to close HTTP client: {e}")
+    for client in sync_clients:
+        client.close()
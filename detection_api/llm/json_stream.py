@@ -0,0 +1,73 @@
+import json
+from typing import List, Tuple
+
+
+class IncrementalDetectionParser:
+    """
+    Incrementally parses a streamed detection object of the form
+
+        {"<technique>": [{"explanation": ..., "location": ...}, ...], ...}
+
+    and returns every (technique, occurrence) pair as soon as the occurrence object is closed,
+    without waiting for the rest of the completion.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.last_key = None
+        self.technique = None
+        self.object_start = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, dict]]:
+        """
+        Add the next chunk of the completion and return the occurrences it completed.
+        """
+        completed = []
+        offset = len(self.text)
+        self.text += chunk
+
+        for position in range(offset, len(self.text)):
+            char = self.text[position]
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = json.loads(self.text[self.string_start:position + 1])
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = position
+            elif char == ":" and self.depth == 1:
+                self.technique = self.last_key
+            elif char in "{[":
+                self.depth += 1
+                if char == "{" and self.depth == 3:
+                    self.object_start = position
+            elif char in "}]":
+                if char == "}" and self.depth == 3 and self.object_start is not None:
+                    try:
+                        occurrence = json.loads(self.text[self.object_start:position + 1])
+                    except json.JSONDecodeError:
+                        occurrence = None
+                    if isinstance(occurrence, dict) and self.technique is not None:
+                        completed.append((self.technique, occurrence))
+                    self.object_start = None
+                self.depth -= 1
+
+        return completed
+
+    def result(self) -> dict:
+        """
+        Parse the complete completion. Only valid once the stream has ended.
+        """
+        return json.loads(self.text)
@@ -1,14 +1,51 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import json
+import logging
+import threading
+
+from llm import http_pool
+from llm.scheduler import SchedulerCallbackHandler
+
+# Process-wide registry of LLM clients, keyed by model name and settings.
+_registry = {}
+_registry_lock = threading.Lock()
+_registry_stats = {"hits": 0, "misses": 0}
+
+
+def _registry_key(model_name, kwargs):
+    return model_name, json.dumps(kwargs, sort_keys=True, default=str)
+
+
 def load_llm(model_name, **kwargs):  # Add **kwargs to accept any arguments
     """
     Load the LLM from the model_name and optional keyword arguments.
+
+    Clients are shared across requests: the same model name and settings always return the same
+    instance, which in turn reuses the process-wide keep-alive connection pool.
+    """
+    key = _registry_key(model_name, kwargs)
+    with _registry_lock:
+        llm = _registry.get(key)
+        if llm is not None:
+            _registry_stats["hits"] += 1
+            return llm
+        _registry_stats["misses"] += 1
+        llm = create_llm(model_name, **kwargs)
+        _registry[key] = llm
+    return llm
+
+
+def create_llm(model_name, **kwargs):
+    """
+    Build a new, unshared LLM client from the model_name and optional keyword arguments.
+    Every call made through the client waits for its rate budget in the process-wide scheduler.
     """
     if "gpt" in model_name:
         from langchain_openai import ChatOpenAI
 
-        # Check if custom settings were provided in kwargs, 
+        # Check if custom settings were provided in kwargs,
         # otherwise use defaults
         temperature = kwargs.get('temperature', 0)
         max_tokens = kwargs.get('max_tokens', None)
@@ -16,19 +53,49 @@ def load_llm(model_name, **kwargs):  # Add **kwargs to accept any arguments
         seed = kwargs.get('seed', None)
 
         llm = ChatOpenAI(
-            model_name=model_name, 
+            model_name=model_name,
             temperature=temperature,
             max_tokens=max_tokens,
             model_kwargs=model_kwargs,
-            seed=seed
+            seed=seed,
+            http_client=http_pool.get_sync_client("openai"),
+            http_async_client=http_pool.get_async_client("openai"),
+            callbacks=[SchedulerCallbackHandler(model_name)]
             )
 
     elif 'gemini' in model_name:
-        from langchain_google_genai import ChatGoogleGenerativeAI #NOTE needs debug -> ValueError: Your location is not supported by google-generativeai at the moment. Try to use ChatVertexAI LLM from langchain_google_vertexai. 
-        llm = ChatGoogleGenerativeAI(model=model_name, 
-                                     convert_system_message_to_human=True #NOTE currently no support for custom system messages
+        from langchain_google_genai import ChatGoogleGenerativeAI #NOTE needs debug -> ValueError: Your location is not supported by google-generativeai at the moment. Try to use ChatVertexAI LLM from langchain_google_vertexai.
+        llm = ChatGoogleGenerativeAI(model=model_name,
+                                     convert_system_message_to_human=True, #NOTE currently no support for custom system messages
+                                     callbacks=[SchedulerCallbackHandler(model_name)]
                                      )
     else:
         raise ValueError(f"Model {model_name} not found")
 
     return llm
+
+
+async def warm_up(llms):
+    """
+    Open a pooled connection to the provider of each given client, so the first request
+    does not pay for the TLS handshake.
+    """
+    for llm in llms:
+        root_async_client = getattr(llm, "root_async_client", None)
+        if root_async_client is None:
+            continue
+        try:
+            await root_async_client.models.list()
+        except Exception as e:
+            logging.warning(f"Failed to warm up connection for {llm.model_name}: {e}")
+
+
+def registry_stats() -> dict:
+    """
+    Return the number of shared clients and how often the registry was hit.
+    """
+    return {
+        "clients": [model_name for model_name, _ in _registry.keys()],
+        "hits": _registry_stats["hits"],
+        "misses": _registry_stats["misses"],
+    }
@@ -0,0 +1,279 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import asyncio
+import ipaddress
+import logging
+import os
+import re
+import socket
+from html.parser import HTMLParser
+from typing import Dict, List, Optional
+
+import httpx
+
+from llm import http_pool
+from llm.cache import SingleFlight, TieredCache, content_key, get_default_store
+
+# Fetching the result pages is optional, as it adds a few seconds to every search
+PAGE_FETCH_ENABLED = os.getenv("PAGE_FETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+# Result pages fetched per search, and how many of them are fetched at the same time process-wide
+PAGE_FETCH_TOP_K = int(os.getenv("PAGE_FETCH_TOP_K", "3"))
+PAGE_FETCH_CONCURRENCY = int(os.getenv("PAGE_FETCH_CONCURRENCY", "10"))
+PAGE_FETCH_TIMEOUT = float(os.getenv("PAGE_FETCH_TIMEOUT", "5"))
+# Pages larger than this are cut off before extraction
+PAGE_MAX_BYTES = int(os.getenv("PAGE_MAX_BYTES", str(2 * 1024 * 1024)))
+# Characters of extracted text kept per page
+PAGE_TEXT_CHARS = int(os.getenv("PAGE_TEXT_CHARS", "3000"))
+# Redirects followed per page, each checked like the page URL itself
+PAGE_MAX_REDIRECTS = int(os.getenv("PAGE_MAX_REDIRECTS", "5"))
+
+PAGE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; apollolytics/1.0)",
+    "Accept": "text/html,application/xhtml+xml",
+}
+
+# Extracted documents are cached by URL, so a page found by several searches is fetched once
+page_cache = TieredCache("page_text",
+                         max_size=int(os.getenv("PAGE_CACHE_SIZE", "2048")),
+                         ttl=float(os.getenv("PAGE_CACHE_TTL", str(24 * 3600))),
+                         store=get_default_store(),
+                         store_max_entries=int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "50000")))
+page_flight = SingleFlight()
+page_counters = {"fetched": 0, "failed": 0, "skipped": 0, "blocked": 0, "bytes": 0}
+
+# Elements whose text is never part of the main content
+SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "iframe", "nav", "header", "footer", "aside",
+                "form", "button", "select", "figure"}
+# Elements whose text is taken as the main content
+CONTENT_TAGS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "li", "blockquote", "pre", "td"}
+# Blocks shorter than this are mostly captions, menus and buttons
+MIN_BLOCK_CHARS = 40
+
+
+class BlockedURL(ValueError):
+    """
+    Raised for a page URL the fetcher must not request.
+    """
+
+
+async def resolve_host(host: str, port: int) -> List[str]:
+    """
+    Return the addresses a host name resolves to.
+    """
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return [info[4][0] for info in infos]
+
+
+def is_public_address(address: str) -> bool:
+    """
+    Whether an address is globally routable unicast, also for IPv4 addresses mapped into IPv6.
+    """
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def check_url(url: httpx.URL):
+    """
+    Raise BlockedURL unless url is an http(s) URL whose host only resolves to public addresses, so search results
+    cannot make the fetcher reach private, loopback or link-local services, e.g. cloud metadata endpoints.
+    The connection resolves the host again, so this does not stop a DNS server that answers differently then.
+    """
+    if url.scheme not in ("http", "https") or not url.host:
+        raise BlockedURL(f"Not an http(s) URL: {url}")
+    try:
+        addresses = [str(ipaddress.ip_address(url.host))]
+    except ValueError:
+        try:
+            addresses = await resolve_host(url.host, url.port or (443 if url.scheme == "https" else 80))
+        except OSError as e:
+            raise BlockedURL(f"Cannot resolve {url.host}: {e}")
+    if not addresses or not all(is_public_address(address) for address in addresses):
+        raise BlockedURL(f"{url.host} does not resolve to a public address")
+
+
+class MainTextExtractor(HTMLParser):
+    """
+    Collects the title and the text of the content blocks (paragraphs, headings, list items) of an HTML page,
+    leaving out scripts, navigation, headers, footers and forms. Text inside <article> or <main> is preferred
+    when the page has any.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.blocks = []
+        self.main_blocks = []
+        self.all_text = []
+        self._skip_depth = 0
+        self._main_depth = 0
+        self._in_title = False
+        self._block = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in ("article", "main"):
+            self._main_depth += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag in CONTENT_TAGS and self._block is None:
+            self._block = []
+        elif tag == "br" and self._block is not None:
+            self._block.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in ("article", "main"):
+            self._main_depth = max(0, self._main_depth - 1)
+        elif tag == "title":
+            self._in_title = False
+        elif tag in CONTENT_TAGS and self._block is not None:
+            self._end_block()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+            return
+        if self._skip_depth:
+            return
+        self.all_text.append(data)
+        if self._block is not None:
+            self._block.append(data)
+
+    def _end_block(self):
+        text = re.sub(r"\s+", " ", "".join(self._block)).strip()
+        self._block = None
+        if len(text) >= MIN_BLOCK_CHARS:
+            self.blocks.append(text)
+            if self._main_depth:
+                self.main_blocks.append(text)
+
+    def text(self) -> str:
+        if self._block is not None:
+            self._end_block()
+        blocks = self.main_blocks or self.blocks
+        if blocks:
+            return "\n".join(blocks)
+        # Pages without content blocks, e.g. text laid out in divs
+        return re.sub(r"\s+", " ", "".join(self.all_text)).strip()
+
+
+def extract_main_text(html: str) -> Dict[str, str]:
+    """
+    Extract the title and main text of an HTML page.
+    """
+    parser = MainTextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:
+        logging.warning(f"Failed to parse page: {e}")
+    return {"title": re.sub(r"\s+", " ", parser.title).strip(), "text": parser.text()}
+
+
+class PageFetcher:
+    """
+    Fetches result pages concurrently through the shared "pages" connection pool and extracts their main text.
+
+    At most concurrency pages are fetched at a time in this process, each with its own timeout and size cap.
+    Extracted documents are cached by URL and concurrent fetches of the same URL are coalesced.
+    Only http(s) URLs of public hosts are requested, including the targets of redirects, see check_url.
+    """
+
+    def __init__(self, concurrency: int = PAGE_FETCH_CONCURRENCY, timeout: float = PAGE_FETCH_TIMEOUT,
+                 max_bytes: int = PAGE_MAX_BYTES, max_chars: int = PAGE_TEXT_CHARS):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Created on first use, so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def _download(self, url: str) -> Optional[str]:
+        async with self._get_semaphore():
+            # The client timeout applies to each read, this one caps pages that trickle in slowly
+            return await asyncio.wait_for(self._read(url), self.timeout * 2)
+
+    async def _read(self, url: str) -> Optional[str]:
+        client = http_pool.get_async_client("pages")
+        url = httpx.URL(url)
+        # Redirects are followed here instead of by the client, so every hop is checked before it is requested
+        for _ in range(PAGE_MAX_REDIRECTS + 1):
+            await check_url(url)
+            async with client.stream("GET", url, headers=PAGE_HEADERS, timeout=self.timeout,
+                                     follow_redirects=False) as response:
+                if response.is_redirect:
+                    url = url.join(response.headers["location"])
+                    continue
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "")
+                if "html" not in content_type and "text/plain" not in content_type:
+                    page_counters["skipped"] += 1
+                    return None
+                body = bytearray()
+                async for chunk in response.aiter_bytes():
+                    body.extend(chunk)
+                    if len(body) >= self.max_bytes:
+                        break
+                page_counters["bytes"] += len(body)
+                return body[:self.max_bytes].decode(response.charset_encoding or "utf-8", errors="replace")
+        raise BlockedURL(f"More than {PAGE_MAX_REDIRECTS} redirects")
+
+    async def _fetch(self, url: str) -> Dict[str, str]:
+        cache_key = content_key(url)
+        document = await page_cache.aget(cache_key)
+        if document is not None:
+            return document
+        try:
+            html = await self._download(url)
+        except BlockedURL as e:
+            page_counters["blocked"] += 1
+            logging.info(f"Not fetching {url}: {e}")
+            return {"url": url, "title": "", "text": ""}
+        except Exception as e:
+            page_counters["failed"] += 1
+            logging.info(f"Failed to fetch {url}: {e}")
+            return {"url": url, "title": "", "text": ""}
+        page_counters["fetched"] += 1
+        document = {"url": url, "title": "", "text": ""}
+        if html is not None:
+            document.update(extract_main_text(html))
+            document["text"] = document["text"][:self.max_chars]
+        await page_cache.aset(cache_key, document)
+        return document
+
+    async def fetch(self, url: str) -> Dict[str, str]:
+        """
+        Return the document {"url", "title", "text"} of a page. The text is empty if the page could not be fetched.
+        """
+        return await page_flight.do(url, lambda: self._fetch(url))
+
+    async def fetch_many(self, urls: List[str]) -> List[Dict[str, str]]:
+        """
+        Fetch several pages concurrently, in the order of urls.
+        """
+        return list(await asyncio.gather(*[self.fetch(url) for url in urls]))
+
+
+page_fetcher = PageFetcher()
+
+
+def page_stats() -> dict:
+    """
+    Return how many result pages were fetched, and how many fetches were coalesced.
+    """
+    return {
+        **page_counters,
+        "enabled": PAGE_FETCH_ENABLED,
+        "in_flight": page_flight.stats(),
+    }
@@ -1,11 +1,32 @@
 from langchain.schema import HumanMessage, SystemMessage  # Custom schema definitions for messages
 import llm.ressources.prompts as prompts
 from llm.load_llm import load_llm  # Custom function for loading language models
+from llm.cache import TieredCache, content_key, normalize_text, get_default_store
+from llm.json_stream import IncrementalDetectionParser
+from llm.chunking import split_text, merge_detections
+import asyncio
+from typing import AsyncIterator, Tuple
+import hashlib
 import json
 import logging
+import os
 import time
 RANDOM_SEED = 42
 
+# Articles longer than ARTICLE_CHUNK_SIZE characters are analyzed in overlapping chunks
+ARTICLE_CHUNK_SIZE = int(os.getenv("ARTICLE_CHUNK_SIZE", "8000"))
+ARTICLE_CHUNK_OVERLAP = int(os.getenv("ARTICLE_CHUNK_OVERLAP", "400"))
+
+# Changes to the system prompt invalidate cached detections
+PROMPT_VERSION = hashlib.sha256(prompts.SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
+
+# Detections are deterministic (temperature 0, fixed seed), so identical articles can share a result
+detection_cache = TieredCache("propaganda_detection",
+                              max_size=int(os.getenv("DETECTION_CACHE_SIZE", "1024")),
+                              ttl=float(os.getenv("DETECTION_CACHE_TTL", str(7 * 24 * 3600))),
+                              store=get_default_store(),
+                              store_max_entries=int(os.getenv("DETECTION_CACHE_MAX_ENTRIES", "100000")))
+
 # Class definition for performing propaganda technique detection using OpenAI's models
 class OpenAITextClassificationPropagandaInference:
     """
@@ -20,6 +41,7 @@ class OpenAITextClassificationPropagandaInference:
         Args:
             model_name (str): Identifier for the OpenAI model to be used.
         """
+        self.model_name = model_name
         # Initialize the language model with specific parameters
         self.llm = load_llm(model_name,
                             temperature=0,  # Set the temperature parameter for model sampling
@@ -39,14 +61,7 @@ class OpenAITextClassificationPropagandaInference:
             str: The model's output containing detected propaganda techniques and explanations.
         """
         # Define the conversation prompt with instructions for the model
-        prompt = [
-            SystemMessage(
-                content=prompts.SYSTEM_PROMPT
-            ),
-            HumanMessage(
-                content=input_text  # The input article text for analysis
-            ),
-        ]
+        prompt = self.build_prompt(input_text)
 
         # Get the model's output given the prompt
         start_time = time.time()
@@ -54,6 +69,21 @@ class OpenAITextClassificationPropagandaInference:
         logging.info(f"detect_explain took {time.time() - start_time} seconds")
         return json.loads(output.content)
 
+    def format_detection(self, detection: dict) -> dict:
+        """
+        Formats a single occurrence of a propaganda technique.
+
+        Args:
+            detection (dict): One occurrence as returned by the model.
+
+        Returns:
+            dict: The explanation and the cleaned-up text evidence of the occurrence.
+        """
+        return {
+            f"explanation": detection["explanation"],
+            "location": detection["location"].strip().strip('"').strip("'")
+        }
+
     def format_output(self, detections: dict) -> dict:
         """
         Parses the model output to extract identified propaganda techniques and their explanations.
@@ -88,14 +118,123 @@ class OpenAITextClassificationPropagandaInference:
             if technique not in extracted_techniques:
                 extracted_techniques[technique] = []
             for detection in detections[technique]:
-                extracted_techniques[technique].append({
-                    f"explanation": detection["explanation"],
-                    "location": detection["location"].strip().strip('"').strip("'")
-                })
+                extracted_techniques[technique].append(self.format_detection(detection))
             #else:
             #    logging.info(f"Unknown technique detected: {technique}")
         return extracted_techniques
 
+    def build_prompt(self, input_text: str) -> list:
+        """
+        Builds the conversation prompt with instructions for the model.
+
+        Args:
+            input_text (str): The article text to analyze.
+
+        Returns:
+            list: The system and human messages to send to the model.
+        """
+        return [
+            SystemMessage(
+                content=prompts.SYSTEM_PROMPT
+            ),
+            HumanMessage(
+                content=input_text  # The input article text for analysis
+            ),
+        ]
+
+    async def detect_explain_stream(self, input_text: str) -> AsyncIterator[Tuple[str, dict]]:
+        """
+        Streaming version of detect_explain that yields each detected occurrence as soon as the model has finished
+        generating it.
+
+        Args:
+            input_text (str): The article text to analyze.
+
+        Yields:
+            tuple: The technique name and the raw occurrence. After the stream ends, the complete model output is
+            available as self.last_stream_output.
+        """
+        parser = IncrementalDetectionParser()
+        start_time = time.time()
+        async for chunk in self.llm.astream(self.build_prompt(input_text)):
+            for technique, detection in parser.feed(chunk.content):
+                yield technique, detection
+        logging.info(f"detect_explain_stream took {time.time() - start_time} seconds")
+        self.last_stream_output = parser.result()
+
+    async def analyze_article_stream(self, input_text: str, on_entry) -> dict:
+        """
+        Like analyze_article, but awaits on_entry(technique, entry_id, entry) for every formatted occurrence as soon as
+        it is available. The entries passed to on_entry are the same objects as in the returned dictionary.
+        Articles longer than ARTICLE_CHUNK_SIZE are not streamed: their entries are passed once all chunks are merged.
+
+        Args:
+            input_text (str): The text of the article to analyze.
+            on_entry (callable): Coroutine function called with the technique, the entry id
+                ("<technique>:<index>") and the formatted entry.
+
+        Returns:
+            dict: A dictionary containing the detected propaganda techniques and their details.
+        """
+        try:
+            extracted_techniques_dict = {}
+
+            async def emit(technique, entry):
+                entries = extracted_techniques_dict.setdefault(technique, [])
+                entries.append(entry)
+                await on_entry(technique, f"{technique}:{len(entries) - 1}", entry)
+
+            cache_key = content_key(normalize_text(input_text), self.model_name, PROMPT_VERSION)
+            cached = await detection_cache.aget(cache_key)
+            if cached is not None:
+                logging.info("Propaganda detection served from cache")
+                for technique, entries in cached.items():
+                    extracted_techniques_dict.setdefault(technique, [])
+                    for entry in entries:
+                        await emit(technique, entry)
+                extracted_techniques_dict["status"] = "success"
+                return extracted_techniques_dict
+
+            if len(input_text) > ARTICLE_CHUNK_SIZE:
+                # Long articles are split into chunks, which only finish once they are merged
+                complete_output = await self.detect_explain_chunked(input_text)
+            else:
+                logging.info("Streaming propaganda technique analysis...")
+                async for technique, detection in self.detect_explain_stream(input_text):
+                    await emit(technique, self.format_detection(detection))
+                complete_output = self.format_output(self.last_stream_output)
+
+            # Emit anything the incremental parser could not pick up from the complete output
+            for technique, entries in complete_output.items():
+                extracted_techniques_dict.setdefault(technique, [])
+                for entry in entries[len(extracted_techniques_dict[technique]):]:
+                    await emit(technique, entry)
+
+            await detection_cache.aset(cache_key, complete_output)
+            extracted_techniques_dict["status"] = "success"
+            return extracted_techniques_dict
+        except Exception as e:
+            logging.error(f"An error occurred during analysis: {e}")
+            return {
+                "status": "error",
+                "error": str(e)
+            }
+
+    async def detect_explain_chunked(self, input_text: str) -> dict:
+        """
+        Detects propaganda techniques in a long article by analyzing overlapping chunks concurrently.
+
+        Args:
+            input_text (str): The article text to analyze.
+
+        Returns:
+            dict: The formatted detections of all chunks, with duplicates from the overlaps removed.
+        """
+        chunks = split_text(input_text, ARTICLE_CHUNK_SIZE, ARTICLE_CHUNK_OVERLAP)
+        logging.info(f"Analyzing article in {len(chunks)} chunks")
+        chunk_outputs = await asyncio.gather(*[self.detect_explain(chunk) for chunk, _ in chunks])
+        return merge_detections([self.format_output(output) for output in chunk_outputs], chunks)
+
     async def analyze_article(self, input_text: str) -> dict:
         """
         Analyzes an article for propaganda techniques, combining detection and formatting of results.
@@ -107,9 +246,20 @@ class OpenAITextClassificationPropagandaInference:
             dict: A dictionary containing the detected propaganda techniques and their details.
         """
         try:
+            cache_key = content_key(normalize_text(input_text), self.model_name, PROMPT_VERSION)
+            extracted_techniques_dict = await detection_cache.aget(cache_key)
+            if extracted_techniques_dict is not None:
+                logging.info("Propaganda detection served from cache")
+                extracted_techniques_dict["status"] = "success"
+                return extracted_techniques_dict
+
             logging.info("Analyzing article for propaganda techniques...")
-            detection_output = await self.detect_explain(input_text)
-            extracted_techniques_dict = self.format_output(detection_output)
+            if len(input_text) > ARTICLE_CHUNK_SIZE:
+                extracted_techniques_dict = await self.detect_explain_chunked(input_text)
+            else:
+                detection_output = await self.detect_explain(input_text)
+                extracted_techniques_dict = self.format_output(detection_output)
+            await detection_cache.aset(cache_key, extracted_techniques_dict)
             extracted_techniques_dict["status"] = "success"
             return extracted_techniques_dict
         except Exception as e:
@@ -0,0 +1,57 @@
+"""
+Precomputes excluded_domains.json from mediabiasfactcheck_fakenews.csv, so the API does not need pandas
+or the CSV at startup. Rerun after updating the CSV (from the detection_api directory):
+
+    python -m llm.ressources.build_excluded_domains
+"""
+import json
+import os
+
+import pandas as pd
+
+RESSOURCES = os.path.dirname(os.path.abspath(__file__))
+CSV_PATH = os.path.join(RESSOURCES, "mediabiasfactcheck_fakenews.csv")
+ARTIFACT_PATH = os.path.join(RESSOURCES, "excluded_domains.json")
+
+
+# Order of the factual reporting ratings, least factual first
+FACTUAL_REPORTING_RANKS = {"verylow": 0, "low": 1, "mixed": 2}
+
+
+def normalize_rating(ratings: pd.Series) -> pd.Series:
+    return ratings.fillna("").str.lower().str.replace(r"\s", "", regex=True)
+
+
+def rank_query_exclusions(fake: pd.DataFrame, domains: pd.Series) -> list:
+    """
+    Rank the high-traffic sites for the -site: terms of the search queries, which only fit a few of them.
+
+    The CSV has traffic tiers but no traffic numbers, so within the high-traffic tier the sites that are worst
+    for a contextualization come first: the lowest factual reporting rating, then the most questionable
+    reasoning items (propaganda, conspiracy, failed fact checks...), then by domain so the order is stable.
+    """
+    high_traffic = normalize_rating(fake["Traffic/Popularity"]).str.startswith("hightraffic")
+    reasoning = fake["Questionable Reasoning"].fillna(fake["Questionable  Reasoning"]).fillna(fake["Reasoning"])
+    reasons = reasoning.fillna("").str.split(r"[,;]").apply(lambda items: sum(1 for item in items if item.strip()))
+    ranked = pd.DataFrame({
+        "domain": domains,
+        "factual": normalize_rating(fake["Factual Reporting"]).map(FACTUAL_REPORTING_RANKS).fillna(3),
+        "reasons": -reasons,
+    })[high_traffic]
+    return ranked.sort_values(["factual", "reasons", "domain"])["domain"].drop_duplicates().tolist()
+
+
+def build():
+    fake = pd.read_csv(CSV_PATH)
+    fake = fake[fake["Traffic/Popularity"] != "Minimal Traffic"]
+    domains = fake["source_link"].apply(lambda x: x.split("//")[-1].split("www.")[-1].split("/")[0])
+    return {
+        "excluded_sites": domains.tolist(),
+        "query_excluded_sites": rank_query_exclusions(fake, domains),
+    }
+
+
+if __name__ == "__main__":
+    with open(ARTIFACT_PATH, "w") as f:
+        json.dump(build(), f, indent=0)
+    print(f"Wrote {ARTIFACT_PATH}")
@@ -0,0 +1,230 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+from llm.budget import current_budget
+
+# Lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Priority of the LLM calls made from the current task
+llm_priority: ContextVar[int] = ContextVar("llm_priority", default=PRIORITY_INTERACTIVE)
+
+# Budgets for models without an entry in LLM_RATE_LIMITS
+LLM_DEFAULT_RPM = int(os.getenv("LLM_DEFAULT_RPM", "500"))
+LLM_DEFAULT_TPM = int(os.getenv("LLM_DEFAULT_TPM", "200000"))
+# Completion tokens assumed for a call that does not set max_tokens
+LLM_DEFAULT_COMPLETION_TOKENS = int(os.getenv("LLM_DEFAULT_COMPLETION_TOKENS", "1000"))
+
+
+def parse_rate_limits(value: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Parse per-model budgets of the form "gpt-4o=500:30000,gpt-4o-mini=1000:200000" (requests:tokens per minute).
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        model_name, budget = item.split("=")
+        rpm, tpm = budget.split(":")
+        limits[model_name.strip()] = (int(rpm), int(tpm))
+    return limits
+
+
+LLM_RATE_LIMITS = parse_rate_limits(os.getenv("LLM_RATE_LIMITS", ""))
+
+
+@contextmanager
+def priority(value: int):
+    """
+    Run the LLM calls made inside the block (and in tasks started from it) with the given priority.
+    """
+    token = llm_priority.set(value)
+    try:
+        yield
+    finally:
+        llm_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute, holding at most one minute worth of tokens.
+    """
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount tokens are available."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        """Take amount tokens. A negative amount returns tokens; the balance may go below zero."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class _ModelState:
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.waiters = []
+        self.changed = asyncio.Event()
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.granted_by_priority = {}
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class LLMScheduler:
+    """
+    Process-wide admission control for LLM calls.
+
+    Every call waits for one request from the model's requests-per-minute bucket and its estimated
+    tokens from the tokens-per-minute bucket. Waiting calls are served in priority order, so interactive
+    detection goes before background contextualization.
+    """
+
+    def __init__(self, rate_limits: Optional[Dict[str, Tuple[int, int]]] = None):
+        self.rate_limits = LLM_RATE_LIMITS if rate_limits is None else rate_limits
+        self._states: Dict[str, _ModelState] = {}
+        self._sequence = itertools.count()
+
+    def _state(self, model_name: str) -> _ModelState:
+        state = self._states.get(model_name)
+        if state is None:
+            rpm, tpm = self.rate_limits.get(model_name, (LLM_DEFAULT_RPM, LLM_DEFAULT_TPM))
+            state = self._states[model_name] = _ModelState(rpm, tpm)
+        return state
+
+    async def acquire(self, model_name: str, tokens: int, priority: Optional[int] = None):
+        """
+        Wait until the model's budgets allow a call of the given estimated size, then charge it.
+        """
+        state = self._state(model_name)
+        ticket = (llm_priority.get() if priority is None else priority, next(self._sequence))
+        start = time.monotonic()
+        heapq.heappush(state.waiters, ticket)
+        try:
+            while True:
+                delay = None
+                if state.waiters[0] == ticket:
+                    delay = max(state.requests.wait_time(1), state.tokens.wait_time(tokens))
+                    if delay <= 0:
+                        state.requests.consume(1)
+                        state.tokens.consume(tokens)
+                        break
+                try:
+                    await asyncio.wait_for(state.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            state.waiters.remove(ticket)
+            heapq.heapify(state.waiters)
+            state.notify()
+
+        waited = time.monotonic() - start
+        state.granted += 1
+        state.granted_by_priority[ticket[0]] = state.granted_by_priority.get(ticket[0], 0) + 1
+        state.total_wait += waited
+        state.max_wait = max(state.max_wait, waited)
+        if waited > 1:
+            logging.info(f"LLM call to {model_name} waited {waited:.2f} seconds for its rate budget")
+
+    def record_usage(self, model_name: str, estimated_tokens: int, actual_tokens: int):
+        """
+        Correct the tokens charged for a call once its actual usage is known.
+        """
+        self._state(model_name).tokens.consume(actual_tokens - estimated_tokens)
+
+    def stats(self) -> dict:
+        return {
+            model_name: {
+                "queue_depth": len(state.waiters),
+                "granted": state.granted,
+                "granted_by_priority": dict(state.granted_by_priority),
+                "avg_wait": state.total_wait / state.granted if state.granted else 0.0,
+                "max_wait": state.max_wait,
+                "rpm_limit": state.requests.capacity,
+                "tpm_limit": state.tokens.capacity,
+                "tpm_available": state.tokens.tokens,
+            }
+            for model_name, state in self._states.items()
+        }
+
+
+scheduler = LLMScheduler()
+
+
+def estimate_tokens(messages, max_tokens: Optional[int] = None) -> int:
+    """
+    Rough token estimate of a chat call: about four characters per prompt token plus the completion budget.
+    """
+    prompt_chars = sum(len(str(message.content)) for message in messages)
+    return prompt_chars // 4 + (max_tokens or LLM_DEFAULT_COMPLETION_TOKENS)
+
+
+class SchedulerCallbackHandler(AsyncCallbackHandler):
+    """
+    Callback attached to every client created by load_llm, which routes its calls through the scheduler
+    and charges them to the budget of the current request.
+    """
+
+    raise_error = True
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._estimates: Dict[UUID, int] = {}
+        self._budgets = {}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        invocation_params = kwargs.get("invocation_params") or {}
+        tokens = sum(estimate_tokens(prompt, invocation_params.get("max_tokens")) for prompt in messages)
+        request_budget = current_budget()
+        if request_budget is not None:
+            request_budget.charge_tokens(tokens)
+            self._budgets[run_id] = request_budget
+        await scheduler.acquire(self.model_name, tokens)
+        self._estimates[run_id] = tokens
+
+    async def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        estimated = self._estimates.pop(run_id, None)
+        request_budget = self._budgets.pop(run_id, None)
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if estimated is not None and token_usage.get("total_tokens"):
+            scheduler.record_usage(self.model_name, estimated, token_usage["total_tokens"])
+            if request_budget is not None:
+                request_budget.correct_tokens(estimated, token_usage["total_tokens"])
+
+    async def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        self._estimates.pop(run_id, None)
+        self._budgets.pop(run_id, None)
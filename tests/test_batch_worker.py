@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, AnalysisResult, BatchJob, BatchItem, format_contextualize, parse_contextualize
+from database.batch import BatchWorker
+from database.repo import Repo
+
+
+@compiles(JSONB, "sqlite")
+def compile_jsonb_for_sqlite(type_, compiler, **kw):
+    return "JSON"
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'batch.db'}", connect_args={"check_same_thread": False})
+    # The GIN index only exists on Postgres
+    tables = [table for table in Base.metadata.sorted_tables]
+    for table in tables:
+        for index in list(table.indexes):
+            if index.dialect_kwargs.get("postgresql_using"):
+                table.indexes.discard(index)
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def create_job(session_factory, texts):
+    with session_factory() as db:
+        job = BatchJob(model_name="gpt-4o", contextualize="false", total_items=len(texts))
+        Repo(db).create_batch_job(job, texts)
+        return job.id
+
+
+async def wait_until_completed(session_factory, job_id, timeout=5.0):
+    for _ in range(int(timeout / 0.02)):
+        with session_factory() as db:
+            if db.get(BatchJob, job_id).status == "completed":
+                return
+        await asyncio.sleep(0.02)
+    raise AssertionError("Batch job did not complete")
+
+
+def slow_then_fast(outcome):
+    """The first call outlives its lease, the ones after it finish right away."""
+    calls = []
+
+    async def analyze(job, text):
+        calls.append(text)
+        if len(calls) == 1:
+            await asyncio.sleep(0.4)
+            if outcome == "error":
+                raise RuntimeError("first attempt failed")
+        return {"Loaded_Language": [{"location": f"{text} {len(calls)}"}]}
+
+    return analyze, calls
+
+
+@pytest.mark.parametrize("outcome", ["done", "error"])
+def test_worker_that_lost_its_lease_does_not_write(session_factory, outcome):
+    async def main():
+        job_id = create_job(session_factory, ["article"])
+        analyze, calls = slow_then_fast(outcome)
+        stale = BatchWorker(analyze, session_factory=session_factory, concurrency=1, lease_seconds=0.1,
+                            poll_interval=0.02, max_attempts=3)
+        # The stale worker stalls and cannot renew its lease
+        stale._renew_leases = lambda item_attempts: None
+        stale.start()
+        await asyncio.sleep(0.15)
+
+        fresh = BatchWorker(analyze, session_factory=session_factory, concurrency=1, lease_seconds=10,
+                            poll_interval=0.02, max_attempts=3)
+        fresh.start()
+        await wait_until_completed(session_factory, job_id)
+        await asyncio.sleep(0.4)  # Let the stale worker finish its attempt
+        await stale.stop()
+        await fresh.stop()
+
+        assert len(calls) == 2
+        assert stale.counters["lease_lost"] == 1
+        assert stale.counters["done"] == stale.counters["retried"] == 0
+        assert fresh.counters["done"] == 1
+        with session_factory() as db:
+            results = db.execute(select(AnalysisResult)).scalars().all()
+            item = db.execute(select(BatchItem)).scalar_one()
+            assert len(results) == 1
+            assert item.status == "done" and item.error is None
+            assert item.analysis_result_id == results[0].id
+            assert results[0].result == {"Loaded_Language": [{"location": "article 2"}]}
+
+    asyncio.run(main())
+
+
+def test_failed_items_are_retried_then_marked_error(session_factory):
+    async def main():
+        job_id = create_job(session_factory, ["good", "bad"])
+        calls = []
+
+        async def analyze(job, text):
+            calls.append(text)
+            if text == "bad":
+                raise RuntimeError("boom")
+            return {}
+
+        worker = BatchWorker(analyze, session_factory=session_factory, concurrency=2, poll_interval=0.02,
+                             max_attempts=2)
+        worker.start()
+        await wait_until_completed(session_factory, job_id)
+        await worker.stop()
+
+        assert calls.count("bad") == 2
+        assert worker.counters == {**worker.counters, "done": 1, "retried": 1, "failed": 1, "lease_lost": 0}
+        with session_factory() as db:
+            statuses = {item.text: (item.status, item.error) for item in db.execute(select(BatchItem)).scalars()}
+        assert statuses == {"good": ("done", None), "bad": ("error", "boom")}
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("value, stored", [(True, "true"), (False, "false"), ("Auto", "Auto")])
+def test_contextualize_is_stored_like_websocket_analyses(session_factory, monkeypatch, value, stored):
+    from fastapi.testclient import TestClient
+
+    import app
+    import dependencies
+
+    def repo():
+        with session_factory() as db:
+            yield Repo(db)
+
+    monkeypatch.setattr(app.batch_worker, "notify", lambda: None)
+    monkeypatch.setitem(app.app.dependency_overrides, dependencies.repo, repo)
+    response = TestClient(app.app).post("/batch/jobs", json={"model_name": "gpt-4o", "texts": ["a"],
+                                                             "contextualize": value})
+
+    with session_factory() as db:
+        job = db.get(BatchJob, response.json()["job_id"])
+    assert job.contextualize == stored == format_contextualize(value)
+    assert parse_contextualize(job.contextualize) == value
+
+
+def test_legacy_contextualize_values_are_parsed():
+    assert parse_contextualize("True") is True
+    assert parse_contextualize("False") is False
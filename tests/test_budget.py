@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from llm.budget import RequestBudget, BudgetExceeded, SKIPPED_BUDGET, budget
+from llm.contextualizer import Contextualizer, context_flight
+from llm.google_retriever import charge_search
+
+
+def make_contextualizer(searches: int, delay: float = 0.05):
+    """A contextualizer whose agent makes the given number of searches. runs records the searches that were made."""
+    contextualizer = Contextualizer(model_name="gpt-4o")
+    runs = []
+
+    async def run_agent(statement, date=None, originator=None):
+        runs.append([])
+        for _ in range(searches):
+            charge_search()
+            runs[-1].append(statement)
+            await asyncio.sleep(delay / searches)
+        return {"status": "success", "output": f"Context for {statement}"}
+
+    contextualizer.run_agent = run_agent
+    return contextualizer, runs
+
+
+async def process_with(contextualizer, statement, request_budget):
+    with budget(request_budget):
+        return await contextualizer.process_statement(statement)
+
+
+def test_shared_statement_is_charged_to_every_request():
+    async def main():
+        contextualizer, runs = make_contextualizer(searches=3)
+        first, second = RequestBudget(max_searches=10), RequestBudget(max_searches=10)
+        started = context_flight.counters["started"]
+        results = await asyncio.gather(process_with(contextualizer, "shared statement one", first),
+                                       process_with(contextualizer, "shared statement one", second))
+        assert [result["status"] for result in results] == ["success", "success"]
+        assert len(runs) == 1
+        assert context_flight.counters["started"] == started + 1
+        assert first.searches == 3 and second.searches == 3
+
+    asyncio.run(main())
+
+
+def test_shared_run_is_paid_by_the_requests_that_can_afford_it():
+    async def main():
+        contextualizer, runs = make_contextualizer(searches=3)
+        tight, loose = RequestBudget(max_searches=1), RequestBudget(max_searches=10)
+        results = await asyncio.gather(process_with(contextualizer, "shared statement two", tight),
+                                       process_with(contextualizer, "shared statement two", loose))
+        # The tight request paid for what it could afford, and still gets the result the other one paid for
+        assert [result["status"] for result in results] == ["success", "success"]
+        assert len(runs) == 1
+        assert tight.searches == 1 and tight.exceeded == "searches"
+        assert loose.searches == 3 and loose.exceeded is None
+
+    asyncio.run(main())
+
+
+def test_shared_run_stops_once_no_request_can_afford_it():
+    async def main():
+        contextualizer, runs = make_contextualizer(searches=15)
+        budgets = [RequestBudget(max_searches=2), RequestBudget(max_searches=3)]
+        results = await asyncio.gather(*[process_with(contextualizer, "shared statement four", request_budget)
+                                         for request_budget in budgets], return_exceptions=True)
+        assert all(isinstance(result, BudgetExceeded) for result in results)
+        assert runs == [["shared statement four"] * 3]
+        assert [request_budget.searches for request_budget in budgets] == [2, 3]
+
+    asyncio.run(main())
+
+
+def test_budget_limits_searches_across_statements():
+    async def main():
+        contextualizer, runs = make_contextualizer(searches=15)
+        request_budget = RequestBudget(max_searches=2)
+        results = await asyncio.gather(*[process_with(contextualizer, f"budget statement {index}", request_budget)
+                                         for index in range(5)], return_exceptions=True)
+        assert all(isinstance(result, BudgetExceeded) for result in results)
+        assert sum(len(searches) for searches in runs) == 2
+        assert request_budget.searches == 2
+
+    asyncio.run(main())
+
+
+def test_finished_shared_run_is_not_discarded():
+    async def main():
+        contextualizer, runs = make_contextualizer(searches=2)
+        request_budget = RequestBudget(max_searches=2)
+        results = await asyncio.gather(*[process_with(contextualizer, "shared statement five", request_budget)
+                                         for _ in range(3)])
+        # One request waiting three times pays for the run once
+        assert [result["status"] for result in results] == ["success"] * 3
+        assert request_budget.searches == 2
+
+    asyncio.run(main())
+
+
+def test_deadline_of_first_request_does_not_cancel_shared_run():
+    async def main():
+        contextualizer, runs = make_contextualizer(searches=1, delay=0.2)
+        hurried, patient = RequestBudget(deadline_seconds=0.05), RequestBudget(deadline_seconds=5)
+        results = await asyncio.gather(process_with(contextualizer, "shared statement three", hurried),
+                                       process_with(contextualizer, "shared statement three", patient),
+                                       return_exceptions=True)
+        assert isinstance(results[0], BudgetExceeded) and results[0].reason == "deadline"
+        assert results[1]["status"] == "success"
+        assert patient.searches == 1
+
+    asyncio.run(main())
+
+
+def test_absorb_charges_at_most_the_limit():
+    request_budget = RequestBudget(max_tokens=100, max_searches=5)
+    request_budget.absorb(60, 2)
+    assert request_budget.exceeded is None
+    request_budget.absorb(60, 2)
+    assert (request_budget.tokens, request_budget.searches, request_budget.exceeded) == (100, 4, "tokens")
+    with pytest.raises(BudgetExceeded):
+        request_budget.check()
+
+
+@pytest.mark.parametrize("entry_concurrency", [2, None])
+def test_entries_are_skipped_once_the_budget_runs_out(monkeypatch, entry_concurrency):
+    import app
+
+    searches = []
+
+    async def run_agent(self, statement, date=None, originator=None):
+        for _ in range(3):
+            charge_search()
+            searches.append(statement)
+            await asyncio.sleep(0.01)
+        return {"status": "success", "output": f"Context for {statement}"}
+
+    monkeypatch.setattr(Contextualizer, "run_agent", run_agent)
+    request = app.Request(model_name="gpt-4o", text="An article.", contextualize=True, context_engine="agent")
+    analysis_results = {"Doubt": [{"explanation": "", "location": f"Entry statement {index} {entry_concurrency}"}
+                                  for index in range(5)]}
+    request_budget = RequestBudget(max_searches=6, entry_concurrency=entry_concurrency)
+
+    async def main():
+        with budget(request_budget):
+            await app.contextualize(request, analysis_results)
+
+    asyncio.run(main())
+    statuses = [entry["contextualize_status"] for entry in analysis_results["Doubt"]]
+    assert len(searches) == 6 and request_budget.searches == 6
+    if entry_concurrency:
+        # The first entries finish, the ones that did not start yet make no searches
+        assert statuses == ["success"] * 2 + [SKIPPED_BUDGET] * 3
+        assert set(searches) == {entry["location"] for entry in analysis_results["Doubt"][:2]}
+    else:
+        # Without the limit every entry starts, and the budget runs out before any of them finishes
+        assert statuses == [SKIPPED_BUDGET] * 5
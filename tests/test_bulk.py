@@ -0,0 +1,127 @@
+import json
+
+import pytest
+
+from llm import bulk
+from llm.bulk import BulkDetection, LocalBatchProvider
+from llm.cache import TieredCache
+
+SENTENCES = [f"Sentence number {index} is {'an outrageous' if index % 3 == 0 else 'a calm'} statement about topic {index}."
+             for index in range(12)]
+ARTICLE = " ".join(SENTENCES)
+
+
+def complete(body):
+    """Flags every whole sentence of the request's text that is outrageous, and fails on "broken" texts."""
+    text = body["messages"][-1]["content"]
+    if "broken" in text:
+        raise RuntimeError("model error")
+    found = [sentence for sentence in SENTENCES if "outrageous" in sentence and sentence in text] \
+        or ([text] if "outrageous" in text else [])
+    if not found:
+        return "{}"
+    return json.dumps({"Loaded_Language": [{"explanation": "Strong words", "location": location} for location in found]})
+
+
+@pytest.fixture(autouse=True)
+def detection_cache(monkeypatch):
+    cache = TieredCache("test_bulk_detection")
+    monkeypatch.setattr(bulk, "detection_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def provider():
+    return LocalBatchProvider(complete)
+
+
+def submitted_texts(provider):
+    return [line["body"]["messages"][-1]["content"] for batch in provider.batches.values() for line in batch["lines"]]
+
+
+def locations(result):
+    return [entry["location"] for entry in result.get("Loaded_Language", [])]
+
+
+def test_run_submits_waits_and_collects_in_order(provider):
+    texts = ["An outrageous claim.", "A calm remark.", "Another outrageous claim.", "This one is broken."]
+    results = BulkDetection("gpt-4o", provider, poll_interval=0, max_requests=3).run(texts)
+
+    assert list(provider.batches) == ["local_batch_0", "local_batch_1"]
+    # Each batch was polled until it finished
+    assert [batch["checks"] for batch in provider.batches.values()] == [2, 2]
+    assert [result["status"] for result in results] == ["success", "success", "success", "error"]
+    assert locations(results[0]) == ["An outrageous claim."]
+    assert results[1] == {"status": "success"}
+    assert locations(results[2]) == ["Another outrageous claim."]
+    assert results[3]["error"] == "model error"
+
+
+def test_run_collects_earlier_batches_without_submitting(provider):
+    texts = ["An outrageous claim.", "A calm remark."]
+    # An earlier run submitted its requests and stopped before collecting them
+    first = BulkDetection("gpt-4o", provider, poll_interval=0)
+    batch_ids = [provider.submit(first.build_requests(texts, set()))]
+
+    results = BulkDetection("gpt-4o", provider, poll_interval=0).run(texts, batch_ids=batch_ids)
+
+    assert list(provider.batches) == batch_ids
+    assert [result["status"] for result in results] == ["success", "success"]
+    assert locations(results[0]) == ["An outrageous claim."]
+
+
+def test_chunked_article_is_merged(provider, monkeypatch):
+    monkeypatch.setattr(bulk, "ARTICLE_CHUNK_SIZE", 250)
+    monkeypatch.setattr(bulk, "ARTICLE_CHUNK_OVERLAP", 120)
+    chunks = [chunk for chunk, _ in BulkDetection.split(ARTICLE)]
+    assert len(chunks) > 2
+    # Some outrageous sentences are in the overlap of two chunks, and detected in both
+    assert sum("outrageous" in sentence and sum(sentence in chunk for chunk in chunks) > 1
+               for sentence in SENTENCES) > 0
+
+    results = BulkDetection("gpt-4o", provider, poll_interval=0).run([ARTICLE, "A calm remark."])
+
+    assert submitted_texts(provider) == chunks + ["A calm remark."]
+    assert results[0]["status"] == "success"
+    assert locations(results[0]) == [sentence for sentence in SENTENCES if "outrageous" in sentence]
+
+
+def test_chunked_article_with_a_failed_chunk_is_an_error(monkeypatch):
+    monkeypatch.setattr(bulk, "ARTICLE_CHUNK_SIZE", 250)
+    monkeypatch.setattr(bulk, "ARTICLE_CHUNK_OVERLAP", 120)
+    article = ARTICLE + " This last sentence is broken."
+    results = BulkDetection("gpt-4o", LocalBatchProvider(complete), poll_interval=0).run([article])
+    assert results == [{"status": "error", "error": "model error"}]
+
+
+def test_repeated_articles_are_submitted_once(provider):
+    texts = ["An outrageous claim.", "A calm remark.", "An outrageous claim."]
+    results = BulkDetection("gpt-4o", provider, poll_interval=0).run(texts)
+
+    assert submitted_texts(provider) == ["An outrageous claim.", "A calm remark."]
+    assert results[2] == results[0]
+    # Copies, so changing one result does not change the other
+    results[2]["Loaded_Language"].clear()
+    assert locations(results[0]) == ["An outrageous claim."]
+
+
+def test_cached_articles_are_not_submitted(detection_cache):
+    texts = ["An outrageous claim.", "This one is broken."]
+    BulkDetection("gpt-4o", LocalBatchProvider(complete), poll_interval=0).run(texts)
+
+    provider = LocalBatchProvider(complete)
+    results = BulkDetection("gpt-4o", provider, poll_interval=0).run(texts + ["Another outrageous claim."])
+
+    # Successful detections were cached, failed ones are submitted again
+    assert submitted_texts(provider) == ["This one is broken.", "Another outrageous claim."]
+    assert locations(results[0]) == ["An outrageous claim."]
+    assert results[0]["status"] == "success"
+    assert detection_cache.counters["memory_hits"] == 1
+
+
+def test_nothing_is_submitted_when_every_article_is_cached(provider):
+    texts = ["An outrageous claim."]
+    BulkDetection("gpt-4o", LocalBatchProvider(complete), poll_interval=0).run(texts)
+    results = BulkDetection("gpt-4o", provider, poll_interval=0).run(texts)
+    assert provider.batches == {}
+    assert locations(results[0]) == ["An outrageous claim."]
@@ -0,0 +1,162 @@
+import multiprocessing
+import sys
+
+import pytest
+
+from llm import cache_stores
+from llm.cache_stores import CacheStore, CompressedJSONSerializer, JSONSerializer, RedisCacheStore, SQLiteCacheStore
+
+VALUE = {"text": "Ein Artikel über \"Propaganda\" " * 20, "sources": [1, 2.5, None, True], "nested": {"list": []}}
+
+
+def redis_store(**kwargs):
+    return RedisCacheStore(url="local", prefix="test:", **kwargs)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_store(request, tmp_path):
+    """
+    Creates stores of one backend that share their data, like the workers of a host do.
+    """
+    if request.param == "sqlite":
+        path = str(tmp_path / "cache.sqlite3")
+        return lambda serializer=None: SQLiteCacheStore(path=path, serializer=serializer)
+    client = cache_stores.LocalRedis()
+    return lambda serializer=None: RedisCacheStore(client=client, prefix="test:", serializer=serializer)
+
+
+@pytest.mark.parametrize("serializer", ["json", "json+zlib"])
+def test_round_trip(make_store, serializer):
+    store = make_store(cache_stores.get_serializer(serializer))
+    store.set("contexts", "key", VALUE)
+    assert store.get("contexts", "key") == VALUE
+    assert store.get("contexts", "missing") is None
+    assert store.get("pages", "key") is None
+    store.set("contexts", "key", ["replaced"])
+    assert store.get("contexts", "key") == ["replaced"]
+
+
+def test_compressed_serializer_reads_json_entries(make_store):
+    make_store(JSONSerializer()).set("contexts", "old", VALUE)
+    store = make_store(CompressedJSONSerializer())
+    store.set("contexts", "new", VALUE)
+    assert store.get("contexts", "old") == VALUE
+    assert store.get("contexts", "new") == VALUE
+
+
+def test_unknown_serializer_is_rejected():
+    with pytest.raises(ValueError):
+        cache_stores.get_serializer("pickle")
+
+
+def test_incomplete_store_cannot_be_instantiated():
+    class GetOnlyStore(CacheStore):
+        def get(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError, match="_write"):
+        GetOnlyStore()
+
+
+def test_entries_expire_after_their_ttl(make_store, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_stores.time, "time", lambda: now[0])
+    store = make_store()
+    store.set("pages", "short", 1, ttl=60)
+    store.set("pages", "forever", 2)
+    now[0] += 59
+    assert store.get("pages", "short") == 1
+    now[0] += 2
+    assert store.get("pages", "short") is None
+    assert store.get("pages", "forever") == 2
+
+
+def test_prune_keeps_the_newest_max_entries(make_store, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_stores.time, "time", lambda: now[0])
+    monkeypatch.setattr(cache_stores, "PRUNE_EVERY", 10)
+    store = make_store()
+    for index in range(10):
+        now[0] += 1
+        store.set("pages", f"key-{index}", index, max_entries=4)
+    assert [store.get("pages", f"key-{index}") for index in range(10)] == [None] * 6 + [6, 7, 8, 9]
+    # Namespaces are pruned on their own
+    store.set("contexts", "key", "kept", max_entries=4)
+    assert store.get("contexts", "key") == "kept"
+
+
+def test_sqlite_prune_deletes_expired_rows(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_stores.time, "time", lambda: now[0])
+    store = SQLiteCacheStore(path=str(tmp_path / "cache.sqlite3"))
+    store.set("pages", "short", 1, ttl=60)
+    store.set("pages", "forever", 2)
+    now[0] += 61
+    store.prune("pages", ttl=60)
+    assert store._connect().execute("SELECT key FROM cache_entries").fetchall() == [("forever",)]
+
+
+def test_sqlite_reconnects_in_a_new_process(tmp_path, monkeypatch):
+    store = SQLiteCacheStore(path=str(tmp_path / "cache.sqlite3"))
+    parent_db = store._connect()
+    monkeypatch.setattr(cache_stores.os, "getpid", lambda: -1)
+    worker_db = store._connect()
+    assert worker_db is not parent_db
+    assert store._connect() is worker_db
+
+
+def _write_in_worker(store, parent_db_id, results):
+    try:
+        store.set("pages", "worker", {"written": "in the worker"})
+        # Addresses survive the fork, so an inherited connection would keep its id
+        results.put((id(store._connect()) != parent_db_id, store.get("pages", "parent")))
+    except Exception as e:
+        results.put(repr(e))
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="needs fork")
+def test_sqlite_store_works_in_forked_workers(tmp_path):
+    # Like gunicorn --preload: the store is created, and connected, before the workers are forked
+    store = SQLiteCacheStore(path=str(tmp_path / "cache.sqlite3"))
+    store.set("pages", "parent", {"written": "before the fork"})
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    args = (store, id(store._connect()), results)
+    workers = [context.Process(target=_write_in_worker, args=args) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+    assert [results.get(timeout=5) for _ in workers] == [(True, {"written": "before the fork"})] * 2
+    assert store.get("pages", "worker") == {"written": "in the worker"}
+
+
+def test_redis_index_is_not_kept_without_max_entries(monkeypatch):
+    monkeypatch.setattr(cache_stores, "PRUNE_EVERY", 10)
+    store = redis_store()
+    for index in range(25):
+        store.set("pages", f"key-{index}", {"index": index})
+    assert store.client.zcard(store._index("pages")) == 0
+    assert store.get("pages", "key-0") == {"index": 0}
+
+
+def test_redis_prune_drops_an_index_left_from_a_limited_namespace():
+    store = redis_store()
+    for index in range(5):
+        store.set("pages", f"key-{index}", index, max_entries=10)
+    assert store.client.zcard(store._index("pages")) == 5
+    store.prune("pages")
+    assert store.client.zcard(store._index("pages")) == 0
+
+
+def test_redis_prune_drops_expired_keys_from_the_index(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_stores.time, "time", lambda: now[0])
+    store = redis_store()
+    for index in range(3):
+        store.set("pages", f"old-{index}", index, ttl=60, max_entries=10)
+    now[0] += 120
+    store.set("pages", "new", 3, ttl=60, max_entries=10)
+    store.prune("pages", max_entries=10, ttl=60)
+    assert store.client.zrange(store._index("pages"), 0, -1) == [b"new"]
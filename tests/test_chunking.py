@@ -0,0 +1,101 @@
+from llm.chunking import merge_detections, split_text
+
+
+def entry(location, explanation=""):
+    return {"location": location, "explanation": explanation}
+
+
+def locations(merged, technique):
+    return [item["location"] for item in merged.get(technique, [])]
+
+
+def chunk(text, shared=""):
+    """A chunk as returned by split_text, starting with the text it shares with the previous chunk."""
+    assert text.startswith(shared)
+    return text, len(shared)
+
+
+SENTENCES = [f"Sentence number {index} talks about topic {index} at some length." for index in range(12)]
+ARTICLE = " ".join(SENTENCES)
+
+
+def test_split_text_chunks_share_their_overlap():
+    chunks = split_text(ARTICLE, 200, 80)
+    assert len(chunks) > 2
+    assert chunks[0][1] == 0
+    for (previous, _), (following, shared) in zip(chunks, chunks[1:]):
+        overlap = following[:shared]
+        assert overlap and previous.endswith(overlap) and overlap in ARTICLE and len(overlap) <= 80
+
+
+def test_split_text_without_overlap_shares_nothing():
+    chunks = split_text("First paragraph here.\n\nSecond paragraph here. " + ARTICLE, 200)
+    assert len(chunks) > 1
+    assert [shared for _, shared in chunks] == [0] * len(chunks)
+    assert chunks[0][0].startswith("First paragraph here.\n\nSecond paragraph here.")
+
+
+def test_overlap_duplicate_is_kept_once_with_the_longer_location():
+    chunks = [chunk("First part. The shared sentence is here."),
+              chunk("The shared sentence is here. Second part.", "The shared sentence is here.")]
+    merged = merge_detections([
+        {"Loaded_Language": [entry("The shared sentence", "first")]},
+        {"Loaded_Language": [entry("The shared sentence is here.", "second")]},
+    ], chunks)
+    assert merged == {"Loaded_Language": [entry("The shared sentence is here.", "second")]}
+
+
+def test_passage_across_overlap_border_is_kept_once():
+    chunks = [chunk("First part. The shared sentence is here."),
+              chunk("The shared sentence is here. Second part.", "The shared sentence is here.")]
+    merged = merge_detections([
+        {"Doubt": [entry("First part. The shared sentence is here.")]},
+        {"Doubt": [entry("The shared sentence")]},
+    ], chunks)
+    assert locations(merged, "Doubt") == ["First part. The shared sentence is here."]
+
+
+def test_intentional_repetition_is_kept():
+    phrase = "They are traitors."
+    chunks = [chunk(f"{phrase} Some text in between. {phrase}"),
+              chunk(f"{phrase} More text and then again {phrase}", phrase)]
+    merged = merge_detections([
+        {"Name_Calling": [entry(phrase), entry(phrase)]},
+        {"Name_Calling": [entry(phrase), entry(phrase)]},
+    ], chunks)
+    # The overlap holds one occurrence, so the article repeats the phrase three times
+    assert locations(merged, "Name_Calling") == [phrase, phrase, phrase]
+
+
+def test_repetition_within_one_chunk_is_kept():
+    merged = merge_detections([{"Name_Calling": [entry("traitors"), entry("traitors")]}], [chunk("traitors and traitors")])
+    assert locations(merged, "Name_Calling") == ["traitors", "traitors"]
+
+
+def test_quote_contained_in_longer_quote_outside_overlap_is_kept():
+    chunks = [chunk("They are traitors to the nation. Filler text."),
+              chunk("Filler text. Still, traitors is what they are.", "Filler text.")]
+    merged = merge_detections([
+        {"Name_Calling": [entry("They are traitors to the nation.")]},
+        {"Name_Calling": [entry("traitors")]},
+    ], chunks)
+    assert locations(merged, "Name_Calling") == ["They are traitors to the nation.", "traitors"]
+
+
+def test_chunks_without_overlap_and_empty_locations_are_not_merged():
+    merged = merge_detections([
+        {"Doubt": [entry("same words"), entry("")]},
+        {"Doubt": [entry("same words"), entry("")]},
+    ], [chunk("same words start here"), chunk("and it ends with same words")])
+    assert locations(merged, "Doubt") == ["same words", "", "same words", ""]
+
+
+def test_duplicate_is_only_matched_against_the_previous_chunk():
+    chunks = [chunk("Alpha beta. Shared one."), chunk("Shared one. Gamma. Shared two.", "Shared one."),
+              chunk("Shared two. Delta.", "Shared two.")]
+    merged = merge_detections([
+        {"Doubt": [entry("Alpha beta.")]},
+        {"Doubt": [entry("Shared two.")]},
+        {"Doubt": [entry("Alpha beta."), entry("Shared two.")]},
+    ], chunks)
+    assert locations(merged, "Doubt") == ["Alpha beta.", "Shared two.", "Alpha beta."]
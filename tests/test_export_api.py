@@ -0,0 +1,36 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+import dependencies
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def export_analysis_results(compress=False, **filters):
+        yield b'{"id": "1"}\n'
+
+    monkeypatch.setattr(app, "export_analysis_results", export_analysis_results)
+    return TestClient(app.app)
+
+
+def test_export_is_disabled_by_default(client):
+    assert dependencies.EXPORT_API_ENABLED is False
+    assert client.get("/export/analyses").status_code == 404
+
+
+def test_export_stays_disabled_without_token(client, monkeypatch):
+    monkeypatch.setattr(dependencies, "EXPORT_API_ENABLED", True)
+    monkeypatch.setattr(dependencies, "EXPORT_API_TOKEN", "")
+    assert client.get("/export/analyses", headers={"Authorization": "Bearer "}).status_code == 404
+
+
+def test_export_requires_admin_token(client, monkeypatch):
+    monkeypatch.setattr(dependencies, "EXPORT_API_ENABLED", True)
+    monkeypatch.setattr(dependencies, "EXPORT_API_TOKEN", "secret")
+    assert client.get("/export/analyses").status_code == 401
+    assert client.get("/export/analyses", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    response = client.get("/export/analyses", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.content == b'{"id": "1"}\n'
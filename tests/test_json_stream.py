@@ -0,0 +1,170 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from llm import propaganda_detection
+from llm.cache import TieredCache
+from llm.json_stream import IncrementalDetectionParser
+from llm.propaganda_detection import OpenAITextClassificationPropagandaInference
+
+DETECTIONS = {
+    "Loaded_Language": [
+        {"explanation": "Quotes \"the {enemy}\" with a brace } and a bracket ]", "location": "the \"{enemy}\""},
+        {"explanation": "A backslash \\ before a quote \\\"", "location": "ends with a backslash \\"},
+    ],
+    "Name_Calling, Labeling": [],
+    "Doubt": [{"explanation": "Ünïcödé – and an escaped \\u escape", "location": "[who knows]"}],
+}
+COMPLETION = json.dumps(DETECTIONS, indent=1, ensure_ascii=False)
+ESCAPED_COMPLETION = json.dumps(DETECTIONS)
+OCCURRENCES = [(technique, entry) for technique, entries in DETECTIONS.items() for entry in entries]
+
+
+def feed_all(chunks):
+    parser = IncrementalDetectionParser()
+    found = []
+    for chunk in chunks:
+        found.extend(parser.feed(chunk))
+    return parser, found
+
+
+@pytest.mark.parametrize("completion", [COMPLETION, ESCAPED_COMPLETION])
+def test_character_by_character(completion):
+    parser, found = feed_all(completion)
+    assert found == OCCURRENCES
+    assert parser.result() == DETECTIONS
+
+
+@pytest.mark.parametrize("size", [2, 3, 5, 7, 11])
+def test_chunks_split_tokens_and_escapes(size):
+    chunks = [ESCAPED_COMPLETION[start:start + size] for start in range(0, len(ESCAPED_COMPLETION), size)]
+    # Some chunks end right after a backslash, so the escaped character arrives with the next one
+    assert any(chunk.endswith("\\") for chunk in chunks)
+    assert feed_all(chunks)[1] == OCCURRENCES
+
+
+def test_every_split_point():
+    for split in range(len(ESCAPED_COMPLETION)):
+        found = feed_all([ESCAPED_COMPLETION[:split], ESCAPED_COMPLETION[split:]])[1]
+        assert found == OCCURRENCES, split
+
+
+def test_occurrences_are_returned_once_closed():
+    first_end = ESCAPED_COMPLETION.index("}, {") + 1
+    parser = IncrementalDetectionParser()
+    assert parser.feed(ESCAPED_COMPLETION[:first_end - 1]) == []
+    assert parser.feed(ESCAPED_COMPLETION[first_end - 1:first_end]) == OCCURRENCES[:1]
+    assert parser.feed(ESCAPED_COMPLETION[first_end:]) == OCCURRENCES[1:]
+
+
+def test_empty_completion():
+    parser, found = feed_all(["{", "}"])
+    assert found == []
+    assert parser.result() == {}
+
+
+class FakeLLM:
+    """Streams a completion in chunks of a few characters, and answers whole prompts from a function."""
+
+    def __init__(self, completion="{}", answer=None, size=4):
+        self.completion = completion
+        self.answer = answer
+        self.size = size
+        self.calls = []
+
+    async def astream(self, prompt):
+        self.calls.append(prompt)
+        for start in range(0, len(self.completion), self.size):
+            await asyncio.sleep(0)
+            yield SimpleNamespace(content=self.completion[start:start + self.size])
+
+    async def ainvoke(self, prompt):
+        self.calls.append(prompt)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(content=self.answer(prompt[-1].content))
+
+
+@pytest.fixture(autouse=True)
+def detection_cache(monkeypatch):
+    cache = TieredCache("test_stream_detection")
+    monkeypatch.setattr(propaganda_detection, "detection_cache", cache)
+    return cache
+
+
+def analyze(llm, text):
+    inference = OpenAITextClassificationPropagandaInference(model_name="gpt-4o")
+    inference.llm = llm
+    emitted = []
+
+    async def on_entry(technique, entry_id, entry):
+        emitted.append((entry_id, entry, len(llm.calls)))
+
+    result = asyncio.run(inference.analyze_article_stream(text, on_entry))
+    return result, emitted
+
+
+def formatted(technique_entries):
+    return [{"explanation": entry["explanation"], "location": entry["location"].strip().strip('"').strip("'")}
+            for entry in technique_entries]
+
+
+def test_analyze_article_stream_emits_while_streaming():
+    result, emitted = analyze(FakeLLM(ESCAPED_COMPLETION), "A short article.")
+    assert [entry_id for entry_id, _, _ in emitted] == ["Loaded_Language:0", "Loaded_Language:1", "Doubt:0"]
+    assert result["status"] == "success"
+    for technique, entries in DETECTIONS.items():
+        assert result[technique] == formatted(entries)
+    # The entries sent are the ones returned
+    assert emitted[0][1] is result["Loaded_Language"][0]
+
+
+def test_analyze_article_stream_emits_missed_entries_from_the_complete_output(monkeypatch):
+    class MissingParser(IncrementalDetectionParser):
+        """Misses every occurrence after the first."""
+        def feed(self, chunk):
+            found = super().feed(chunk)
+            self.seen = getattr(self, "seen", 0) + len(found)
+            return found if self.seen == len(found) else []
+
+    monkeypatch.setattr(propaganda_detection, "IncrementalDetectionParser", MissingParser)
+    result, emitted = analyze(FakeLLM(ESCAPED_COMPLETION), "A short article.")
+
+    assert [entry_id for entry_id, _, _ in emitted] == ["Loaded_Language:0", "Loaded_Language:1", "Doubt:0"]
+    assert [entry for _, entry, _ in emitted] == \
+        formatted(DETECTIONS["Loaded_Language"]) + formatted(DETECTIONS["Doubt"])
+    assert result["Name_Calling, Labeling"] == []
+
+
+def test_analyze_article_stream_emits_cached_detections(detection_cache):
+    analyze(FakeLLM(ESCAPED_COMPLETION), "A short article.")
+    llm = FakeLLM("not called")
+    result, emitted = analyze(llm, "A short article.")
+    assert llm.calls == []
+    assert [entry_id for entry_id, _, _ in emitted] == ["Loaded_Language:0", "Loaded_Language:1", "Doubt:0"]
+    assert result["Doubt"] == formatted(DETECTIONS["Doubt"])
+
+
+def test_chunked_article_emits_only_after_the_merge(monkeypatch):
+    monkeypatch.setattr(propaganda_detection, "ARTICLE_CHUNK_SIZE", 120)
+    monkeypatch.setattr(propaganda_detection, "ARTICLE_CHUNK_OVERLAP", 60)
+    sentences = [f"Sentence {index} of the long article is {'loaded' if index in (2, 5) else 'plain'}."
+                 for index in range(10)]
+    article = " ".join(sentences)
+
+    def answer(chunk):
+        return json.dumps({"Loaded_Language": [{"explanation": "Loaded", "location": sentence}
+                                               for sentence in sentences if "loaded" in sentence and sentence in chunk]})
+    llm = FakeLLM(answer=answer)
+    result, emitted = analyze(llm, article)
+
+    chunk_count = len(llm.calls)
+    assert chunk_count > 2
+    # Both loaded sentences are in the overlap of two chunks
+    assert [sum(sentence in call[-1].content for call in llm.calls) for sentence in (sentences[2], sentences[5])] \
+        == [2, 2]
+    # Chunks are not streamed: every entry is sent once all chunks are analyzed and merged
+    assert [calls for _, _, calls in emitted] == [chunk_count] * 2
+    assert [entry["location"] for _, entry, _ in emitted] == [sentences[2], sentences[5]]
+    assert result["Loaded_Language"] == [entry for _, entry, _ in emitted]
@@ -0,0 +1,242 @@
+import asyncio
+
+import httpx
+import pytest
+
+from llm import http_pool
+from llm import page_fetcher as page_fetcher_module
+from llm.cache import SingleFlight, TieredCache
+from llm.page_fetcher import PageFetcher, extract_main_text
+
+ARTICLE_HTML = """<html><head><title>The  article title</title>
+<script>var paragraph = "<p>This script text must never be part of the main text at all.</p>";</script>
+<style>p { color: red; }</style></head>
+<body>
+<nav><ul><li>Home page link of the site navigation menu, which is long enough</li></ul></nav>
+<header><p>Subscribe to our newsletter for the latest news about everything.</p></header>
+<article>
+<h1>A headline that is long enough to count as a block</h1>
+<p>The first paragraph of the article tells what happened, and where it happened.</p>
+<p>Short caption</p>
+<p>The second paragraph<br>continues after a line break with more details.</p>
+</article>
+<aside><p>Related: another article that is not part of this one at all.</p></aside>
+<footer><p>Copyright notice of the publisher, with all of its rights reserved.</p></footer>
+</body></html>"""
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    monkeypatch.setattr(page_fetcher_module, "page_cache", TieredCache("test_page_text"))
+    monkeypatch.setattr(page_fetcher_module, "page_flight", SingleFlight())
+    monkeypatch.setattr(page_fetcher_module, "page_counters",
+                        {"fetched": 0, "failed": 0, "skipped": 0, "blocked": 0, "bytes": 0})
+    monkeypatch.setattr(page_fetcher_module, "resolve_host", resolve_host)
+
+
+HOSTS = {"example.com": ["93.184.216.34"], "intranet.example.com": ["10.0.0.7"],
+         "mixed.example.com": ["93.184.216.34", "127.0.0.1"]}
+
+
+async def resolve_host(host, port):
+    if host not in HOSTS:
+        raise OSError(f"Unknown host {host}")
+    return HOSTS[host]
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Routes the "pages" pool through a handler of httpx.MockTransport."""
+    def install(handler):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setitem(http_pool._async_clients, "pages", client)
+    return install
+
+
+def html_response(body=ARTICLE_HTML, content_type="text/html; charset=utf-8"):
+    return httpx.Response(200, headers={"content-type": content_type}, content=body)
+
+
+def test_extract_main_text_leaves_out_boilerplate():
+    document = extract_main_text(ARTICLE_HTML)
+    assert document["title"] == "The article title"
+    assert document["text"] == "\n".join([
+        "A headline that is long enough to count as a block",
+        "The first paragraph of the article tells what happened, and where it happened.",
+        "The second paragraph continues after a line break with more details.",
+    ])
+
+
+def test_extract_main_text_without_article_or_content_blocks():
+    assert extract_main_text("<div><p>A paragraph outside of any article element, but long enough.</p></div>"
+                             "<script>ignored()</script>")["text"] == \
+        "A paragraph outside of any article element, but long enough."
+    assert extract_main_text("<div>Text laid out\n in divs</div><nav>Menu</nav>")["text"] == "Text laid out in divs"
+
+
+def test_fetch_extracts_and_caps_the_text(serve):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return html_response()
+    serve(handler)
+
+    document = asyncio.run(PageFetcher(max_chars=60).fetch("https://example.com/article"))
+
+    assert document == {"url": "https://example.com/article", "title": "The article title",
+                        "text": "A headline that is long enough to count as a block\nThe first"}
+    assert requests[0].headers["user-agent"] == page_fetcher_module.PAGE_HEADERS["User-Agent"]
+    assert page_fetcher_module.page_counters["fetched"] == 1
+
+
+def test_non_html_pages_are_skipped(serve):
+    serve(lambda request: html_response(b"%PDF-1.4 binary", content_type="application/pdf"))
+    document = asyncio.run(PageFetcher().fetch("https://example.com/report.pdf"))
+    assert document == {"url": "https://example.com/report.pdf", "title": "", "text": ""}
+    assert page_fetcher_module.page_counters["skipped"] == 1
+
+
+def test_plain_text_pages_are_read(serve):
+    serve(lambda request: html_response(b"A plain text page.", content_type="text/plain"))
+    assert asyncio.run(PageFetcher().fetch("https://example.com/notes.txt"))["text"] == "A plain text page."
+
+
+def test_failed_pages_are_empty(serve):
+    serve(lambda request: httpx.Response(404, headers={"content-type": "text/html"}, content=b"Not found"))
+    document = asyncio.run(PageFetcher().fetch("https://example.com/missing"))
+    assert document["text"] == ""
+    assert page_fetcher_module.page_counters["failed"] == 1
+
+
+def test_slow_pages_time_out(serve):
+    async def handler(request):
+        async def trickle():
+            yield b"<p>The beginning of a page that never finishes loading at all.</p>"
+            await asyncio.sleep(5)
+            yield b"<p>Never read.</p>"
+        return httpx.Response(200, headers={"content-type": "text/html"}, content=trickle())
+    serve(handler)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        document = await PageFetcher(timeout=0.05).fetch("https://example.com/slow")
+        return document, loop.time() - start
+
+    document, elapsed = asyncio.run(main())
+    assert document["text"] == ""
+    assert elapsed < 1
+    assert page_fetcher_module.page_counters["failed"] == 1
+
+
+def test_large_pages_are_cut_off(serve):
+    sent = []
+
+    async def handler(request):
+        async def chunks():
+            for index in range(100):
+                sent.append(index)
+                yield b"<p>" + b"x" * 96 + b"</p>\n"
+        return httpx.Response(200, headers={"content-type": "text/html"}, content=chunks())
+    serve(handler)
+
+    document = asyncio.run(PageFetcher(max_bytes=1000, max_chars=10000).fetch("https://example.com/large"))
+
+    # The download stops at the cap instead of reading the whole page
+    assert len(sent) <= 11
+    assert 0 < len(document["text"]) < 1000
+
+
+def test_concurrent_downloads_are_limited(serve):
+    active = []
+    peak = []
+
+    async def handler(request):
+        active.append(request)
+        peak.append(len(active))
+        await asyncio.sleep(0.02)
+        active.remove(request)
+        return html_response()
+    serve(handler)
+
+    urls = [f"https://example.com/{index}" for index in range(8)]
+    documents = asyncio.run(PageFetcher(concurrency=3).fetch_many(urls))
+
+    assert [document["url"] for document in documents] == urls
+    assert max(peak) == 3
+
+
+def test_pages_are_fetched_once(serve):
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        await asyncio.sleep(0.02)
+        return html_response()
+    serve(handler)
+
+    async def main():
+        fetcher = PageFetcher()
+        # Coalesced while the first fetch runs, then served from the cache
+        first = await fetcher.fetch_many(["https://example.com/article"] * 3)
+        return first + [await fetcher.fetch("https://example.com/article")]
+
+    documents = asyncio.run(main())
+
+    assert len(requests) == 1
+    assert all(document == documents[0] for document in documents)
+    assert page_fetcher_module.page_flight.counters["joined"] == 2
+    assert page_fetcher_module.page_cache.counters["memory_hits"] == 1
+
+
+@pytest.mark.parametrize("url", [
+    "file:///etc/passwd",
+    "ftp://example.com/file.html",
+    "http://127.0.0.1/admin",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://[::1]:8080/",
+    "http://[::ffff:10.0.0.1]/",
+    "http://100.64.0.1/",
+    "http://intranet.example.com/",
+    "http://mixed.example.com/",
+    "http://unknown.invalid/",
+])
+def test_non_public_urls_are_not_requested(serve, url):
+    requests = []
+    serve(lambda request: requests.append(request) or html_response())
+    document = asyncio.run(PageFetcher().fetch(url))
+    assert document == {"url": url, "title": "", "text": ""}
+    assert requests == []
+    assert page_fetcher_module.page_counters["blocked"] == 1
+
+
+def test_redirects_are_checked_before_they_are_followed(serve):
+    requests = []
+
+    def handler(request):
+        requests.append(str(request.url))
+        if request.url.path == "/moved":
+            return httpx.Response(302, headers={"location": "/article"})
+        if request.url.path == "/article":
+            return html_response()
+        return httpx.Response(301, headers={"location": "http://169.254.169.254/latest/meta-data/"})
+    serve(handler)
+
+    async def main():
+        fetcher = PageFetcher()
+        return await fetcher.fetch("https://example.com/moved"), await fetcher.fetch("https://example.com/metadata")
+
+    moved, metadata = asyncio.run(main())
+
+    assert moved["title"] == "The article title"
+    assert metadata["text"] == ""
+    assert requests == ["https://example.com/moved", "https://example.com/article", "https://example.com/metadata"]
+    assert page_fetcher_module.page_counters["blocked"] == 1
+
+
+def test_redirect_loops_are_cut_off(serve):
+    requests = []
+    serve(lambda request: requests.append(request) or httpx.Response(302, headers={"location": "/again"}))
+    assert asyncio.run(PageFetcher().fetch("https://example.com/loop"))["text"] == ""
+    assert len(requests) == page_fetcher_module.PAGE_MAX_REDIRECTS + 1
@@ -0,0 +1,240 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+async def wait_for_event(event: threading.Event):
+    # Polled, as the tests set the event from their own thread
+    while not event.is_set():
+        await asyncio.sleep(0.005)
+
+
+class FakeAnalysis:
+    """
+    Stands in for the detection and contextualization calls of the app. Each article gets one Loaded_Language entry
+    whose location is the article text. Detections wait for `detected`, contextualizations for `contextualized`.
+    """
+
+    def __init__(self):
+        self.detected = threading.Event()
+        self.contextualized = threading.Event()
+        self.detections = []
+        self.active_detections = 0
+        self.peak_detections = 0
+        self.cancelled = []
+        self.saved = []
+
+    async def detect(self, request):
+        self.detections.append(request.text)
+        self.active_detections += 1
+        self.peak_detections = max(self.peak_detections, self.active_detections)
+        try:
+            await wait_for_event(self.detected)
+        except asyncio.CancelledError:
+            self.cancelled.append("detection")
+            raise
+        finally:
+            self.active_detections -= 1
+        return {"Loaded_Language": [{"explanation": "Strong words", "location": request.text}], "status": "success"}
+
+    def contextualizer(self, model_name, engine=None):
+        fake = self
+
+        class Contextualizer:
+            async def process_statement(self, statement):
+                try:
+                    await wait_for_event(fake.contextualized)
+                except asyncio.CancelledError:
+                    fake.cancelled.append("contextualization")
+                    raise
+                return {"status": "success", "output": f"Context of {statement}"}
+
+        return Contextualizer()
+
+    async def save(self, request, user_id, analysis_results):
+        self.saved.append((user_id, analysis_results))
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeAnalysis()
+    monkeypatch.setattr(app, "detect_propaganda_async", fake.detect)
+    monkeypatch.setattr(app, "Contextualizer", fake.contextualizer)
+    monkeypatch.setattr(app, "save_analysis", fake.save)
+    monkeypatch.setattr(app, "in_flight_analyses", {})
+    monkeypatch.setattr(app, "analysis_counters", {key: 0 for key in app.analysis_counters})
+    monkeypatch.setattr(app, "session_counters", {key: 0 for key in app.session_counters})
+    yield fake
+    # Let anything still waiting finish
+    fake.detected.set()
+    fake.contextualized.set()
+
+
+@pytest.fixture
+def client(fake, monkeypatch):
+    monkeypatch.setattr(app.analysis_writer, "start", lambda: None)
+    # Entered, so every websocket runs on the same event loop like in a worker
+    with TestClient(app.app) as client:
+        yield client
+
+
+def request(text="A short article.", **fields):
+    return {"user_id": None, "model_name": "gpt-4o", "text": text, **fields}
+
+
+def receive_until(websocket, message_type):
+    messages = []
+    while not messages or messages[-1]["type"] != message_type:
+        messages.append(websocket.receive_json())
+    return messages
+
+
+def test_identical_requests_share_one_analysis(client, fake):
+    with client.websocket_connect("/ws/analyze_propaganda") as first, \
+            client.websocket_connect("/ws/analyze_propaganda") as second:
+        first.send_json(request(user_id="first"))
+        wait_until(lambda: len(fake.detections) == 1)
+        second.send_json(request(user_id="second"))
+        wait_until(lambda: app.analysis_counters["joined"] == 1)
+        fake.detected.set()
+
+        messages = [first.receive_json(), second.receive_json()]
+
+    assert fake.detections == ["A short article."]
+    assert app.analysis_counters["started"] == 1
+    assert [message["user_id"] for message in messages] == ["first", "second"]
+    for message in messages:
+        assert message["type"] == "propaganda_detection"
+        assert message["data"] == {"Loaded_Language": [{"explanation": "Strong words", "location": "A short article."}]}
+    wait_until(lambda: len(fake.saved) == 2)
+    assert sorted(user_id for user_id, _ in fake.saved) == ["first", "second"]
+    assert app.in_flight_analyses == {}
+
+
+def test_different_requests_do_not_share(client, fake):
+    fake.detected.set()
+    fake.contextualized.set()
+    with client.websocket_connect("/ws/analyze_propaganda") as first, \
+            client.websocket_connect("/ws/analyze_propaganda") as second:
+        first.send_json(request("One article."))
+        second.send_json(request("One article.", contextualize=True))
+        first.receive_json()
+        receive_until(second, "contextualization")
+
+    assert app.analysis_counters["started"] == 2
+    assert app.analysis_counters["joined"] == 0
+
+
+def test_analysis_continues_when_one_of_two_clients_disconnects(client, fake):
+    with client.websocket_connect("/ws/analyze_propaganda") as first, \
+            client.websocket_connect("/ws/analyze_propaganda") as second:
+        first.send_json(request(user_id="first", contextualize=True))
+        second.send_json(request(user_id="second", contextualize=True))
+        fake.detected.set()
+        assert first.receive_json()["type"] == "propaganda_detection"
+        assert second.receive_json()["type"] == "propaganda_detection"
+
+        first.close()
+        wait_until(lambda: app.analysis_counters["disconnected"] == 1)
+        fake.contextualized.set()
+        message = second.receive_json()
+
+    assert message["type"] == "contextualization"
+    assert message["data"]["Loaded_Language"][0]["contextualize"] == "Context of A short article."
+    assert app.analysis_counters["cancelled"] == 0
+    assert fake.cancelled == []
+    wait_until(lambda: len(fake.saved) == 2)
+    saved = dict(fake.saved)
+    # The client that left gets what was done when it left, the other one the whole analysis
+    assert saved["first"]["Loaded_Language"][0]["contextualize_status"] == "cancelled"
+    assert saved["second"]["Loaded_Language"][0]["contextualize"] == "Context of A short article."
+
+
+def test_analysis_is_cancelled_when_every_client_disconnects(client, fake):
+    with client.websocket_connect("/ws/analyze_propaganda") as first, \
+            client.websocket_connect("/ws/analyze_propaganda") as second:
+        first.send_json(request(user_id="first", contextualize=True))
+        second.send_json(request(user_id="second", contextualize=True))
+        fake.detected.set()
+        first.receive_json()
+        second.receive_json()
+
+        first.close()
+        second.close()
+        wait_until(lambda: app.analysis_counters["cancelled"] == 1)
+
+    wait_until(lambda: fake.cancelled == ["contextualization"])
+    assert app.analysis_counters["disconnected"] == 2
+    assert app.in_flight_analyses == {}
+    # The detection results are saved for both clients, with the unfinished contextualization marked
+    wait_until(lambda: len(fake.saved) == 2)
+    assert app.analysis_counters["partial_saved"] == 2
+    for user_id, result in fake.saved:
+        assert result == {"Loaded_Language": [{"explanation": "Strong words", "location": "A short article.",
+                                               "contextualize_status": "cancelled"}]}
+
+
+def test_nothing_is_saved_when_clients_leave_during_the_detection(client, fake):
+    with client.websocket_connect("/ws/analyze_propaganda") as first, \
+            client.websocket_connect("/ws/analyze_propaganda") as second:
+        first.send_json(request())
+        second.send_json(request())
+        wait_until(lambda: app.analysis_counters["joined"] == 1)
+        first.close()
+        second.close()
+        wait_until(lambda: fake.cancelled == ["detection"])
+
+    assert app.analysis_counters["cancelled"] == 1
+    assert app.analysis_counters["partial_saved"] == 0
+    assert fake.saved == []
+
+
+def test_session_tags_messages_and_limits_concurrency(client, fake, monkeypatch):
+    monkeypatch.setattr(app, "SESSION_MAX_CONCURRENCY", 2)
+    texts = {"a": "Article A.", "b": "Article B.", "c": "Article C."}
+    with client.websocket_connect("/ws/session") as session:
+        for request_id, text in texts.items():
+            session.send_json({"type": "analyze", "request_id": request_id, **request(text)})
+        wait_until(lambda: len(fake.detections) == 2)
+        time.sleep(0.1)
+        # The third request waits for one of the first two
+        assert len(fake.detections) == 2
+
+        session.send_json({"type": "analyze", "request_id": "a", **request("Article A again.")})
+        error = session.receive_json()
+        session.send_json({"type": "ping"})
+        pong = session.receive_json()
+
+        fake.detected.set()
+        messages = []
+        while sum(message["type"] == "analysis_complete" for message in messages) < len(texts):
+            messages.append(session.receive_json())
+
+    assert error == {"type": "error", "status": "error", "request_id": "a",
+                     "message": "Every request needs a request_id that is not in use"}
+    assert pong == {"type": "pong"}
+    assert sorted(fake.detections) == sorted(texts.values())
+    assert fake.peak_detections == 2
+    for request_id, text in texts.items():
+        tagged = [message for message in messages if message["request_id"] == request_id]
+        assert [message["type"] for message in tagged] == ["propaganda_detection", "analysis_complete"]
+        assert tagged[0]["data"]["Loaded_Language"][0]["location"] == text
+        assert tagged[1]["status"] == "success"
+    # Requests without a user_id share the one generated for the session
+    user_ids = {message["user_id"] for message in messages}
+    assert len(user_ids) == 1
+    wait_until(lambda: len(fake.saved) == len(texts))
+    assert {user_id for user_id, _ in fake.saved} == user_ids
+    assert app.session_counters["requests"] == len(texts)